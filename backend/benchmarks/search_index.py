@@ -0,0 +1,83 @@
+import os
+import sys
+import random
+import tempfile
+import time
+
+# Indexing and query benchmark for the full-text search index.
+#
+#   python -m benchmarks.search_index [lessons] [users]
+#
+# Builds a synthetic corpus in a temporary SQLite database (or the database in
+# DATABASE_URL when BENCH_USE_DATABASE_URL=true), measuring incremental
+# indexing through save_cached_lesson / save_user_note, a full rebuild, and
+# query latency for common, rare and prefix searches.
+
+WORDS_PER_LESSON = 600
+WORDS_PER_NOTE = 60
+
+def _vocabulary(rng: random.Random, size: int = 20000) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+def _text(rng: random.Random, vocabulary: list, words: int) -> str:
+    # Zipf-like word frequencies, like natural text
+    return " ".join(vocabulary[min(int(rng.paretovariate(1.1)) - 1, len(vocabulary) - 1)] for _ in range(words))
+
+def _percentile(values: list, fraction: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+def run(lessons: int, users: int):
+    from services import auth_service as db
+
+    rng = random.Random(42)
+    vocabulary = _vocabulary(rng)
+    courses_per_user = max(1, lessons // (users * 10))
+
+    for user in range(users):
+        for course in range(courses_per_user):
+            db.save_user_course(f"user{user}@bench", {"course_id": f"course-{user}-{course}", "title": "Bench", "topic": "t"})
+
+    started = time.perf_counter()
+    for index in range(lessons):
+        user = index % users
+        course_id = f"course-{user}-{index % courses_per_user}"
+        db.save_cached_lesson(course_id, f"Lesson {index}", f"Topic {index // 10}", "Beginner",
+                              _text(rng, vocabulary, WORDS_PER_LESSON))
+        if index % 4 == 0:
+            db.save_user_note(f"user{user}@bench", course_id, f"Lesson {index}", _text(rng, vocabulary, WORDS_PER_NOTE))
+    incremental = time.perf_counter() - started
+    documents = lessons + (lessons + 3) // 4
+    print(f"Incremental indexing: {documents} documents in {incremental:.1f}s ({documents / incremental:.0f} docs/s)")
+
+    started = time.perf_counter()
+    rebuilt = db.rebuild_search_index()
+    rebuild = time.perf_counter() - started
+    print(f"Full rebuild: {rebuilt} documents in {rebuild:.1f}s ({rebuilt / rebuild:.0f} docs/s)")
+
+    queries = {
+        "common word": [vocabulary[rng.randint(0, 5)] for _ in range(50)],
+        "rare word": [vocabulary[rng.randint(1000, 19999)] for _ in range(50)],
+        "two words": [f"{vocabulary[rng.randint(0, 50)]} {vocabulary[rng.randint(0, 500)]}" for _ in range(50)],
+        "prefix": [vocabulary[rng.randint(0, 200)][:3] for _ in range(50)],
+    }
+    for label, texts in queries.items():
+        latencies = []
+        for text in texts:
+            started = time.perf_counter()
+            db.search_user_content(f"user{rng.randrange(users)}@bench", text)
+            latencies.append(time.perf_counter() - started)
+        print(f"Query ({label}): p50 {_percentile(latencies, 0.5):.1f} ms, p99 {_percentile(latencies, 0.99):.1f} ms")
+
+if __name__ == "__main__":
+    lessons = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    if os.getenv("BENCH_USE_DATABASE_URL", "false").lower() == "true":
+        run(lessons, users)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["SQLITE_PATH"] = os.path.join(directory, "bench.db")
+            os.environ.pop("DATABASE_URL", None)
+            run(lessons, users)
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+            print(f"Database size: {size / 1024 / 1024:.1f} MB")
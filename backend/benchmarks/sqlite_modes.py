@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+
+# Compare the default SQLite mode with SQLITE_CONCURRENT=true under a mixed
+# read/write load from many threads, the way the DB worker pool drives it.
+#
+#   python -m benchmarks.sqlite_modes [threads] [seconds]
+#
+# Each mode runs in a fresh process against its own temporary database.
+
+USERS = 50
+COURSES_PER_USER = 5
+
+def _run_load(threads: int, seconds: float, write_ratio: float) -> dict:
+    from services import auth_service as db
+
+    for user in range(USERS):
+        for course in range(COURSES_PER_USER):
+            db.save_user_course(f"user{user}@bench", {
+                "course_id": f"course-{user}-{course}", "title": f"Course {course}", "topic": "Benchmarking",
+                "level": "Beginner", "chapters": [{"id": "c1", "title": "Intro", "lessons": ["A", "B", "C"]}]
+            })
+        db.save_cached_lesson(f"course-{user}-0", "A", "Benchmarking", "Beginner", "# A\n" + "text " * 500, "mindmap\n  root((A))", "")
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    latencies = {"reads": [], "writes": []}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(index: int):
+        n = 0
+        local = {"reads": 0, "writes": 0, "errors": 0}
+        local_latencies = {"reads": [], "writes": []}
+        while time.perf_counter() < deadline:
+            user = f"user{(index * 7 + n) % USERS}@bench"
+            is_write = (n * 0.618 + index * 0.31) % 1 < write_ratio
+            started = time.perf_counter()
+            try:
+                if is_write:
+                    if n % 2:
+                        db.save_user_note(user, "course-0-0", f"lesson-{n % 20}", f"note {n}")
+                    else:
+                        db.log_user_activity(user, 1, 0)
+                else:
+                    if n % 2:
+                        db.get_user_courses(user, list(db.COURSE_SUMMARY_FIELDS), 10)
+                    else:
+                        db.get_cached_lesson("course-0-0", "A")
+                kind = "writes" if is_write else "reads"
+                local[kind] += 1
+                local_latencies[kind].append(time.perf_counter() - started)
+            except Exception:
+                local["errors"] += 1
+            n += 1
+        with lock:
+            for key in counts:
+                counts[key] += local[key]
+            for key in latencies:
+                latencies[key].extend(local_latencies[key])
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    def p99(values):
+        return round(sorted(values)[int(len(values) * 0.99)] * 1000, 2) if values else None
+
+    return {
+        "reads_per_sec": round(counts["reads"] / seconds),
+        "writes_per_sec": round(counts["writes"] / seconds),
+        "errors": counts["errors"],
+        "read_p99_ms": p99(latencies["reads"]),
+        "write_p99_ms": p99(latencies["writes"]),
+    }
+
+def _run_mode(concurrent: bool, threads: int, seconds: float, write_ratio: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, SQLITE_PATH=os.path.join(directory, "bench.db"),
+                   SQLITE_CONCURRENT="true" if concurrent else "false", TRACING_ENABLED="false")
+        env.pop("DATABASE_URL", None)
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.sqlite_modes", "--worker", str(threads), str(seconds), str(write_ratio)],
+            env=env, capture_output=True, text=True, check=True,
+            cwd=os.path.join(os.path.dirname(__file__), "..")
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--worker"]:
+        print(json.dumps(_run_load(int(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4]))))
+        sys.exit(0)
+
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{threads} threads, {seconds:g}s per run")
+    print(f"{'mix':<12}{'mode':<12}{'reads/s':>10}{'writes/s':>10}{'errors':>8}{'read p99':>10}{'write p99':>11}")
+    for label, write_ratio in (("read-heavy", 0.1), ("write-heavy", 0.5)):
+        for mode, concurrent in (("default", False), ("concurrent", True)):
+            result = _run_mode(concurrent, threads, seconds, write_ratio)
+            print(f"{label:<12}{mode:<12}{result['reads_per_sec']:>10}{result['writes_per_sec']:>10}{result['errors']:>8}"
+                  f"{result['read_p99_ms'] or '-':>10}{result['write_p99_ms'] or '-':>11}")
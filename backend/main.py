@@ -1,43 +1,165 @@
 import os
+import json
 import uuid
-from fastapi import FastAPI, HTTPException, Header
+import asyncio
+from datetime import date, timedelta
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Header, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
-from schemas.syllabus import SyllabusRequest, SyllabusResponse
-from schemas.quiz import QuizRequest, QuizResponse
-from schemas.lesson import LessonContentRequest, LessonContentResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Optional, Literal, Tuple, List
+from schemas.syllabus import SyllabusRequest, SyllabusResponse, SimilarSyllabus, SimilarSyllabiResponse
+from schemas.quiz import QuizRequest, QuizResponse, ChapterQuizRequest, ChapterQuizResponse
+from schemas.lesson import (
+    LessonContentRequest, LessonContentResponse, LessonOutlineResponse, LessonSectionInfo, LessonSection,
+    LessonBundleRequest, LessonBundleResponse, LessonRegenerateRequest, LessonRegenerateResponse
+)
 from schemas.diagram import DiagramRequest, DiagramResponse
-from schemas.user import UserRegister, UserLogin, VerifyEmail, UserResponse, CourseProgress
+from schemas.search import SearchResult, SearchResponse
+from schemas.admin import ProfileCapture, ProfileListResponse
+from schemas.user import (
+    UserRegister, UserLogin, VerifyEmail, UserResponse, CourseProgress,
+    SyncRequest, SyncResponse, SyncResult, SyncProgressData, SyncNoteData, SyncNotePatchData, NotePatchRequest,
+    ActivityPeriod, ActivityHistoryResponse, LeaderboardEntry, LeaderboardRank, LeaderboardResponse
+)
 from services.gemini_service import (
     generate_syllabus_content, 
     generate_quiz_content, 
+    generate_chapter_quiz_content,
     generate_diagram_content,
     generate_lesson_content,
+    regenerate_lesson_part_content,
     generate_course_suggestions
 )
 from services.auth_service import (
+    get_user_from_supabase_token,
+    encode_course_cursor,
+    COURSE_FIELDS,
+    COURSE_SUMMARY_FIELDS,
+    period_start,
+    NoteVersionConflict
+)
+from services.async_db import (
     register_user,
     verify_email,
-    login_user,
+    get_login_hash,
+    create_session,
     get_user_by_token,
-    get_user_from_supabase_token,
     logout_user,
     save_user_course,
     get_user_courses,
+    get_user_course,
+    save_syllabus,
+    get_syllabus,
     get_cached_lesson,
+    get_lesson_outline,
+    get_lesson_section,
     save_cached_lesson,
+    patch_cached_lesson,
+    delete_user_course,
+    purge_unreferenced_lesson_bodies,
+    get_cached_quizzes,
+    save_cached_quizzes,
+    get_cached_diagram,
+    save_cached_diagram,
     get_user_note,
     save_user_note,
+    patch_user_note,
     log_user_activity,
     get_user_stats,
-    update_daily_goal
+    get_activity_history,
+    update_daily_goal,
+    apply_user_sync,
+    search_user_content,
+    find_similar_syllabi,
+    find_matching_syllabus
+)
+from services.hashing_service import hash_password_async, verify_password_async, HashingPoolBusy
+from services.metrics_service import get_metrics, incr
+from services.syllabus_index import index_syllabus, normalize_topic
+from services.leaderboard import get_leaderboard
+from services.lesson_sections import split_lesson_sections
+from services.email_service import start_email_worker, stop_email_worker
+from services.tracing_service import TRACING_ENABLED, trace_request, span
+from services.profiling_service import should_profile, profile_request, list_captures, capture_path
+from services.generation_quota import (
+    GENERATION_QUOTA_ENABLED, GenerationQuotaExceeded, quota_key, begin_request_quota, charge_generation,
+    request_quota_status, identity_cache, start_quota_sync, stop_quota_sync
 )
+from services.generation_scheduler import Priority, GenerationQueueFull, generation_slot
+from services.circuit_breaker import CircuitOpenError, gemini_breaker
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 load_dotenv()
 
-app = FastAPI(title="The Infinite Tutor API")
+# Reuse the stored syllabus of an identical intake instead of generating a new one
+SYLLABUS_REUSE = os.getenv("SYLLABUS_REUSE", "true").lower() == "true"
+
+# Largest page /user/courses will return
+COURSES_MAX_PAGE_SIZE = int(os.getenv("COURSES_MAX_PAGE_SIZE", "100"))
+# Largest range /user/stats/history serves, in periods per granularity
+HISTORY_MAX_PERIODS = {"day": 366, "week": 260, "month": 120}
+# Largest batch accepted by /user/sync
+SYNC_MAX_OPERATIONS = int(os.getenv("SYNC_MAX_OPERATIONS", "200"))
+# Most edits accepted in one PATCH of a note
+NOTE_PATCH_MAX_OPS = int(os.getenv("NOTE_PATCH_MAX_OPS", "200"))
+# Routes that call Gemini, limited per caller by services/generation_quota.py
+GENERATION_PATHS = {
+    "/generate-syllabus", "/generate-quiz", "/generate-chapter-quizzes", "/generate-diagram",
+    "/generate-lesson", "/generate-lesson-bundle", "/regenerate-lesson-part",
+}
+# Accounts allowed to use the /admin endpoints
+ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_email_worker()
+    start_quota_sync()
+    purged = await purge_unreferenced_lesson_bodies()
+    if purged:
+        print(f"🧹 Purged {purged} unreferenced lesson bodies")
+    yield
+    stop_email_worker()
+    stop_quota_sync()
+
+app = FastAPI(title="The Infinite Tutor API", lifespan=lifespan)
+
+async def generation_quota_keys(request: Request) -> List[str]:
+    """The caller's quota buckets: their account when verified, otherwise their IP address, plus their network."""
+    address = request.client.host if request.client else "unknown"
+    keys = [quota_key("network", address)]
+    authorization = request.headers.get("authorization")
+    key = None
+    if authorization:
+        found, key = identity_cache.get(authorization)
+        if not found:
+            # Only verified identities: an unchecked JWT could name a new account on every request
+            user = await get_verified_user(authorization)
+            key = quota_key("user", user["email"]) if user else None
+            identity_cache.put(authorization, key)
+    keys.append(key or quota_key("ip", address))
+    return keys
+
+# Registered before CORS so that 429s still carry the CORS headers
+@app.middleware("http")
+async def enforce_generation_quota(request: Request, call_next):
+    """Limit how many generation requests each user or IP address can make."""
+    if not GENERATION_QUOTA_ENABLED or request.method != "POST" or request.url.path not in GENERATION_PATHS:
+        return await call_next(request)
+    
+    decision = begin_request_quota(await generation_quota_keys(request))
+    if not decision.allowed:
+        incr("quota.rejected")
+        return JSONResponse(
+            status_code=429,
+            content={"detail": f"Generation quota exceeded; try again in {decision.retry_after} seconds"},
+            headers=decision.headers()
+        )
+    response = await call_next(request)
+    response.headers.update((request_quota_status() or decision).headers())
+    return response
 
 # Add CORS middleware
 app.add_middleware(
@@ -46,47 +168,149 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Open a root trace span per request when TRACING_ENABLED is set."""
+    if not TRACING_ENABLED:
+        return await call_next(request)
+    
+    with trace_request(f"{request.method} {request.url.path}", **{"http.method": request.method}) as root:
+        response = await call_next(request)
+        root.set_attribute("http.status_code", response.status_code)
+        return response
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    """Profile a sample of requests when PROFILING_ENABLED is set, keeping the slow ones."""
+    if not should_profile():
+        return await call_next(request)
+    
+    with profile_request(request.method, request.url.path) as details:
+        response = await call_next(request)
+        # Group captures by route (e.g. /lesson/{course_id}/outline) rather than by URL
+        route = request.scope.get("route")
+        if route is not None:
+            details["path"] = route.path
+        details["status"] = response.status_code
+        return response
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
 
-def get_current_user(authorization: Optional[str]) -> Optional[dict]:
+@app.get("/metrics")
+def metrics():
+    return get_metrics()
+
+async def require_admin(authorization: Optional[str]) -> dict:
+    # Verified identities only: an unchecked JWT could claim any admin's email
+    user = await get_verified_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if user["email"].lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+@app.get("/admin/profiles", response_model=ProfileListResponse)
+async def admin_profiles(limit: int = Query(50, ge=1, le=500), authorization: Optional[str] = Header(None)):
+    """Summaries of the most recent slow-request profiles, newest first."""
+    await require_admin(authorization)
+    captures = await run_in_threadpool(list_captures, limit)
+    return ProfileListResponse(captures=[ProfileCapture(**capture) for capture in captures])
+
+@app.get("/admin/profiles/{capture_id}")
+async def admin_profile(capture_id: str, authorization: Optional[str] = Header(None)):
+    """A capture's collapsed stacks, ready for flamegraph.pl or speedscope."""
+    await require_admin(authorization)
+    path = capture_path(capture_id)
+    if not path:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="text/plain", filename=f"{capture_id}.folded")
+
+def service_unavailable(retry_after: int, detail: str) -> HTTPException:
+    """Build a 503 that tells the client when to try again."""
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(retry_after)})
+
+async def run_generation(priority: Priority, fn, *args):
+    """Run a blocking Gemini generator in the threadpool once the scheduler admits it."""
+    # Don't queue behind other requests for a provider we already know is down
+    gemini_breaker.check()
+    charge_generation()
+    async with generation_slot(priority):
+        return await run_in_threadpool(fn, *args)
+
+async def get_current_user(authorization: Optional[str]) -> Optional[dict]:
     """Get current user from either Supabase JWT or legacy token."""
     if not authorization or not authorization.startswith("Bearer "):
         return None
     
     token = authorization.split(" ")[1]
     
-    # Try Supabase JWT first
-    user = get_user_from_supabase_token(token)
-    if user:
+    with span("auth.get_current_user"):
+        # Try Supabase JWT first
+        user = get_user_from_supabase_token(token)
+        if user:
+            return user
+        
+        # Fall back to legacy token
+        user = await get_user_by_token(token)
         return user
+
+async def get_verified_user(authorization: Optional[str]) -> Optional[dict]:
+    """Like get_current_user, but only trusts signature-checked Supabase JWTs and legacy session tokens.
     
-    # Fall back to legacy token
-    user = get_user_by_token(token)
-    return user
+    Use it wherever acting as someone else would pay off: quotas, admin access, shared content.
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    
+    token = authorization.split(" ")[1]
+    
+    with span("auth.get_verified_user"):
+        user = get_user_from_supabase_token(token, verify=True)
+        if user:
+            return user
+        return await get_user_by_token(token)
 
 # ============ AUTH ENDPOINTS ============
 
 @app.post("/auth/register")
 async def auth_register(request: UserRegister):
-    success, message = register_user(request.email, request.password)
+    try:
+        with span("auth.hash_password"):
+            password_hash = await hash_password_async(request.password)
+    except HashingPoolBusy as e:
+        raise service_unavailable(e.retry_after, "Server is busy, please try again shortly")
+    
+    success, message = await register_user(request.email, password_hash)
     if not success:
         raise HTTPException(status_code=400, detail=message)
     return {"message": message}
 
 @app.post("/auth/login")
 async def auth_login(request: UserLogin):
-    success, message, token = login_user(request.email, request.password)
+    success, message, password_hash = await get_login_hash(request.email)
     if not success:
         raise HTTPException(status_code=400, detail=message)
-    return {"message": message, "token": token}
+    
+    try:
+        with span("auth.verify_password"):
+            password_ok = await verify_password_async(request.password, password_hash)
+    except HashingPoolBusy as e:
+        raise service_unavailable(e.retry_after, "Server is busy, please try again shortly")
+    
+    if not password_ok:
+        raise HTTPException(status_code=400, detail="Invalid password")
+    
+    token = await create_session(request.email)
+    return {"message": "Login successful", "token": token}
 
 @app.post("/auth/verify")
 async def auth_verify(request: VerifyEmail):
-    success, message, token = verify_email(request.email, request.code)
+    success, message, token = await verify_email(request.email, request.code)
     if not success:
         raise HTTPException(status_code=400, detail=message)
     return {"message": message, "token": token}
@@ -97,7 +321,7 @@ async def auth_me(authorization: Optional[str] = Header(None)):
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     token = authorization.split(" ")[1]
-    user = get_user_by_token(token)
+    user = await get_user_by_token(token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
     
@@ -112,7 +336,7 @@ async def auth_me(authorization: Optional[str] = Header(None)):
 async def auth_logout(authorization: Optional[str] = Header(None)):
     if authorization and authorization.startswith("Bearer "):
         token = authorization.split(" ")[1]
-        logout_user(token)
+        await logout_user(token)
     return {"message": "Logged out successfully"}
 
 # ============ USER COURSE ENDPOINTS ============
@@ -127,47 +351,86 @@ class SaveCourseRequest(BaseModel):
 
 @app.post("/user/save-course")
 async def save_course(request: SaveCourseRequest, authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    save_user_course(user["email"], request.model_dump())
+    await save_user_course(user["email"], request.model_dump())
     return {"message": "Course saved successfully"}
 
 @app.get("/user/courses")
-async def get_courses(authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+async def get_courses(
+    limit: Optional[int] = Query(None, ge=1, le=COURSES_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    authorization: Optional[str] = Header(None)
+):
+    """List the user's courses, most recent first.
+
+    summary=true (or a comma-separated fields list) skips the chapters; with
+    limit the response is one page plus a next_cursor for the following one.
+    """
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    courses = get_user_courses(user["email"])
-    return {"courses": courses}
+    if summary:
+        selected = list(COURSE_SUMMARY_FIELDS)
+    elif fields:
+        selected = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in selected if field not in COURSE_FIELDS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    else:
+        selected = None
+    
+    try:
+        courses = await get_user_courses(user["email"], selected, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    next_cursor = None
+    if limit is not None and len(courses) == limit:
+        next_cursor = encode_course_cursor(courses[-1]["last_accessed"], courses[-1]["course_id"])
+    if selected is not None:
+        courses = [{field: course[field] for field in selected} for course in courses]
+    return {"courses": courses, "next_cursor": next_cursor}
 
 @app.get("/user/course/{course_id}")
 async def get_course(course_id: str, authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    courses = get_user_courses(user["email"])
-    course = next((c for c in courses if c.get("course_id") == course_id), None)
+    course = await get_user_course(user["email"], course_id)
     
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
     return course
 
+@app.delete("/user/course/{course_id}")
+async def delete_course(course_id: str, authorization: Optional[str] = Header(None)):
+    user = await get_current_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    if not await delete_user_course(user["email"], course_id):
+        raise HTTPException(status_code=404, detail="Course not found")
+    return {"message": "Course deleted successfully"}
+
 @app.get("/user/suggestions")
 async def get_suggestions(authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    courses = get_user_courses(user["email"])
+    courses = await get_user_courses(user["email"])
     topics = [c.get("topic", c.get("title", "")) for c in courses]
     
     try:
-        suggestions = generate_course_suggestions(topics)
+        suggestions = await run_generation(Priority.BACKGROUND, generate_course_suggestions, topics)
         return {"suggestions": suggestions}
     except Exception as e:
         return {"suggestions": [
@@ -180,24 +443,68 @@ async def get_suggestions(authorization: Optional[str] = Header(None)):
 
 class SaveNoteRequest(BaseModel):
     content: str
+    base_version: Optional[int] = None  # Reject the save if the note has moved past this version
+
+def note_conflict(e: NoteVersionConflict) -> HTTPException:
+    """A 409 carrying the note's current version, so the client can refetch and retry."""
+    incr("notes.conflicts")
+    return HTTPException(status_code=409, detail={"message": str(e), "version": e.version})
 
 @app.get("/user/notes/{course_id}/{lesson_id}")
 async def get_note(course_id: str, lesson_id: str, authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    note_content = get_user_note(user["email"], course_id, lesson_id)
-    return {"content": note_content or ""}
+    note = await get_user_note(user["email"], course_id, lesson_id)
+    return note or {"content": "", "version": 0}
 
 @app.post("/user/notes/{course_id}/{lesson_id}")
 async def save_note(course_id: str, lesson_id: str, request: SaveNoteRequest, authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    try:
+        result = await save_user_note(user["email"], course_id, lesson_id, request.content, request.base_version)
+    except NoteVersionConflict as e:
+        raise note_conflict(e)
+    incr("notes.saved" if result["changed"] else "notes.unchanged")
+    return {"message": "Note saved successfully", **result}
+
+@app.patch("/user/notes/{course_id}/{lesson_id}")
+async def patch_note(course_id: str, lesson_id: str, request: NotePatchRequest, authorization: Optional[str] = Header(None)):
+    """Save only the edits made since base_version instead of the whole note."""
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
+    if len(request.ops) > NOTE_PATCH_MAX_OPS:
+        raise HTTPException(status_code=400, detail=f"At most {NOTE_PATCH_MAX_OPS} edits per patch; send the full note instead")
     
-    save_user_note(user["email"], course_id, lesson_id, request.content)
-    return {"message": "Note saved successfully"}
+    try:
+        result = await patch_user_note(user["email"], course_id, lesson_id, request.base_version,
+                                       [op.model_dump() for op in request.ops], request.sha256)
+    except NoteVersionConflict as e:
+        raise note_conflict(e)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    incr("notes.patched" if result["changed"] else "notes.unchanged")
+    return {"message": "Note saved successfully", **result}
+
+@app.get("/user/search", response_model=SearchResponse)
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    kind: Optional[Literal["lesson", "note"]] = None,
+    limit: int = Query(20, ge=1, le=50),
+    authorization: Optional[str] = Header(None)
+):
+    """Full-text search over the lessons in the user's courses and their notes."""
+    user = await get_current_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    rows = await search_user_content(user["email"], q, kind, limit)
+    return SearchResponse(query=q, results=[SearchResult(**row) for row in rows])
 
 # ============ ACTIVITY TRACKING ENDPOINTS ============
 
@@ -210,97 +517,496 @@ class UpdateGoalRequest(BaseModel):
 
 @app.get("/user/stats")
 async def get_stats(authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    stats = get_user_stats(user["email"])
+    stats = await get_user_stats(user["email"])
     return stats
 
+@app.get("/user/stats/history", response_model=ActivityHistoryResponse)
+async def get_stats_history(
+    granularity: Literal["day", "week", "month"] = "week",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    authorization: Optional[str] = Header(None)
+):
+    """Minutes, lessons and active days per day, week or month; the last 52 weeks by default."""
+    user = await get_current_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    end = end or date.today()
+    start = start or end - timedelta(weeks=51)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    first = period_start(start, granularity)
+    if granularity == "day":
+        periods = (end - first).days + 1
+    elif granularity == "week":
+        periods = (end - first).days // 7 + 1
+    else:
+        periods = (end.year - first.year) * 12 + end.month - first.month + 1
+    if periods > HISTORY_MAX_PERIODS[granularity]:
+        raise HTTPException(status_code=400, detail=f"At most {HISTORY_MAX_PERIODS[granularity]} {granularity}s per request")
+    
+    history = await get_activity_history(user["email"], start, end, granularity)
+    return ActivityHistoryResponse(
+        granularity=granularity,
+        start=first.isoformat(),
+        end=end.isoformat(),
+        periods=[ActivityPeriod(**period) for period in history],
+        total_minutes=sum(period["minutes"] for period in history),
+        total_lessons=sum(period["lessons"] for period in history),
+        active_days=sum(period["active_days"] for period in history)
+    )
+
+def mask_email(email: str) -> str:
+    """Show learners on public boards without exposing their addresses."""
+    local, _, domain = email.partition("@")
+    return f"{local[:2]}***@{domain}" if domain else f"{local[:2]}***"
+
+@app.get("/leaderboard", response_model=LeaderboardResponse)
+async def leaderboard(
+    board: Literal["streak", "weekly_minutes"] = "streak",
+    limit: int = Query(10, ge=1, le=100),
+    authorization: Optional[str] = Header(None)
+):
+    """Top learners by current streak or by minutes studied this week, with the caller's own rank."""
+    user = await get_current_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    result = await run_in_threadpool(get_leaderboard, board, limit, user["email"])
+    return LeaderboardResponse(
+        board=board,
+        entries=[
+            LeaderboardEntry(rank=rank, name=mask_email(email), score=score, is_me=email == user["email"])
+            for rank, email, score in result["entries"]
+        ],
+        me=LeaderboardRank(rank=result["me"][0], score=result["me"][1]) if result["me"] else None,
+        total=result["total"]
+    )
+
 @app.post("/user/activity")
 async def log_activity(request: LogActivityRequest, authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    log_user_activity(user["email"], request.minutes, request.lessons)
+    await log_user_activity(user["email"], request.minutes, request.lessons)
     return {"message": "Activity logged successfully"}
 
 @app.post("/user/goal")
 async def set_goal(request: UpdateGoalRequest, authorization: Optional[str] = Header(None)):
-    user = get_current_user(authorization)
+    user = await get_current_user(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
-    update_daily_goal(user["email"], request.goal_minutes)
+    await update_daily_goal(user["email"], request.goal_minutes)
     return {"message": "Goal updated successfully"}
 
+# ============ SYNC ENDPOINT ============
+
+# Payload model per sync operation type; validated before anything is written
+SYNC_DATA_MODELS = {
+    "save_course": SaveCourseRequest,
+    "update_progress": SyncProgressData,
+    "save_note": SyncNoteData,
+    "patch_note": SyncNotePatchData,
+    "log_activity": LogActivityRequest,
+    "set_goal": UpdateGoalRequest,
+}
+
+@app.post("/user/sync", response_model=SyncResponse)
+async def sync_user_data(request: SyncRequest, authorization: Optional[str] = Header(None)):
+    """Apply a queue of client mutations in one transaction, with a result per operation."""
+    user = await get_current_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if len(request.operations) > SYNC_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {SYNC_MAX_OPERATIONS} operations per sync")
+    
+    results = [SyncResult(id=op.id, type=op.type, status="ok") for op in request.operations]
+    valid = []
+    for index, op in enumerate(request.operations):
+        try:
+            data = SYNC_DATA_MODELS[op.type].model_validate(op.data).model_dump()
+        except ValidationError as e:
+            results[index].status = "error"
+            results[index].error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            continue
+        valid.append((index, op.type, data))
+    
+    errors = await apply_user_sync(user["email"], [(op_type, data) for _, op_type, data in valid]) if valid else []
+    for (index, _, _), error in zip(valid, errors):
+        if error:
+            results[index].status = "error"
+            results[index].error = error
+    
+    incr("sync.operations", len(request.operations))
+    incr("sync.failed", sum(1 for result in results if result.status == "error"))
+    return SyncResponse(results=results)
+
 # ============ CONTENT GENERATION ENDPOINTS ============
 
+@app.post("/syllabus/similar", response_model=SimilarSyllabiResponse)
+async def similar_syllabi(request: SyllabusRequest):
+    """Offer previously generated syllabi that closely match this intake."""
+    matches = await find_similar_syllabi(
+        request.topic, request.level, request.daily_minutes,
+        threshold=request.similarity_threshold, limit=3
+    )
+    
+    results = []
+    for syllabus_id, similarity in matches:
+        stored = await get_syllabus(syllabus_id)
+        if stored:
+            results.append(SimilarSyllabus(
+                syllabus_id=syllabus_id,
+                topic=stored["topic"],
+                title=stored["title"],
+                similarity=round(similarity, 3),
+                chapters=stored["chapters"]
+            ))
+    return SimilarSyllabiResponse(matches=results)
+
 @app.post("/generate-syllabus", response_model=SyllabusResponse)
 async def generate_syllabus(request: SyllabusRequest):
     try:
-        syllabus_data = generate_syllabus_content(request)
+        # Reuse the syllabus of an identical intake unless the client asked for a
+        # fresh one; near-duplicates are only offered through /syllabus/similar
+        if SYLLABUS_REUSE and not request.force_new:
+            syllabus_id = await find_matching_syllabus(request.topic, request.level, request.daily_minutes)
+            stored = await get_syllabus(syllabus_id) if syllabus_id else None
+            if stored:
+                print(f"♻️ Reusing syllabus '{stored['title']}' for topic: {request.topic}")
+                incr("syllabus.reused")
+                return SyllabusResponse(
+                    course_id=str(uuid.uuid4()),
+                    title=stored["title"],
+                    chapters=stored["chapters"],
+                    reused_from=stored["id"],
+                    similarity=1.0
+                )
+        
+        syllabus_data = await run_generation(Priority.STANDARD, generate_syllabus_content, request)
+        incr("syllabus.generated")
         
         # Ensure a unique ID if not generated by AI
         if "course_id" not in syllabus_data or not syllabus_data["course_id"]:
             syllabus_data["course_id"] = str(uuid.uuid4())
+        
+        # Remember real (non-demo) syllabi for future reuse
+        if syllabus_data["course_id"] != "demo-mode":
+            syllabus_id = str(uuid.uuid4())
+            await save_syllabus(
+                syllabus_id, request.topic, normalize_topic(request.topic), request.level,
+                request.daily_minutes, syllabus_data["title"], syllabus_data["chapters"]
+            )
+            index_syllabus(syllabus_id, request.topic, request.level, request.daily_minutes)
             
         return syllabus_data
+    except (GenerationQueueFull, CircuitOpenError) as e:
+        raise service_unavailable(e.retry_after, str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def load_or_generate_quiz(request: QuizRequest) -> Tuple[dict, bool]:
+    """The quiz for a lesson and whether it came from the cache."""
+    # Check cache first if course_id is provided
+    if request.course_id:
+        cached = await get_cached_quizzes(request.course_id, [request.lesson_title], request.topic, request.level)
+        if request.lesson_title in cached:
+            print(f"✅ Returning cached quiz: {request.lesson_title}")
+            return {"lesson_title": request.lesson_title, "questions": cached[request.lesson_title]}, True
+    
+    quiz_data = await run_generation(Priority.STANDARD, generate_quiz_content, request)
+    
+    if request.course_id:
+        await save_cached_quizzes(request.course_id, request.topic, request.level, [quiz_data])
+        print(f"💾 Cached new quiz: {request.lesson_title}")
+    
+    return quiz_data, False
+
 @app.post("/generate-quiz", response_model=QuizResponse)
 async def generate_quiz(request: QuizRequest):
     try:
-        quiz_data = generate_quiz_content(request)
+        quiz_data, _ = await load_or_generate_quiz(request)
         return quiz_data
+    except (GenerationQueueFull, CircuitOpenError) as e:
+        raise service_unavailable(e.retry_after, str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate-chapter-quizzes", response_model=ChapterQuizResponse)
+async def generate_chapter_quizzes(request: ChapterQuizRequest):
+    """Generate (or load from cache) the quizzes for every lesson in a chapter."""
+    try:
+        lesson_titles = request.chapter.lessons
+        cached = await get_cached_quizzes(request.course_id, lesson_titles, request.topic, request.level) if request.course_id else {}
+        missing = [title for title in lesson_titles if title not in cached]
+        
+        generated = await run_generation(Priority.STANDARD, generate_chapter_quiz_content, request, missing) if missing else []
+        if request.course_id and generated:
+            await save_cached_quizzes(request.course_id, request.topic, request.level, generated)
+            print(f"💾 Cached {len(generated)} quizzes for chapter: {request.chapter.title}")
+        
+        questions_by_title = dict(cached)
+        questions_by_title.update({quiz["lesson_title"]: quiz["questions"] for quiz in generated})
+        
+        return ChapterQuizResponse(
+            chapter_id=request.chapter.id,
+            quizzes=[
+                QuizResponse(lesson_title=title, questions=questions_by_title[title])
+                for title in lesson_titles
+            ]
+        )
+    except (GenerationQueueFull, CircuitOpenError) as e:
+        raise service_unavailable(e.retry_after, str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def load_or_generate_diagram(request: DiagramRequest) -> Tuple[dict, bool]:
+    """The diagram for a lesson and whether it came from the cache."""
+    if not request.refresh:
+        cached = await get_cached_diagram(request.topic, request.level, request.lesson_title)
+        if cached:
+            print(f"✅ Returning cached diagram: {request.lesson_title}")
+            return cached, True
+    
+    diagram_data = await run_generation(Priority.STANDARD, generate_diagram_content, request)
+    
+    # Same rule as lesson diagrams: one that failed validation isn't cached.
+    # Neither is the demo placeholder served without GEMINI_API_KEY, which
+    # would otherwise be shared with every later request for this lesson.
+    if os.getenv("GEMINI_API_KEY") and diagram_data.get("mermaid_valid", True):
+        await save_cached_diagram(request.topic, request.level, request.lesson_title,
+                                  diagram_data.get("mermaid_code", ""), diagram_data.get("explanation", ""))
+        print(f"💾 Cached new diagram: {request.lesson_title}")
+    
+    return diagram_data, False
+
 @app.post("/generate-diagram", response_model=DiagramResponse)
 async def generate_diagram(request: DiagramRequest):
     try:
-        diagram_data = generate_diagram_content(request)
+        diagram_data, _ = await load_or_generate_diagram(request)
         return diagram_data
+    except (GenerationQueueFull, CircuitOpenError) as e:
+        raise service_unavailable(e.retry_after, str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def load_or_generate_lesson(request: LessonContentRequest) -> Tuple[dict, bool]:
+    """The lesson content and whether it came from the cache."""
+    # Check cache first if course_id is provided. Shared bodies from other
+    # courses are only adopted (and returned) when a course-specific copy isn't requested.
+    if request.course_id:
+        if request.course_specific:
+            cached = await get_cached_lesson(request.course_id, request.lesson_title)
+            if cached and cached["shared"]:
+                cached = None
+        else:
+            cached = await get_cached_lesson(request.course_id, request.lesson_title, request.topic, request.level)
+        if cached:
+            print(f"✅ Returning cached lesson: {request.lesson_title}")
+            return {
+                "lesson_title": cached["lesson_title"],
+                "content_markdown": cached["content_markdown"],
+                "mermaid_code": cached.get("mermaid_code", ""),
+                "image_prompt": "",
+                "summary": ""
+            }, True
+    
+    # Generate new lesson
+    lesson_data = await run_generation(Priority.LESSON, generate_lesson_content, request)
+    
+    # Cache the lesson if course_id is provided. A diagram that failed
+    # validation is not cached, so a later regeneration can replace it.
+    if request.course_id:
+        mermaid_valid = lesson_data.get("mermaid_valid", True)
+        await save_cached_lesson(
+            course_id=request.course_id,
+            lesson_title=request.lesson_title,
+            topic=request.topic,
+            level=request.level,
+            content_markdown=lesson_data.get("content_markdown", ""),
+            mermaid_code=lesson_data.get("mermaid_code", "") if mermaid_valid else "",
+            explanation=lesson_data.get("summary", ""),
+            shared=not request.course_specific
+        )
+        print(f"💾 Cached new lesson: {request.lesson_title}")
+    
+    return lesson_data, False
+
 @app.post("/generate-lesson", response_model=LessonContentResponse)
 async def generate_lesson(request: LessonContentRequest):
     try:
-        # Check cache first if course_id is provided
-        if request.course_id:
-            cached = get_cached_lesson(request.course_id, request.lesson_title)
-            if cached:
-                print(f"✅ Returning cached lesson: {request.lesson_title}")
-                return LessonContentResponse(
-                    lesson_title=cached["lesson_title"],
-                    content_markdown=cached["content_markdown"],
-                    mermaid_code=cached.get("mermaid_code", ""),
-                    image_prompt="",
-                    summary=""
-                )
-        
-        # Generate new lesson
-        lesson_data = generate_lesson_content(request)
-        
-        # Cache the lesson if course_id is provided
-        if request.course_id:
-            save_cached_lesson(
-                course_id=request.course_id,
-                lesson_title=request.lesson_title,
-                topic=request.topic,
-                level=request.level,
-                content_markdown=lesson_data.get("content_markdown", ""),
-                mermaid_code=lesson_data.get("mermaid_code", ""),
-                explanation=lesson_data.get("summary", "")
-            )
-            print(f"💾 Cached new lesson: {request.lesson_title}")
-        
+        lesson_data, _ = await load_or_generate_lesson(request)
         return lesson_data
+    except (GenerationQueueFull, CircuitOpenError) as e:
+        raise service_unavailable(e.retry_after, str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+BUNDLE_PART_MODELS = {"lesson": LessonContentResponse, "quiz": QuizResponse, "diagram": DiagramResponse}
+
+async def run_bundle_part(name: str, part) -> Tuple[str, Optional[dict], bool, Optional[Exception]]:
+    """(name, data, cached, error) of one part of a lesson bundle."""
+    try:
+        data, cached = await part
+        return name, data, cached, None
+    except Exception as e:
+        return name, None, False, e
+
+@app.post("/generate-lesson-bundle", response_model=LessonBundleResponse)
+async def generate_lesson_bundle(request: LessonBundleRequest):
+    """The lesson, its quiz and its diagram in one call.
+    
+    Each part is served from its cache or generated, and the missing ones are
+    generated concurrently, so an uncached bundle takes about as long as its
+    slowest part. With `stream`, parts are sent as NDJSON lines as they finish.
+    Each part generated beyond the first costs another generation-quota token.
+    """
+    parts = {"lesson": load_or_generate_lesson(LessonContentRequest(
+        lesson_title=request.lesson_title, topic=request.topic, level=request.level,
+        course_id=request.course_id, course_specific=request.course_specific
+    ))}
+    if request.include_quiz:
+        parts["quiz"] = load_or_generate_quiz(QuizRequest(
+            lesson_title=request.lesson_title, topic=request.topic, level=request.level, course_id=request.course_id
+        ))
+    if request.include_diagram:
+        parts["diagram"] = load_or_generate_diagram(DiagramRequest(
+            lesson_title=request.lesson_title, topic=request.topic, level=request.level,
+            refresh=request.refresh_diagram
+        ))
+    # Tasks rather than bare coroutines: a part keeps running (and gets cached)
+    # even if a streaming client disconnects before it arrives
+    tasks = [asyncio.create_task(run_bundle_part(name, part)) for name, part in parts.items()]
+    incr("bundle.requests")
+    
+    if request.stream:
+        async def stream_parts():
+            for finished in asyncio.as_completed(tasks):
+                name, data, cached, error = await finished
+                if error is None:
+                    data = BUNDLE_PART_MODELS[name].model_validate(data).model_dump()
+                    line = {"part": name, "data": data, "cached": cached}
+                elif isinstance(error, (GenerationQueueFull, CircuitOpenError, GenerationQuotaExceeded)):
+                    line = {"part": name, "error": str(error), "retry_after": error.retry_after}
+                else:
+                    line = {"part": name, "error": str(error)}
+                yield json.dumps(line) + "\n"
+            yield json.dumps({"part": "done"}) + "\n"
+        
+        return StreamingResponse(stream_parts(), media_type="application/x-ndjson")
+    
+    bundle = {"cached": [], "errors": {}}
+    failures = []
+    for name, data, cached, error in await asyncio.gather(*tasks):
+        if error is not None:
+            failures.append(error)
+            bundle["errors"][name] = str(error)
+            continue
+        bundle[name] = data
+        if cached:
+            bundle["cached"].append(name)
+    
+    if len(failures) == len(tasks):
+        exhausted = [e for e in failures if isinstance(e, GenerationQuotaExceeded)]
+        if exhausted:
+            raise HTTPException(status_code=429, detail=str(exhausted[0]), headers=exhausted[0].decision.headers())
+        unavailable = [e for e in failures if isinstance(e, (GenerationQueueFull, CircuitOpenError))]
+        if unavailable:
+            raise service_unavailable(max(e.retry_after for e in unavailable), str(unavailable[0]))
+        raise HTTPException(status_code=500, detail=str(failures[0]))
+    return LessonBundleResponse(**bundle)
+
+@app.post("/regenerate-lesson-part", response_model=LessonRegenerateResponse)
+async def regenerate_lesson_part(request: LessonRegenerateRequest, authorization: Optional[str] = Header(None)):
+    """Regenerate one section, the mindmap or the summary of a cached lesson and patch just that part."""
+    # Verified identities only, since this writes learner feedback into stored content
+    user = await get_verified_user(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if not await get_user_course(user["email"], request.course_id):
+        raise HTTPException(status_code=404, detail="Course not found")
+    if request.shared and user["email"].lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Only admins can patch a shared lesson")
+    
+    lesson = await get_cached_lesson(request.course_id, request.lesson_title)
+    if not lesson:
+        raise HTTPException(status_code=404, detail="Lesson not cached; generate it with /generate-lesson")
+    
+    sections = split_lesson_sections(lesson["content_markdown"])
+    expected = None
+    if request.part == "section":
+        if request.section_index is None or not 0 <= request.section_index < len(sections):
+            raise HTTPException(status_code=404, detail="Section not found")
+        expected = sections[request.section_index].content_markdown
+    
+    try:
+        data = await run_generation(Priority.LESSON, regenerate_lesson_part_content, request, lesson, sections)
+    except (GenerationQueueFull, CircuitOpenError) as e:
+        raise service_unavailable(e.retry_after, str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if request.part == "mindmap" and not data.get("mermaid_valid", True):
+        # Keep the stored mindmap rather than replacing it with one that won't render
+        raise HTTPException(status_code=500, detail="Could not generate a valid mindmap")
+    
+    value = {"section": data.get("content_markdown"), "mindmap": data.get("mermaid_code"), "summary": data.get("summary")}[request.part]
+    try:
+        patched = await patch_cached_lesson(request.course_id, request.lesson_title, request.part, value,
+                                            request.section_index, expected, private=not request.shared)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not patched:
+        raise HTTPException(status_code=404, detail="Lesson not cached")
+    incr(f"lesson.regenerated.{request.part}")
+    print(f"♻️ Regenerated {request.part} of lesson: {request.lesson_title}")
+    
+    response = LessonRegenerateResponse(lesson_title=request.lesson_title, part=request.part,
+                                        restructured=patched["restructured"])
+    if request.part == "section":
+        section = await get_lesson_section(request.course_id, request.lesson_title, request.section_index)
+        response.section = LessonSection(index=section.pop("position"), **section) if section else None
+    elif request.part == "mindmap":
+        response.mermaid_code = patched["mermaid_code"]
+    else:
+        response.summary = patched["explanation"]
+    return response
+
+@app.get("/lesson/{course_id}/outline", response_model=LessonOutlineResponse)
+async def lesson_outline(
+    course_id: str,
+    lesson_title: str = Query(..., min_length=1),
+    topic: Optional[str] = None,
+    level: Optional[str] = None
+):
+    """Table of contents and first section of a cached lesson; fetch the rest with /sections/{index}."""
+    outline = await get_lesson_outline(course_id, lesson_title, topic, level)
+    if not outline:
+        raise HTTPException(status_code=404, detail="Lesson not cached; generate it with /generate-lesson")
+    
+    first = outline["first_section"]
+    return LessonOutlineResponse(
+        lesson_title=outline["lesson_title"],
+        mermaid_code=outline["mermaid_code"] or "",
+        summary=outline["explanation"] or "",
+        sections=[LessonSectionInfo(index=section.pop("position"), **section) for section in outline["sections"]],
+        first_section=LessonSection(index=first.pop("position"), **first) if first else None
+    )
+
+@app.get("/lesson/{course_id}/sections/{index}", response_model=LessonSection)
+async def lesson_section(course_id: str, index: int, lesson_title: str = Query(..., min_length=1)):
+    section = await get_lesson_section(course_id, lesson_title, index)
+    if not section:
+        raise HTTPException(status_code=404, detail="Section not found")
+    return LessonSection(index=section.pop("position"), **section)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,21 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+class ProfileFrame(BaseModel):
+    frame: str  # "function (file:line)"
+    samples: int
+
+class ProfileCapture(BaseModel):
+    id: str
+    captured_at: str
+    method: str
+    path: str
+    status: Optional[int] = None
+    duration_ms: float
+    samples: int
+    interval_ms: float
+    concurrent: int  # Other profiled requests running during the capture
+    top_frames: List[ProfileFrame]
+
+class ProfileListResponse(BaseModel):
+    captures: List[ProfileCapture]
@@ -4,6 +4,7 @@ class DiagramRequest(BaseModel):
     lesson_title: str
     topic: str
     level: str
+    refresh: bool = False  # Generate a new diagram even if one is cached, and replace it
 
 class DiagramResponse(BaseModel):
     lesson_title: str
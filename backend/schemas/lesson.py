@@ -1,11 +1,14 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
+from schemas.quiz import QuizResponse
+from schemas.diagram import DiagramResponse
 
 class LessonContentRequest(BaseModel):
     lesson_title: str
     topic: str
     level: str
     course_id: Optional[str] = None  # For caching lessons
+    course_specific: bool = False  # Generate a private copy instead of sharing one across courses
 
 class LessonContentResponse(BaseModel):
     lesson_title: str
@@ -13,3 +16,56 @@ class LessonContentResponse(BaseModel):
     mermaid_code: str
     image_prompt: str
     summary: str
+
+class LessonSectionInfo(BaseModel):
+    index: int
+    heading: str  # Empty for text before the first heading
+    level: int  # Heading level (1 for "#"), 0 when untitled
+    anchor: str
+    length: int  # Characters of markdown, for placeholders and progress
+
+class LessonSection(LessonSectionInfo):
+    content_markdown: str
+
+class LessonOutlineResponse(BaseModel):
+    lesson_title: str
+    mermaid_code: str
+    summary: str
+    sections: List[LessonSectionInfo]
+    first_section: Optional[LessonSection] = None
+
+class LessonBundleRequest(BaseModel):
+    lesson_title: str
+    topic: str
+    level: str
+    course_id: Optional[str] = None  # For caching, as in /generate-lesson and /generate-quiz
+    course_specific: bool = False
+    include_quiz: bool = True
+    include_diagram: bool = False
+    refresh_diagram: bool = False  # As `refresh` in /generate-diagram
+    stream: bool = False  # Send each part as NDJSON as soon as it is ready
+
+class LessonBundleResponse(BaseModel):
+    lesson: Optional[LessonContentResponse] = None
+    quiz: Optional[QuizResponse] = None
+    diagram: Optional[DiagramResponse] = None
+    cached: List[str] = []  # Parts served from cache
+    errors: Dict[str, str] = {}  # Parts that failed, with the reason
+
+class LessonRegenerateRequest(BaseModel):
+    course_id: str
+    lesson_title: str
+    topic: str
+    level: str
+    part: Literal["section", "mindmap", "summary"]
+    section_index: Optional[int] = None  # Required for part="section"
+    feedback: Optional[str] = None  # What the learner didn't like, passed to the model
+    shared: bool = False  # Admins only: patch the body shared across courses instead of a private copy
+
+class LessonRegenerateResponse(BaseModel):
+    lesson_title: str
+    part: str
+    section: Optional[LessonSection] = None
+    mermaid_code: Optional[str] = None
+    summary: Optional[str] = None
+    restructured: bool = False  # The lesson's sections changed; refetch the outline
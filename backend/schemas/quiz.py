@@ -1,10 +1,12 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+from schemas.syllabus import Chapter
 
 class QuizRequest(BaseModel):
     lesson_title: str
     topic: str
     level: str
+    course_id: Optional[str] = None  # For caching quizzes
 
 class Question(BaseModel):
     question: str
@@ -15,3 +17,13 @@ class Question(BaseModel):
 class QuizResponse(BaseModel):
     lesson_title: str
     questions: List[Question]
+
+class ChapterQuizRequest(BaseModel):
+    topic: str
+    level: str
+    chapter: Chapter
+    course_id: Optional[str] = None  # For caching quizzes
+
+class ChapterQuizResponse(BaseModel):
+    chapter_id: str
+    quizzes: List[QuizResponse]
@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+class SearchResult(BaseModel):
+    kind: str  # "lesson" or "note"
+    course_id: Optional[str] = None
+    lesson_title: str  # For notes, the lesson_id the note belongs to
+    snippet: str  # Matching excerpt with hits wrapped in <mark></mark>
+    score: float
+
+class SearchResponse(BaseModel):
+    query: str
+    results: List[SearchResult]
@@ -1,10 +1,13 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field
+from typing import List, Optional
 
 class SyllabusRequest(BaseModel):
     topic: str
     level: str
     daily_minutes: int
+    force_new: bool = False  # Skip near-duplicate reuse and always generate
+    # Overrides SYLLABUS_SIMILARITY_THRESHOLD in /syllabus/similar; low values would match unrelated topics
+    similarity_threshold: Optional[float] = Field(None, ge=0.5, le=1.0)
 
 class Lesson(BaseModel):
     title: str
@@ -18,3 +21,15 @@ class SyllabusResponse(BaseModel):
     course_id: str
     title: str
     chapters: List[Chapter]
+    reused_from: Optional[str] = None  # Id of the stored syllabus this one was copied from
+    similarity: Optional[float] = None
+
+class SimilarSyllabus(BaseModel):
+    syllabus_id: str
+    topic: str
+    title: str
+    similarity: float
+    chapters: List[Chapter]
+
+class SimilarSyllabiResponse(BaseModel):
+    matches: List[SimilarSyllabus]
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from typing import List, Optional, Literal
 from datetime import datetime
 
 class UserRegister(BaseModel):
@@ -32,3 +32,83 @@ class UserDashboard(BaseModel):
     user: UserResponse
     courses: List[CourseProgress]
     suggestions: List[dict]
+
+# ============ ACTIVITY HISTORY ============
+
+class ActivityPeriod(BaseModel):
+    period_start: str  # YYYY-MM-DD: the day, the week's Monday or the 1st of the month
+    minutes: int
+    lessons: int
+    active_days: int
+
+class ActivityHistoryResponse(BaseModel):
+    granularity: Literal["day", "week", "month"]
+    start: str
+    end: str
+    periods: List[ActivityPeriod]
+    total_minutes: int
+    total_lessons: int
+    active_days: int
+
+# ============ LEADERBOARD ============
+
+class LeaderboardEntry(BaseModel):
+    rank: int  # Tied scores share a rank
+    name: str  # Masked email
+    score: int
+    is_me: bool = False
+
+class LeaderboardRank(BaseModel):
+    rank: int
+    score: int
+
+class LeaderboardResponse(BaseModel):
+    board: Literal["streak", "weekly_minutes"]
+    entries: List[LeaderboardEntry]
+    me: Optional[LeaderboardRank] = None  # None when the user isn't on the board
+    total: int  # Users on the board
+
+# ============ SYNC ============
+
+SyncOperationType = Literal["save_course", "update_progress", "save_note", "patch_note", "log_activity", "set_goal"]
+
+class SyncOperation(BaseModel):
+    id: Optional[str] = None  # Client-side id, echoed back in the result
+    type: SyncOperationType
+    data: dict
+
+class SyncRequest(BaseModel):
+    operations: List[SyncOperation]
+
+class SyncResult(BaseModel):
+    id: Optional[str] = None
+    type: str
+    status: Literal["ok", "error"]
+    error: Optional[str] = None
+
+class SyncResponse(BaseModel):
+    results: List[SyncResult]
+
+class SyncProgressData(BaseModel):
+    course_id: str
+    progress_percent: int
+
+class SyncNoteData(BaseModel):
+    course_id: str
+    lesson_id: str
+    content: str
+    base_version: Optional[int] = None  # Reject the save if the note has moved past this version
+
+class NotePatchOp(BaseModel):
+    pos: int  # In code points of the base version
+    delete: int = 0
+    insert: str = ""
+
+class NotePatchRequest(BaseModel):
+    base_version: int
+    ops: List[NotePatchOp]
+    sha256: Optional[str] = None  # Of the expected result, to catch a client whose copy has drifted
+
+class SyncNotePatchData(NotePatchRequest):
+    course_id: str
+    lesson_id: str
@@ -0,0 +1,103 @@
+import os
+import time
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from services import auth_service, syllabus_index
+from services.metrics_service import set_gauge, observe
+
+# Async facade over the blocking data layer for request handlers. It exposes
+# the same functions as auth_service, as coroutines: each call runs on a
+# dedicated pool of DB_ASYNC_WORKERS threads (which borrow connections from
+# the pool in auth_service.get_db), so a slow query only occupies one of those
+# threads instead of blocking the event loop, and database work can't starve
+# the threadpool used for Gemini calls.
+#
+# This is not a native async driver (asyncpg/aiosqlite); the queries are still
+# psycopg2/sqlite3, shared with the SQLite writer thread and the scripts. The
+# limits that follow from that: at most DB_ASYNC_WORKERS calls run at once per
+# worker process and the rest wait for a thread (db.queue_wait_ms in /metrics),
+# each running call holds a thread and a connection until it returns, and a
+# call can't be cancelled once it has started. Size DB_ASYNC_WORKERS to the
+# connections the database can give each worker (DB_POOL_MAX on Postgres).
+
+DB_ASYNC_WORKERS = int(os.getenv("DB_ASYNC_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_ASYNC_WORKERS, thread_name_prefix="db")
+_in_flight = 0
+
+def _async(fn):
+    """Wrap a blocking auth_service function as a coroutine run on the DB pool."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        global _in_flight
+        queued = time.perf_counter()
+        # Carry the current trace into the worker thread
+        context = contextvars.copy_context()
+
+        def run():
+            observe("db.queue_wait_ms", (time.perf_counter() - queued) * 1000)
+            return context.run(fn, *args, **kwargs)
+
+        _in_flight += 1
+        set_gauge("db.in_flight", _in_flight)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(_executor, run)
+        finally:
+            _in_flight -= 1
+            set_gauge("db.in_flight", _in_flight)
+            observe(f"db.call_ms.{name}", (time.perf_counter() - queued) * 1000)
+    return wrapper
+
+# ============ SYLLABUS INDEX ============
+
+# Refreshing the in-memory index reads new syllabi from the database
+find_similar_syllabi = _async(syllabus_index.find_similar_syllabi)
+find_matching_syllabus = _async(syllabus_index.find_matching_syllabus)
+
+# ============ AUTH ============
+
+register_user = _async(auth_service.register_user)
+verify_email = _async(auth_service.verify_email)
+get_login_hash = _async(auth_service.get_login_hash)
+create_session = _async(auth_service.create_session)
+get_user_by_token = _async(auth_service.get_user_by_token)
+logout_user = _async(auth_service.logout_user)
+
+# ============ COURSES ============
+
+save_user_course = _async(auth_service.save_user_course)
+get_user_courses = _async(auth_service.get_user_courses)
+get_user_course = _async(auth_service.get_user_course)
+update_course_progress = _async(auth_service.update_course_progress)
+delete_user_course = _async(auth_service.delete_user_course)
+
+# ============ SYLLABI, LESSONS, QUIZZES ============
+
+save_syllabus = _async(auth_service.save_syllabus)
+get_syllabus = _async(auth_service.get_syllabus)
+get_cached_lesson = _async(auth_service.get_cached_lesson)
+get_lesson_outline = _async(auth_service.get_lesson_outline)
+get_lesson_section = _async(auth_service.get_lesson_section)
+save_cached_lesson = _async(auth_service.save_cached_lesson)
+patch_cached_lesson = _async(auth_service.patch_cached_lesson)
+purge_unreferenced_lesson_bodies = _async(auth_service.purge_unreferenced_lesson_bodies)
+get_cached_quizzes = _async(auth_service.get_cached_quizzes)
+save_cached_quizzes = _async(auth_service.save_cached_quizzes)
+get_cached_diagram = _async(auth_service.get_cached_diagram)
+save_cached_diagram = _async(auth_service.save_cached_diagram)
+
+# ============ NOTES, ACTIVITY, SYNC, SEARCH ============
+
+get_user_note = _async(auth_service.get_user_note)
+save_user_note = _async(auth_service.save_user_note)
+patch_user_note = _async(auth_service.patch_user_note)
+log_user_activity = _async(auth_service.log_user_activity)
+get_user_stats = _async(auth_service.get_user_stats)
+get_activity_history = _async(auth_service.get_activity_history)
+update_daily_goal = _async(auth_service.update_daily_goal)
+apply_user_sync = _async(auth_service.apply_user_sync)
+search_user_content = _async(auth_service.search_user_content)
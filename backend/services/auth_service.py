@@ -1,23 +1,39 @@
 import os
+import base64
+import functools
 import secrets
 import bcrypt
 import psycopg2
 import jwt
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from contextlib import contextmanager
 from urllib.parse import urlparse
+from services.tracing_service import span, traced
+from services.metrics_service import incr
+from services.sqlite_store import SQLITE_CONCURRENT, SQLITE_WRITE_BATCH, SQLiteWriter, reader_connection
 
 # Supabase JWT secret - use the JWT secret from your Supabase project
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 
-def get_user_from_supabase_token(token: str) -> Optional[dict]:
-    """Decode Supabase JWT token and extract user info."""
+@traced
+def get_user_from_supabase_token(token: str, verify: bool = False) -> Optional[dict]:
+    """Decode Supabase JWT token and extract user info.
+    
+    With `verify`, only tokens signed with SUPABASE_JWT_SECRET are accepted
+    (none are when it isn't set); use it wherever a forged email would matter.
+    """
     try:
-        # First try to decode without verification (for development/testing)
-        # In production, you should verify with SUPABASE_JWT_SECRET
-        decoded = jwt.decode(token, options={"verify_signature": False})
+        if verify:
+            if not SUPABASE_JWT_SECRET:
+                return None
+            decoded = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], options={"verify_aud": False})
+        else:
+            # First try to decode without verification (for development/testing)
+            # In production, you should verify with SUPABASE_JWT_SECRET
+            decoded = jwt.decode(token, options={"verify_signature": False})
         
         email = decoded.get("email")
         if not email:
@@ -42,32 +58,378 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 # Fallback to SQLite for local development if no DATABASE_URL
 USE_POSTGRES = DATABASE_URL is not None and DATABASE_URL.startswith("postgresql")
 
+# Postgres connections are pooled; when all DB_POOL_MAX are busy (e.g. nested
+# get_db calls), an extra short-lived connection is opened instead of waiting
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "16"))
+
 if not USE_POSTGRES:
     import sqlite3
-    DATABASE_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'infinitetutor.db')
+    DATABASE_PATH = os.getenv("SQLITE_PATH", os.path.join(os.path.dirname(__file__), '..', 'data', 'infinitetutor.db'))
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
 
+_pg_pool = None
+_sqlite_writer = SQLiteWriter(DATABASE_PATH, SQLITE_WRITE_BATCH) if SQLITE_CONCURRENT and not USE_POSTGRES else None
+
+def _get_pg_pool():
+    global _pg_pool
+    if _pg_pool is None:
+        _pg_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, cursor_factory=RealDictCursor)
+    return _pg_pool
+
 @contextmanager
 def get_db():
     """Get database connection."""
     if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        pool = _get_pg_pool()
+        with span("db.connect"):
+            try:
+                conn = pool.getconn()
+                pooled = True
+            except PoolError:
+                incr("db.pool_overflow")
+                conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+                pooled = False
         try:
             yield conn
         finally:
-            conn.close()
+            if not pooled:
+                conn.close()
+            elif conn.closed:
+                pool.putconn(conn, close=True)
+            else:
+                # Don't hand the next user an open (possibly failed) transaction
+                try:
+                    conn.rollback()
+                    pool.putconn(conn)
+                except psycopg2.Error:
+                    pool.putconn(conn, close=True)
+    elif SQLITE_CONCURRENT:
+        # Inside a queued write use the writer's connection, otherwise this thread's reader
+        yield _sqlite_writer.current_connection() or reader_connection(DATABASE_PATH)
     else:
-        conn = sqlite3.connect(DATABASE_PATH)
+        with span("db.connect"):
+            conn = sqlite3.connect(DATABASE_PATH)
         conn.row_factory = sqlite3.Row
         try:
             yield conn
         finally:
             conn.close()
 
+def writes(fn):
+    """Mark a function that writes; in concurrent SQLite mode it runs on the single writer thread."""
+    if _sqlite_writer is None:
+        return fn
+    
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return _sqlite_writer.submit(fn, *args, **kwargs)
+    return wrapper
+
 def get_placeholder():
     """Return the correct placeholder for the database type."""
     return "%s" if USE_POSTGRES else "?"
 
+def _table_exists(cursor, table: str) -> bool:
+    if USE_POSTGRES:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL AS present', (table,))
+        return cursor.fetchone()['present']
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return cursor.fetchone() is not None
+
+def add_column_if_missing(cursor, table: str, column: str, definition: str):
+    """Add a column to an existing table (for databases created by older versions)."""
+    if USE_POSTGRES:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+    else:
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row['name'] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# ============ SEARCH INDEX ============
+
+# Lessons and notes are indexed as search documents, keyed so that saving the
+# same thing again replaces its entry: a shared lesson body once per
+# content_key, a course-specific lesson per (course, title), a note per
+# (user, course, lesson). Only bodies a user can reach are ever returned.
+
+def _note_doc_key(user_email: str, course_id: str, lesson_id: str) -> str:
+    return f"note:{user_email}\x1f{course_id}\x1f{lesson_id}"
+
+def _course_lesson_doc_key(course_id: str, lesson_title: str) -> str:
+    return f"course:{course_id}\x1f{lesson_title}"
+
+def _plain_text(markdown: str) -> str:
+    """Markdown reduced to the words worth indexing and showing in snippets."""
+    import re
+    text = re.sub(r'```[a-zA-Z]*', ' ', markdown or '')
+    text = re.sub(r'!?\[([^\]]*)\]\([^)]*\)', r'\1', text)
+    text = re.sub(r'[#*_`>|~]+', ' ', text)
+    return " ".join(text.split())
+
+def _index_search_doc(cursor, doc_key: str, kind: str, lesson_title: str, body: str, owner: Optional[str] = None,
+                      course_id: Optional[str] = None, content_key: Optional[str] = None) -> None:
+    """Add or replace one search document inside the caller's transaction."""
+    now = datetime.now().isoformat()
+    body = _plain_text(body)
+    
+    if USE_POSTGRES:
+        cursor.execute('''
+            INSERT INTO search_docs (doc_key, kind, owner, course_id, content_key, lesson_title, body, document, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s,
+                    setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'B'), %s)
+            ON CONFLICT (doc_key) DO UPDATE SET
+                lesson_title = EXCLUDED.lesson_title,
+                body = EXCLUDED.body,
+                document = EXCLUDED.document,
+                updated_at = EXCLUDED.updated_at
+        ''', (doc_key, kind, owner, course_id, content_key, lesson_title, body, lesson_title, body, now))
+        return
+    
+    cursor.execute('SELECT id FROM search_docs WHERE doc_key = ?', (doc_key,))
+    row = cursor.fetchone()
+    if row:
+        doc_id = row['id']
+        cursor.execute('UPDATE search_docs SET lesson_title = ?, updated_at = ? WHERE id = ?', (lesson_title, now, doc_id))
+        cursor.execute('DELETE FROM search_fts WHERE rowid = ?', (doc_id,))
+    else:
+        cursor.execute('''
+            INSERT INTO search_docs (doc_key, kind, owner, course_id, content_key, lesson_title, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (doc_key, kind, owner, course_id, content_key, lesson_title, now))
+        doc_id = cursor.lastrowid
+    cursor.execute('INSERT INTO search_fts (rowid, lesson_title, body) VALUES (?, ?, ?)', (doc_id, lesson_title, body))
+
+def _remove_search_docs(cursor, condition: str, params: tuple) -> None:
+    """Remove the search documents matching a WHERE condition on search_docs."""
+    if not USE_POSTGRES:
+        cursor.execute(f'SELECT id FROM search_docs WHERE {condition}', params)
+        for row in cursor.fetchall():
+            cursor.execute('DELETE FROM search_fts WHERE rowid = ?', (row['id'],))
+    cursor.execute(f'DELETE FROM search_docs WHERE {condition}', params)
+
+def _rebuild_search_index(cursor) -> int:
+    """Re-index every lesson body, course-specific lesson and note. Returns the document count."""
+    _remove_search_docs(cursor, '1 = 1', ())
+    reader = cursor.connection.cursor()
+    count = 0
+    
+    reader.execute('SELECT content_key, lesson_title, content_markdown FROM lesson_bodies')
+    for rows in iter(lambda: reader.fetchmany(500), []):
+        for body in rows:
+            _index_search_doc(cursor, f"body:{body['content_key']}", 'lesson', body['lesson_title'],
+                              body['content_markdown'], content_key=body['content_key'])
+            count += 1
+    
+    reader.execute("SELECT course_id, lesson_title, content_markdown FROM lessons WHERE content_key IS NULL AND content_markdown <> ''")
+    for rows in iter(lambda: reader.fetchmany(500), []):
+        for lesson in rows:
+            _index_search_doc(cursor, _course_lesson_doc_key(lesson['course_id'], lesson['lesson_title']), 'lesson',
+                              lesson['lesson_title'], lesson['content_markdown'], course_id=lesson['course_id'])
+            count += 1
+    
+    reader.execute("SELECT user_email, course_id, lesson_id, content FROM user_notes WHERE content IS NOT NULL AND content <> ''")
+    for rows in iter(lambda: reader.fetchmany(500), []):
+        for note in rows:
+            _index_search_doc(cursor, _note_doc_key(note['user_email'], note['course_id'], note['lesson_id']), 'note',
+                              note['lesson_id'], note['content'], owner=note['user_email'], course_id=note['course_id'])
+            count += 1
+    return count
+
+# ============ LESSON SECTIONS ============
+
+# Every cached lesson is also stored split at its headings (see
+# services/lesson_sections.py): shared bodies by content_key, course-specific
+# lessons by (course_id, lesson_title). Readers can then fetch the table of
+# contents and one section at a time instead of the whole body.
+
+def _store_lesson_sections(cursor, content_markdown: str, content_key: Optional[str] = None,
+                           course_id: Optional[str] = None, lesson_title: Optional[str] = None) -> None:
+    """Replace the stored sections of one lesson body inside the caller's transaction."""
+    from services.lesson_sections import split_lesson_sections
+    _remove_lesson_sections(cursor, content_key=content_key, course_id=course_id, lesson_title=lesson_title)
+    ph = get_placeholder()
+    cursor.executemany(f'''
+        INSERT INTO lesson_sections (content_key, course_id, lesson_title, position, heading, level, anchor, content_markdown)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+    ''', [(content_key, course_id, lesson_title, position, section.heading, section.level, section.anchor, section.content_markdown)
+          for position, section in enumerate(split_lesson_sections(content_markdown))])
+
+def _remove_lesson_sections(cursor, content_key: Optional[str] = None, course_id: Optional[str] = None,
+                            lesson_title: Optional[str] = None) -> None:
+    """Drop the sections of a shared body, of one course-specific lesson, or of a whole course."""
+    ph = get_placeholder()
+    if content_key:
+        cursor.execute(f'DELETE FROM lesson_sections WHERE content_key = {ph}', (content_key,))
+    elif lesson_title is not None:
+        cursor.execute(f'''
+            DELETE FROM lesson_sections WHERE content_key IS NULL AND course_id = {ph} AND lesson_title = {ph}
+        ''', (course_id, lesson_title))
+    else:
+        cursor.execute(f'DELETE FROM lesson_sections WHERE content_key IS NULL AND course_id = {ph}', (course_id,))
+
+def _rebuild_lesson_sections(cursor) -> int:
+    """Re-split every cached lesson. Returns the number of lessons."""
+    cursor.execute('DELETE FROM lesson_sections')
+    reader = cursor.connection.cursor()
+    count = 0
+    
+    reader.execute('SELECT content_key, content_markdown FROM lesson_bodies')
+    for rows in iter(lambda: reader.fetchmany(500), []):
+        for body in rows:
+            _store_lesson_sections(cursor, body['content_markdown'], content_key=body['content_key'])
+            count += 1
+    
+    reader.execute("SELECT course_id, lesson_title, content_markdown FROM lessons WHERE content_key IS NULL AND content_markdown <> ''")
+    for rows in iter(lambda: reader.fetchmany(500), []):
+        for lesson in rows:
+            _store_lesson_sections(cursor, lesson['content_markdown'], course_id=lesson['course_id'],
+                                   lesson_title=lesson['lesson_title'])
+            count += 1
+    return count
+
+# ============ ACTIVITY ROLLUPS ============
+
+# user_activity holds a row per user per day; activity_rollups keeps running
+# weekly (from Monday) and monthly totals of it, updated with every logged
+# activity, so history charts read one row per period instead of per day.
+
+ROLLUP_PERIODS = ("week", "month")
+
+def period_start(day, period: str):
+    """First day of the week (Monday) or month containing a date."""
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+def _add_to_rollups(cursor, user_email: str, day, minutes: int, lessons: int, active_days: int) -> None:
+    """Add one day's change in activity to its week and month totals."""
+    ph = get_placeholder()
+    cursor.executemany(f'''
+        INSERT INTO activity_rollups (user_email, period, period_start, minutes_studied, lessons_completed, active_days)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ON CONFLICT (user_email, period, period_start) DO UPDATE SET
+            minutes_studied = activity_rollups.minutes_studied + EXCLUDED.minutes_studied,
+            lessons_completed = activity_rollups.lessons_completed + EXCLUDED.lessons_completed,
+            active_days = activity_rollups.active_days + EXCLUDED.active_days
+    ''', [(user_email, period, period_start(day, period).isoformat(), minutes, lessons, active_days)
+          for period in ROLLUP_PERIODS])
+
+def _rebuild_activity_rollups(cursor) -> int:
+    """Recompute every rollup from user_activity, one user at a time. Returns the number of users."""
+    ph = get_placeholder()
+    cursor.execute('DELETE FROM activity_rollups')
+    reader = cursor.connection.cursor()
+    reader.execute('''
+        SELECT user_email, activity_date, minutes_studied, lessons_completed FROM user_activity
+        ORDER BY user_email, activity_date
+    ''')
+    
+    users = 0
+    current_user, totals = None, {}
+    
+    def flush():
+        cursor.executemany(f'''
+            INSERT INTO activity_rollups (user_email, period, period_start, minutes_studied, lessons_completed, active_days)
+            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ''', [(current_user, period, start, *values) for (period, start), values in totals.items()])
+    
+    for rows in iter(lambda: reader.fetchmany(1000), []):
+        for row in rows:
+            if row['user_email'] != current_user:
+                if current_user is not None:
+                    flush()
+                current_user, totals = row['user_email'], {}
+                users += 1
+            day = datetime.strptime(row['activity_date'], '%Y-%m-%d').date()
+            minutes, lessons = row['minutes_studied'] or 0, row['lessons_completed'] or 0
+            for period in ROLLUP_PERIODS:
+                values = totals.setdefault((period, period_start(day, period).isoformat()), [0, 0, 0])
+                values[0] += minutes
+                values[1] += lessons
+                values[2] += 1 if minutes > 0 else 0
+    if current_user is not None:
+        flush()
+    return users
+
+# ============ LEADERBOARD SCORES ============
+
+# leaderboard_scores holds what the rankings in services/leaderboard.py are
+# built from: the length of each user's latest run of consecutive active days
+# (ending on last_active_date) and their minutes in the week starting
+# week_start. Both are updated in place with every logged activity; whether a
+# streak is still current is decided when it is read.
+
+def _update_leaderboard_scores(cursor, user_email: str, day, minutes: int, active_days: int) -> None:
+    """Apply one logged activity (and whether it made the day active) to the user's scores."""
+    ph = get_placeholder()
+    cursor.execute(f'''
+        SELECT streak, last_active_date, week_start, week_minutes FROM leaderboard_scores WHERE user_email = {ph}
+    ''', (user_email,))
+    row = cursor.fetchone()
+    
+    streak = row['streak'] if row else 0
+    last_active = row['last_active_date'] if row else None
+    week = period_start(day, "week").isoformat()
+    week_minutes = (row['week_minutes'] if row and row['week_start'] == week else 0) + minutes
+    if active_days > 0 and last_active != day.isoformat():
+        streak = streak + 1 if last_active == (day - timedelta(days=1)).isoformat() else 1
+        last_active = day.isoformat()
+    
+    cursor.execute(f'''
+        INSERT INTO leaderboard_scores (user_email, streak, last_active_date, week_start, week_minutes, updated_at)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ON CONFLICT (user_email) DO UPDATE SET
+            streak = EXCLUDED.streak,
+            last_active_date = EXCLUDED.last_active_date,
+            week_start = EXCLUDED.week_start,
+            week_minutes = EXCLUDED.week_minutes,
+            updated_at = EXCLUDED.updated_at
+    ''', (user_email, streak, last_active, week, week_minutes, datetime.now().isoformat()))
+
+def _rebuild_leaderboard(cursor) -> int:
+    """Recompute every user's scores in one ordered pass over user_activity. Returns the number of users."""
+    ph = get_placeholder()
+    cursor.execute('DELETE FROM leaderboard_scores')
+    reader = cursor.connection.cursor()
+    reader.execute('''
+        SELECT user_email, activity_date, minutes_studied FROM user_activity ORDER BY user_email, activity_date
+    ''')
+    
+    now = datetime.now()
+    week = period_start(now.date(), "week").isoformat()
+    scores = []
+    current_user, streak, last_active, week_minutes = None, 0, None, 0
+    for rows in iter(lambda: reader.fetchmany(1000), []):
+        for row in rows:
+            if row['user_email'] != current_user:
+                if current_user is not None:
+                    scores.append((current_user, streak, last_active, week, week_minutes, now.isoformat()))
+                current_user, streak, last_active, week_minutes = row['user_email'], 0, None, 0
+            minutes = row['minutes_studied'] or 0
+            if row['activity_date'] >= week:
+                week_minutes += minutes
+            if minutes > 0:
+                day = datetime.strptime(row['activity_date'], '%Y-%m-%d').date()
+                streak = streak + 1 if last_active == (day - timedelta(days=1)).isoformat() else 1
+                last_active = day.isoformat()
+            if len(scores) >= 1000:
+                cursor.executemany(f'''
+                    INSERT INTO leaderboard_scores (user_email, streak, last_active_date, week_start, week_minutes, updated_at)
+                    VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+                ''', scores)
+                scores = []
+    if current_user is not None:
+        scores.append((current_user, streak, last_active, week, week_minutes, now.isoformat()))
+    cursor.executemany(f'''
+        INSERT INTO leaderboard_scores (user_email, streak, last_active_date, week_start, week_minutes, updated_at)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+    ''', scores)
+    cursor.execute('SELECT COUNT(*) AS users FROM leaderboard_scores')
+    return cursor.fetchone()['users']
+
 def init_db():
     """Initialize database tables."""
     ph = get_placeholder()
@@ -117,6 +479,21 @@ def init_db():
                     UNIQUE(user_email, course_id)
                 )
             ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_courses_recent ON user_courses (user_email, last_accessed, course_id)')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS syllabi (
+                    id TEXT PRIMARY KEY,
+                    topic TEXT NOT NULL,
+                    normalized_topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    daily_minutes INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    chapters_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_syllabi_created_at ON syllabi (created_at)')
             
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS lessons (
@@ -129,10 +506,65 @@ def init_db():
                     mermaid_code TEXT,
                     explanation TEXT,
                     created_at TEXT NOT NULL,
+                    content_key TEXT,
+                    UNIQUE(course_id, lesson_title)
+                )
+            ''')
+            
+            # Lesson bodies shared by every course that references them (see lesson_content_key)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lesson_bodies (
+                    content_key TEXT PRIMARY KEY,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    content_markdown TEXT NOT NULL,
+                    mermaid_code TEXT,
+                    explanation TEXT,
+                    ref_count INTEGER DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    released_at TEXT
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS quizzes (
+                    id SERIAL PRIMARY KEY,
+                    course_id TEXT NOT NULL,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    questions_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
                     UNIQUE(course_id, lesson_title)
                 )
             ''')
             
+            # Quizzes shared across courses, keyed like lesson_bodies
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS quiz_bodies (
+                    content_key TEXT PRIMARY KEY,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    questions_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Standalone lesson diagrams (/generate-diagram), keyed like lesson_bodies
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS diagram_bodies (
+                    content_key TEXT PRIMARY KEY,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    mermaid_code TEXT NOT NULL,
+                    explanation TEXT,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_notes (
                     id SERIAL PRIMARY KEY,
@@ -141,6 +573,7 @@ def init_db():
                     lesson_id TEXT NOT NULL,
                     content TEXT,
                     updated_at TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
                     UNIQUE(user_email, course_id, lesson_id)
                 )
             ''')
@@ -156,6 +589,94 @@ def init_db():
                     UNIQUE(user_email, activity_date)
                 )
             ''')
+            
+            # Weekly and monthly totals of user_activity (see the activity rollup functions)
+            activity_rollups_exist = _table_exists(cursor, 'activity_rollups')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS activity_rollups (
+                    id SERIAL PRIMARY KEY,
+                    user_email TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    period_start TEXT NOT NULL,
+                    minutes_studied INTEGER DEFAULT 0,
+                    lessons_completed INTEGER DEFAULT 0,
+                    active_days INTEGER DEFAULT 0,
+                    UNIQUE(user_email, period, period_start)
+                )
+            ''')
+            
+            # Each user's streak and minutes this week (see the leaderboard functions)
+            leaderboard_exists = _table_exists(cursor, 'leaderboard_scores')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leaderboard_scores (
+                    user_email TEXT PRIMARY KEY,
+                    streak INTEGER DEFAULT 0,
+                    last_active_date TEXT,
+                    week_start TEXT,
+                    week_minutes INTEGER DEFAULT 0,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Generation quota balances shared by the workers (services/generation_quota.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS generation_quotas (
+                    bucket_key TEXT PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    updated_at DOUBLE PRECISION NOT NULL
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS email_outbox (
+                    id SERIAL PRIMARY KEY,
+                    recipient TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    html_content TEXT NOT NULL,
+                    text_content TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    next_attempt_at TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    sent_at TEXT
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)')
+            
+            # Full-text index over lessons and notes (see the search functions)
+            search_index_exists = _table_exists(cursor, 'search_docs')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS search_docs (
+                    id SERIAL PRIMARY KEY,
+                    doc_key TEXT UNIQUE NOT NULL,
+                    kind TEXT NOT NULL,
+                    owner TEXT,
+                    course_id TEXT,
+                    content_key TEXT,
+                    lesson_title TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    document TSVECTOR NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_docs_document ON search_docs USING GIN (document)')
+            
+            # Cached lessons split at their headings (see the lesson section functions)
+            lesson_sections_exist = _table_exists(cursor, 'lesson_sections')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lesson_sections (
+                    id SERIAL PRIMARY KEY,
+                    content_key TEXT,
+                    course_id TEXT,
+                    lesson_title TEXT,
+                    position INTEGER NOT NULL,
+                    heading TEXT NOT NULL,
+                    level INTEGER NOT NULL,
+                    anchor TEXT NOT NULL,
+                    content_markdown TEXT NOT NULL
+                )
+            ''')
         else:
             # SQLite syntax
             cursor.execute('''
@@ -198,6 +719,21 @@ def init_db():
                     UNIQUE(user_email, course_id)
                 )
             ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_courses_recent ON user_courses (user_email, last_accessed, course_id)')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS syllabi (
+                    id TEXT PRIMARY KEY,
+                    topic TEXT NOT NULL,
+                    normalized_topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    daily_minutes INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    chapters_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_syllabi_created_at ON syllabi (created_at)')
             
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS lessons (
@@ -210,10 +746,65 @@ def init_db():
                     mermaid_code TEXT,
                     explanation TEXT,
                     created_at TEXT NOT NULL,
+                    content_key TEXT,
+                    UNIQUE(course_id, lesson_title)
+                )
+            ''')
+            
+            # Lesson bodies shared by every course that references them (see lesson_content_key)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lesson_bodies (
+                    content_key TEXT PRIMARY KEY,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    content_markdown TEXT NOT NULL,
+                    mermaid_code TEXT,
+                    explanation TEXT,
+                    ref_count INTEGER DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    released_at TEXT
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS quizzes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    course_id TEXT NOT NULL,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    questions_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
                     UNIQUE(course_id, lesson_title)
                 )
             ''')
             
+            # Quizzes shared across courses, keyed like lesson_bodies
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS quiz_bodies (
+                    content_key TEXT PRIMARY KEY,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    questions_json TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Standalone lesson diagrams (/generate-diagram), keyed like lesson_bodies
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS diagram_bodies (
+                    content_key TEXT PRIMARY KEY,
+                    lesson_title TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    level TEXT NOT NULL,
+                    mermaid_code TEXT NOT NULL,
+                    explanation TEXT,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_notes (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -222,6 +813,7 @@ def init_db():
                     lesson_id TEXT NOT NULL,
                     content TEXT,
                     updated_at TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
                     UNIQUE(user_email, course_id, lesson_id)
                 )
             ''')
@@ -237,6 +829,133 @@ def init_db():
                     UNIQUE(user_email, activity_date)
                 )
             ''')
+            
+            # Weekly and monthly totals of user_activity (see the activity rollup functions)
+            activity_rollups_exist = _table_exists(cursor, 'activity_rollups')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS activity_rollups (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_email TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    period_start TEXT NOT NULL,
+                    minutes_studied INTEGER DEFAULT 0,
+                    lessons_completed INTEGER DEFAULT 0,
+                    active_days INTEGER DEFAULT 0,
+                    UNIQUE(user_email, period, period_start)
+                )
+            ''')
+            
+            # Each user's streak and minutes this week (see the leaderboard functions)
+            leaderboard_exists = _table_exists(cursor, 'leaderboard_scores')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leaderboard_scores (
+                    user_email TEXT PRIMARY KEY,
+                    streak INTEGER DEFAULT 0,
+                    last_active_date TEXT,
+                    week_start TEXT,
+                    week_minutes INTEGER DEFAULT 0,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            
+            # Generation quota balances shared by the workers (services/generation_quota.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS generation_quotas (
+                    bucket_key TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS email_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    recipient TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    html_content TEXT NOT NULL,
+                    text_content TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    next_attempt_at TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    sent_at TEXT
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)')
+            
+            # Full-text index over lessons and notes: search_fts rows share their rowid with search_docs
+            search_index_exists = _table_exists(cursor, 'search_docs')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS search_docs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    doc_key TEXT UNIQUE NOT NULL,
+                    kind TEXT NOT NULL,
+                    owner TEXT,
+                    course_id TEXT,
+                    content_key TEXT,
+                    lesson_title TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+                    lesson_title, body, tokenize = 'porter unicode61 remove_diacritics 2'
+                )
+            ''')
+            
+            # Cached lessons split at their headings (see the lesson section functions)
+            lesson_sections_exist = _table_exists(cursor, 'lesson_sections')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS lesson_sections (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    content_key TEXT,
+                    course_id TEXT,
+                    lesson_title TEXT,
+                    position INTEGER NOT NULL,
+                    heading TEXT NOT NULL,
+                    level INTEGER NOT NULL,
+                    anchor TEXT NOT NULL,
+                    content_markdown TEXT NOT NULL
+                )
+            ''')
+        
+        # Columns added after the tables were first created
+        cursor.execute('SELECT * FROM lesson_bodies LIMIT 0')
+        released_at_exists = 'released_at' in [column[0] for column in cursor.description]
+        add_column_if_missing(cursor, 'lessons', 'content_key', 'TEXT')
+        add_column_if_missing(cursor, 'user_notes', 'version', 'INTEGER NOT NULL DEFAULT 0')
+        add_column_if_missing(cursor, 'lesson_bodies', 'released_at', 'TEXT')
+        if not released_at_exists:
+            # Unreferenced bodies from before released_at get the full grace period from now
+            cursor.execute(f'''
+                UPDATE lesson_bodies SET released_at = {get_placeholder()} WHERE ref_count <= 0
+            ''', (datetime.now().isoformat(),))
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_lessons_content_key ON lessons (content_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_docs_content_key ON search_docs (content_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_docs_course ON search_docs (course_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_lesson_sections_body ON lesson_sections (content_key, position)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_lesson_sections_course ON lesson_sections (course_id, lesson_title, position)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_leaderboard_scores_updated ON leaderboard_scores (updated_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_generation_quotas_updated ON generation_quotas (updated_at)')
+        
+        # Databases from before the derived tables: build them from what they already hold
+        if not search_index_exists:
+            count = _rebuild_search_index(cursor)
+            if count:
+                print(f"🔎 Indexed {count} existing lessons and notes for search")
+        if not lesson_sections_exist:
+            count = _rebuild_lesson_sections(cursor)
+            if count:
+                print(f"📑 Split {count} existing lessons into sections")
+        if not activity_rollups_exist:
+            count = _rebuild_activity_rollups(cursor)
+            if count:
+                print(f"📊 Rolled up activity for {count} existing users")
+        if not leaderboard_exists:
+            count = _rebuild_leaderboard(cursor)
+            if count:
+                print(f"🏆 Scored {count} existing users for the leaderboard")
         
         conn.commit()
 
@@ -262,31 +981,10 @@ def verify_password(password: str, password_hash: str) -> bool:
     """Verify a password against its hash."""
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
 
-def send_verification_email(email: str, code: str) -> bool:
-    """Send verification email using Brevo (Sendinblue)."""
-    brevo_api_key = os.getenv("BREVO_API_KEY")
-    
-    if not brevo_api_key:
-        print(f"\n{'='*50}")
-        print(f"📧 VERIFICATION CODE FOR {email}")
-        print(f"   Code: {code}")
-        print(f"{'='*50}\n")
-        return True
-    
-    try:
-        import sib_api_v3_sdk
-        from sib_api_v3_sdk.rest import ApiException
-        
-        # Configure Brevo API
-        configuration = sib_api_v3_sdk.Configuration()
-        configuration.api_key['api-key'] = brevo_api_key
-        
-        api_instance = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
-        
-        sender = {"name": "InfiniteTutor", "email": "noreply@infinitetutor.app"}
-        to = [{"email": email}]
-        subject = "Your InfiniteTutor verification code"
-        html_content = f"""
+def build_verification_email(code: str) -> tuple[str, str, str]:
+    """Build the subject, HTML and plain-text bodies of a verification email."""
+    subject = "Your InfiniteTutor verification code"
+    html_content = f"""
         <div style="font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; max-width: 480px; margin: 0 auto; padding: 40px 20px;">
             <div style="text-align: center; margin-bottom: 40px;">
                 <h1 style="color: #2AB7CA; font-size: 28px; margin: 0;">InfiniteTutor</h1>
@@ -302,29 +1000,18 @@ def send_verification_email(email: str, code: str) -> bool:
                 If you didn't request this code, you can safely ignore this email.
             </p>
         </div>
-        """
-        
-        send_smtp_email = sib_api_v3_sdk.SendSmtpEmail(
-            to=to,
-            sender=sender,
-            subject=subject,
-            html_content=html_content
-        )
-        
-        api_instance.send_transac_email(send_smtp_email)
-        print(f"✅ Verification email sent to {email}")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Failed to send email: {e}")
-        print(f"\n{'='*50}")
-        print(f"📧 VERIFICATION CODE FOR {email}")
-        print(f"   Code: {code}")
-        print(f"{'='*50}\n")
-        return True
+    """
+    text_content = f"Your InfiniteTutor verification code is: {code}\nThis code expires in 10 minutes."
+    return subject, html_content, text_content
 
-def register_user(email: str, password: str) -> tuple[bool, str]:
-    """Register a new user (step 1: send verification code)."""
+@traced
+@writes
+def register_user(email: str, password_hash: str) -> tuple[bool, str]:
+    """Register a new user (step 1: send verification code).
+
+    The password is hashed by the caller (see services/hashing_service.py)
+    so bcrypt never runs on the event loop.
+    """
     ph = get_placeholder()
     
     with get_db() as conn:
@@ -338,7 +1025,7 @@ def register_user(email: str, password: str) -> tuple[bool, str]:
             return False, "Email already registered. Please log in."
     
     # Store password hash temporarily
-    pending_registrations[email] = hash_password(password)
+    pending_registrations[email] = password_hash
     
     # Generate and store verification code
     code = generate_verification_code()
@@ -357,12 +1044,16 @@ def register_user(email: str, password: str) -> tuple[bool, str]:
                 INSERT OR REPLACE INTO verification_codes (email, code, expires_at)
                 VALUES (?, ?, ?)
             ''', (email, code, expires_at))
+        
+        # The email itself is delivered by the outbox worker (services/email_service.py)
+        subject, html_content, text_content = build_verification_email(code)
+        queue_email(cursor, email, subject, html_content, text_content)
         conn.commit()
     
-    if send_verification_email(email, code):
-        return True, "Verification code sent to your email"
-    return False, "Failed to send verification email"
+    return True, "Verification code sent to your email"
 
+@traced
+@writes
 def verify_email(email: str, code: str) -> tuple[bool, str, Optional[str]]:
     """Verify email with code and complete registration."""
     ph = get_placeholder()
@@ -420,8 +1111,9 @@ def verify_email(email: str, code: str) -> tuple[bool, str, Optional[str]]:
         
         return True, "Email verified successfully", token
 
-def login_user(email: str, password: str) -> tuple[bool, str, Optional[str]]:
-    """Log in an existing user with email and password."""
+@traced
+def get_login_hash(email: str) -> tuple[bool, str, Optional[str]]:
+    """Look up the stored password hash for a login attempt."""
     ph = get_placeholder()
     
     with get_db() as conn:
@@ -436,18 +1128,41 @@ def login_user(email: str, password: str) -> tuple[bool, str, Optional[str]]:
         if not user['is_verified']:
             return False, "Please verify your email first", None
         
-        if not verify_password(password, user['password_hash']):
-            return False, "Invalid password", None
-        
-        # Create session
-        token = generate_session_token()
+        return True, "", user['password_hash']
+
+@traced
+@writes
+def create_session(email: str) -> str:
+    """Create a new session for a user and return its token."""
+    ph = get_placeholder()
+    token = generate_session_token()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
         cursor.execute(f'''
             INSERT INTO sessions (token, email, created_at) VALUES ({ph}, {ph}, {ph})
         ''', (token, email, datetime.now().isoformat()))
         conn.commit()
-        
-        return True, "Login successful", token
+    
+    return token
+
+@traced
+def login_user(email: str, password: str) -> tuple[bool, str, Optional[str]]:
+    """Log in an existing user with email and password.
+
+    Runs bcrypt inline; request handlers should use get_login_hash and
+    hashing_service.verify_password_async instead.
+    """
+    success, message, password_hash = get_login_hash(email)
+    if not success:
+        return False, message, None
+    
+    if not verify_password(password, password_hash):
+        return False, "Invalid password", None
+    
+    return True, "Login successful", create_session(email)
 
+@traced
 def get_user_by_token(token: str) -> Optional[dict]:
     """Get user data from session token."""
     ph = get_placeholder()
@@ -468,6 +1183,8 @@ def get_user_by_token(token: str) -> Optional[dict]:
             return dict(user)
         return None
 
+@traced
+@writes
 def logout_user(token: str) -> bool:
     """Remove session token."""
     ph = get_placeholder()
@@ -478,99 +1195,295 @@ def logout_user(token: str) -> bool:
         conn.commit()
         return cursor.rowcount > 0
 
+@traced
+@writes
 def save_user_course(email: str, course_data: dict) -> bool:
     """Save or update a course for a user."""
-    import json
-    
     with get_db() as conn:
         cursor = conn.cursor()
-        
-        if USE_POSTGRES:
-            cursor.execute('''
-                INSERT INTO user_courses 
-                (user_email, course_id, title, topic, level, progress_percent, chapters_json, last_accessed)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (user_email, course_id) DO UPDATE SET
-                    title = EXCLUDED.title,
-                    topic = EXCLUDED.topic,
-                    level = EXCLUDED.level,
-                    progress_percent = EXCLUDED.progress_percent,
-                    chapters_json = EXCLUDED.chapters_json,
-                    last_accessed = EXCLUDED.last_accessed
-            ''', (
-                email,
-                course_data.get('course_id'),
-                course_data.get('title'),
-                course_data.get('topic', ''),
-                course_data.get('level', 'Beginner'),
-                course_data.get('progress_percent', 0),
-                json.dumps(course_data.get('chapters', [])),
-                datetime.now().isoformat()
-            ))
-        else:
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_courses 
-                (user_email, course_id, title, topic, level, progress_percent, chapters_json, last_accessed)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                email,
-                course_data.get('course_id'),
-                course_data.get('title'),
-                course_data.get('topic', ''),
-                course_data.get('level', 'Beginner'),
-                course_data.get('progress_percent', 0),
-                json.dumps(course_data.get('chapters', [])),
-                datetime.now().isoformat()
-            ))
+        _save_user_course(cursor, email, course_data)
         conn.commit()
         return True
 
-def get_user_courses(email: str) -> list:
-    """Get all courses for a user."""
+def _save_user_course(cursor, email: str, course_data: dict) -> None:
+    import json
+    
+    if USE_POSTGRES:
+        cursor.execute('''
+            INSERT INTO user_courses 
+            (user_email, course_id, title, topic, level, progress_percent, chapters_json, last_accessed)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_email, course_id) DO UPDATE SET
+                title = EXCLUDED.title,
+                topic = EXCLUDED.topic,
+                level = EXCLUDED.level,
+                progress_percent = EXCLUDED.progress_percent,
+                chapters_json = EXCLUDED.chapters_json,
+                last_accessed = EXCLUDED.last_accessed
+        ''', (
+            email,
+            course_data.get('course_id'),
+            course_data.get('title'),
+            course_data.get('topic', ''),
+            course_data.get('level', 'Beginner'),
+            course_data.get('progress_percent', 0),
+            json.dumps(course_data.get('chapters', [])),
+            datetime.now().isoformat()
+        ))
+    else:
+        cursor.execute('''
+            INSERT OR REPLACE INTO user_courses 
+            (user_email, course_id, title, topic, level, progress_percent, chapters_json, last_accessed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            email,
+            course_data.get('course_id'),
+            course_data.get('title'),
+            course_data.get('topic', ''),
+            course_data.get('level', 'Beginner'),
+            course_data.get('progress_percent', 0),
+            json.dumps(course_data.get('chapters', [])),
+            datetime.now().isoformat()
+        ))
+
+# Columns a course listing can be projected to; "chapters" is decoded from chapters_json
+COURSE_FIELDS = ("course_id", "title", "topic", "level", "progress_percent", "last_accessed", "chapters")
+COURSE_SUMMARY_FIELDS = ("course_id", "title", "topic", "level", "progress_percent", "last_accessed")
+
+def encode_course_cursor(last_accessed: str, course_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{last_accessed}|{course_id}".encode('utf-8')).decode('ascii')
+
+def decode_course_cursor(cursor: str) -> Tuple[str, str]:
+    """Raises ValueError for a cursor we did not issue."""
+    try:
+        last_accessed, course_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split("|", 1)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    return last_accessed, course_id
+
+@traced
+def get_user_courses(email: str, fields: Optional[list] = None, limit: Optional[int] = None,
+                     after: Optional[str] = None) -> list:
+    """Get a user's courses, most recently accessed first.
+
+    fields limits the returned keys (chapters_json is only read when "chapters"
+    is requested). With limit, returns one page; pass the cursor of the page's
+    last course (see encode_course_cursor) as after to get the next one.
+    """
     import json
     ph = get_placeholder()
+    fields = [field for field in COURSE_FIELDS if fields is None or field in fields]
+    # The sort key is always selected so the caller can build the next cursor
+    columns = [field for field in fields if field != "chapters"]
+    columns += [column for column in ("last_accessed", "course_id") if column not in columns]
+    if "chapters" in fields:
+        columns.append("chapters_json")
+    
+    query = f'SELECT {", ".join(columns)} FROM user_courses WHERE user_email = {ph}'
+    params = [email]
+    if after:
+        last_accessed, course_id = decode_course_cursor(after)
+        query += f' AND (last_accessed < {ph} OR (last_accessed = {ph} AND course_id < {ph}))'
+        params += [last_accessed, last_accessed, course_id]
+    query += ' ORDER BY last_accessed DESC, course_id DESC'
+    if limit is not None:
+        query += f' LIMIT {ph}'
+        params.append(limit)
     
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute(f'''
-            SELECT course_id, title, topic, level, progress_percent, chapters_json, last_accessed 
-            FROM user_courses WHERE user_email = {ph} 
-            ORDER BY last_accessed DESC
-        ''', (email,))
+        cursor.execute(query, tuple(params))
         
         courses = []
         for row in cursor.fetchall():
             course = dict(row)
-            course['chapters'] = json.loads(course.get('chapters_json', '[]'))
-            del course['chapters_json']
+            if "chapters" in fields:
+                course['chapters'] = json.loads(course.pop('chapters_json') or '[]')
             courses.append(course)
         
         return courses
 
+@traced
+def get_user_course(email: str, course_id: str) -> Optional[dict]:
+    """Get one of a user's courses with its chapters."""
+    import json
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT course_id, title, topic, level, progress_percent, chapters_json, last_accessed 
+            FROM user_courses WHERE user_email = {ph} AND course_id = {ph}
+        ''', (email, course_id))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        course = dict(row)
+        course['chapters'] = json.loads(course.pop('chapters_json') or '[]')
+        return course
+
+@traced
+@writes
 def update_course_progress(email: str, course_id: str, progress_percent: int) -> bool:
     """Update the progress of a specific course."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        updated = _update_course_progress(cursor, email, course_id, progress_percent)
+        conn.commit()
+        return updated
+
+def _update_course_progress(cursor, email: str, course_id: str, progress_percent: int) -> bool:
+    ph = get_placeholder()
+    
+    cursor.execute(f'''
+        UPDATE user_courses 
+        SET progress_percent = {ph}, last_accessed = {ph}
+        WHERE user_email = {ph} AND course_id = {ph}
+    ''', (progress_percent, datetime.now().isoformat(), email, course_id))
+    return cursor.rowcount > 0
+
+# ============ SYLLABUS FUNCTIONS ============
+
+@traced
+@writes
+def save_syllabus(syllabus_id: str, topic: str, normalized_topic: str, level: str, daily_minutes: int,
+                  title: str, chapters: list) -> str:
+    """Store a generated syllabus so later near-duplicate requests can reuse it. Returns its created_at."""
+    import json
     ph = get_placeholder()
+    created_at = datetime.now().isoformat()
     
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute(f'''
-            UPDATE user_courses 
-            SET progress_percent = {ph}, last_accessed = {ph}
-            WHERE user_email = {ph} AND course_id = {ph}
-        ''', (progress_percent, datetime.now().isoformat(), email, course_id))
+            INSERT INTO syllabi (id, topic, normalized_topic, level, daily_minutes, title, chapters_json, created_at)
+            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ''', (syllabus_id, topic, normalized_topic, level, daily_minutes, title, json.dumps(chapters), created_at))
         conn.commit()
-        return cursor.rowcount > 0
+        return created_at
 
-def get_cached_lesson(course_id: str, lesson_title: str) -> Optional[dict]:
-    """Get a cached lesson if it exists."""
+@traced
+def get_syllabus(syllabus_id: str) -> Optional[dict]:
+    """Get a stored syllabus by id."""
+    import json
     ph = get_placeholder()
     
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute(f'''
-            SELECT lesson_title, content_markdown, mermaid_code, explanation
-            FROM lessons 
+            SELECT id, topic, level, daily_minutes, title, chapters_json FROM syllabi WHERE id = {ph}
+        ''', (syllabus_id,))
+        
+        row = cursor.fetchone()
+        if not row:
+            return None
+        syllabus = dict(row)
+        syllabus['chapters'] = json.loads(syllabus.pop('chapters_json'))
+        return syllabus
+
+@traced
+def get_syllabus_index_rows(since: Optional[str] = None) -> list:
+    """Get the fields needed to build the topic similarity index, optionally only rows newer than `since`."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if since:
+            cursor.execute(f'''
+                SELECT id, topic, level, daily_minutes, created_at FROM syllabi
+                WHERE created_at > {ph} ORDER BY created_at
+            ''', (since,))
+        else:
+            cursor.execute('''
+                SELECT id, topic, level, daily_minutes, created_at FROM syllabi ORDER BY created_at
+            ''')
+        return [dict(row) for row in cursor.fetchall()]
+
+def lesson_content_key(topic: str, level: str, lesson_title: str) -> str:
+    """Content address of a lesson: a hash of its normalized (topic, level, lesson_title)."""
+    import hashlib
+    normalized = "\x1f".join(" ".join(part.casefold().split()) for part in (topic, level, lesson_title))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def _link_course_lesson(cursor, course_id: str, lesson_title: str, topic: str, level: str,
+                        content_key: Optional[str]) -> None:
+    """Point a course's lesson row at a shared body, keeping reference counts in step.
+
+    With content_key=None the row is left for the caller to fill with course-specific content.
+    """
+    ph = get_placeholder()
+    
+    cursor.execute(f'''
+        SELECT content_key FROM lessons WHERE course_id = {ph} AND lesson_title = {ph}
+    ''', (course_id, lesson_title))
+    row = cursor.fetchone()
+    previous_key = row['content_key'] if row else None
+    
+    if row and previous_key == content_key:
+        return
+    
+    if row:
+        cursor.execute(f'''
+            UPDATE lessons SET content_key = {ph}, content_markdown = '', mermaid_code = NULL, explanation = NULL
             WHERE course_id = {ph} AND lesson_title = {ph}
+        ''', (content_key, course_id, lesson_title))
+    else:
+        cursor.execute(f'''
+            INSERT INTO lessons (course_id, lesson_title, topic, level, content_markdown, created_at, content_key)
+            VALUES ({ph}, {ph}, {ph}, {ph}, '', {ph}, {ph})
+        ''', (course_id, lesson_title, topic, level, datetime.now().isoformat(), content_key))
+    
+    if content_key:
+        cursor.execute(f'''
+            UPDATE lesson_bodies SET ref_count = ref_count + 1, released_at = NULL WHERE content_key = {ph}
+        ''', (content_key,))
+    if previous_key:
+        _release_lesson_body(cursor, previous_key)
+
+def _release_lesson_body(cursor, content_key: str) -> None:
+    """Drop a reference to a shared body, noting when its last reference went (for the purge)."""
+    ph = get_placeholder()
+    cursor.execute(f'''
+        UPDATE lesson_bodies SET ref_count = ref_count - 1,
+            released_at = CASE WHEN ref_count <= 1 THEN {ph} ELSE released_at END
+        WHERE content_key = {ph}
+    ''', (datetime.now().isoformat(), content_key))
+
+@traced
+@writes
+def adopt_shared_lesson(course_id: str, lesson_title: str, topic: str, level: str, content_key: str) -> None:
+    """Link a course with no copy of a lesson to a shared body (a no-op if it has gained one since)."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT 1 FROM lessons WHERE course_id = {ph} AND lesson_title = {ph}', (course_id, lesson_title))
+        if cursor.fetchone():
+            return
+        _link_course_lesson(cursor, course_id, lesson_title, topic, level, content_key)
+        conn.commit()
+
+@traced
+def get_cached_lesson(course_id: str, lesson_title: str, topic: Optional[str] = None,
+                      level: Optional[str] = None) -> Optional[dict]:
+    """Get a cached lesson if it exists.
+
+    When topic and level are given and the course has no copy yet, a shared body
+    generated for another course is adopted by reference. Only that adoption
+    is a write; the lookups run on a reader connection.
+    """
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT l.lesson_title, l.content_key,
+                   COALESCE(b.content_markdown, l.content_markdown) AS content_markdown,
+                   COALESCE(b.mermaid_code, l.mermaid_code) AS mermaid_code,
+                   COALESCE(b.explanation, l.explanation) AS explanation
+            FROM lessons l
+            LEFT JOIN lesson_bodies b ON b.content_key = l.content_key
+            WHERE l.course_id = {ph} AND l.lesson_title = {ph}
         ''', (course_id, lesson_title))
         
         row = cursor.fetchone()
@@ -579,118 +1492,838 @@ def get_cached_lesson(course_id: str, lesson_title: str) -> Optional[dict]:
                 "lesson_title": row['lesson_title'],
                 "content_markdown": row['content_markdown'],
                 "mermaid_code": row['mermaid_code'],
-                "explanation": row['explanation']
+                "explanation": row['explanation'],
+                "shared": row['content_key'] is not None
             }
-        return None
+        
+        if topic is None or level is None:
+            return None
+        
+        content_key = lesson_content_key(topic, level, lesson_title)
+        cursor.execute(f'''
+            SELECT content_markdown, mermaid_code, explanation FROM lesson_bodies WHERE content_key = {ph}
+        ''', (content_key,))
+        body = cursor.fetchone()
+        if not body:
+            return None
+    
+    adopt_shared_lesson(course_id, lesson_title, topic, level, content_key)
+    return {
+        "lesson_title": lesson_title,
+        "content_markdown": body['content_markdown'],
+        "mermaid_code": body['mermaid_code'],
+        "explanation": body['explanation'],
+        "shared": True
+    }
 
+def _save_lesson_body(cursor, content_key: str, lesson_title: str, topic: str, level: str,
+                      content_markdown: str, mermaid_code: str, explanation: str) -> None:
+    """Insert or replace a shared lesson body, with its search document and sections."""
+    now = datetime.now().isoformat()
+    ph = get_placeholder()
+    cursor.execute(f'''
+        INSERT INTO lesson_bodies
+        (content_key, lesson_title, topic, level, content_markdown, mermaid_code, explanation, ref_count, created_at)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, 0, {ph})
+        ON CONFLICT (content_key) DO UPDATE SET
+            content_markdown = EXCLUDED.content_markdown,
+            mermaid_code = EXCLUDED.mermaid_code,
+            explanation = EXCLUDED.explanation
+    ''', (content_key, lesson_title, topic, level, content_markdown, mermaid_code, explanation, now))
+    _index_search_doc(cursor, f"body:{content_key}", 'lesson', lesson_title, content_markdown, content_key=content_key)
+    _store_lesson_sections(cursor, content_markdown, content_key=content_key)
+
+@traced
+@writes
 def save_cached_lesson(course_id: str, lesson_title: str, topic: str, level: str, 
-                       content_markdown: str, mermaid_code: str = "", explanation: str = "") -> bool:
-    """Save a generated lesson to cache."""
+                       content_markdown: str, mermaid_code: str = "", explanation: str = "",
+                       shared: bool = True) -> bool:
+    """Save a generated lesson to cache.
+
+    Shared lessons are stored once in lesson_bodies and referenced from the course;
+    shared=False keeps a course-specific copy that other courses never see.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        
+        if shared:
+            content_key = lesson_content_key(topic, level, lesson_title)
+            _save_lesson_body(cursor, content_key, lesson_title, topic, level, content_markdown, mermaid_code, explanation)
+            _link_course_lesson(cursor, course_id, lesson_title, topic, level, content_key)
+            _remove_search_docs(cursor, f'doc_key = {get_placeholder()}', (_course_lesson_doc_key(course_id, lesson_title),))
+            _remove_lesson_sections(cursor, course_id=course_id, lesson_title=lesson_title)
+        else:
+            _save_course_lesson(cursor, course_id, lesson_title, topic, level, content_markdown, mermaid_code, explanation)
+        conn.commit()
+        return True
+
+def _save_course_lesson(cursor, course_id: str, lesson_title: str, topic: str, level: str,
+                        content_markdown: str, mermaid_code: str, explanation: str) -> None:
+    """Store a course-specific copy of a lesson, with its search document and sections."""
+    _link_course_lesson(cursor, course_id, lesson_title, topic, level, None)
+    ph = get_placeholder()
+    cursor.execute(f'''
+        UPDATE lessons SET content_markdown = {ph}, mermaid_code = {ph}, explanation = {ph}, created_at = {ph}
+        WHERE course_id = {ph} AND lesson_title = {ph}
+    ''', (content_markdown, mermaid_code, explanation, datetime.now().isoformat(), course_id, lesson_title))
+    _index_search_doc(cursor, _course_lesson_doc_key(course_id, lesson_title), 'lesson', lesson_title,
+                      content_markdown, course_id=course_id)
+    _store_lesson_sections(cursor, content_markdown, course_id=course_id, lesson_title=lesson_title)
+
+@traced
+@writes
+def save_shared_lesson(lesson_title: str, topic: str, level: str, content_markdown: str,
+                       mermaid_code: str = "", explanation: str = "") -> bool:
+    """Store a shared lesson body that no course references yet (used to pre-warm the cache)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        _save_lesson_body(cursor, lesson_content_key(topic, level, lesson_title), lesson_title, topic, level,
+                          content_markdown, mermaid_code, explanation)
+        conn.commit()
+        return True
+
+# Columns of a cached lesson that patch_cached_lesson can replace on their own
+LESSON_PATCH_COLUMNS = {"mindmap": "mermaid_code", "summary": "explanation"}
+
+@traced
+@writes
+def patch_cached_lesson(course_id: str, lesson_title: str, part: str, value: str,
+                        position: Optional[int] = None, expected: Optional[str] = None,
+                        private: bool = True) -> Optional[dict]:
+    """Replace one part of a cached lesson: a section, the mindmap or the summary.
+
+    A section is written as one lesson_sections row (the whole lesson is only
+    re-split if the new text changes its headings), plus the body column and
+    search document that hold the full markdown. `expected` is the section's
+    text the replacement was generated from; LookupError is raised for a
+    missing section and ValueError if the section has changed since. By default
+    a course using a shared body gets its own patched copy; private=False
+    patches the shared body for every course using it. Returns the patched
+    lesson, or None when the lesson isn't cached.
+    """
+    from services.lesson_sections import split_lesson_sections
+    ph = get_placeholder()
+    lock = " FOR UPDATE" if USE_POSTGRES else ""
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT course_id, lesson_title, topic, level, content_key, content_markdown, mermaid_code, explanation
+            FROM lessons WHERE course_id = {ph} AND lesson_title = {ph}{lock}
+        ''', (course_id, lesson_title))
+        lesson = cursor.fetchone()
+        if not lesson:
+            return None
+        lesson = dict(lesson)
+        if lesson['content_key']:
+            cursor.execute(f'''
+                SELECT content_markdown, mermaid_code, explanation FROM lesson_bodies WHERE content_key = {ph}{lock}
+            ''', (lesson['content_key'],))
+            lesson.update(dict(cursor.fetchone()))
+        
+        patched = {"content_markdown": lesson['content_markdown'], "mermaid_code": lesson['mermaid_code'] or "",
+                   "explanation": lesson['explanation'] or ""}
+        restructured = False
+        if part == "section":
+            sections = split_lesson_sections(lesson['content_markdown'])
+            if position is None or not 0 <= position < len(sections):
+                raise LookupError("Section not found")
+            if expected is not None and sections[position].content_markdown != expected:
+                raise ValueError("The section changed while it was being regenerated")
+            texts = [section.content_markdown for section in sections]
+            texts[position] = value
+            patched["content_markdown"] = "".join(texts)
+            resplit = split_lesson_sections(patched["content_markdown"])
+            restructured = [(section.heading, section.level) for section in resplit] != \
+                           [(section.heading, section.level) for section in sections]
+        else:
+            patched[LESSON_PATCH_COLUMNS[part]] = value
+        
+        if lesson['content_key'] and private:
+            # Copy-on-write: the course gets its own copy and the shared body is untouched
+            _save_course_lesson(cursor, course_id, lesson_title, lesson['topic'], lesson['level'],
+                                patched["content_markdown"], patched["mermaid_code"], patched["explanation"])
+        else:
+            if lesson['content_key']:
+                table, condition, params = "lesson_bodies", f"content_key = {ph}", (lesson['content_key'],)
+                doc_key = f"body:{lesson['content_key']}"
+            else:
+                table, condition, params = "lessons", f"course_id = {ph} AND lesson_title = {ph}", (course_id, lesson_title)
+                doc_key = _course_lesson_doc_key(course_id, lesson_title)
+            column = "content_markdown" if part == "section" else LESSON_PATCH_COLUMNS[part]
+            cursor.execute(f'UPDATE {table} SET {column} = {ph} WHERE {condition}', (patched[column], *params))
+            
+            if part == "section":
+                _index_search_doc(cursor, doc_key, 'lesson', lesson_title, patched["content_markdown"],
+                                  course_id=None if lesson['content_key'] else course_id, content_key=lesson['content_key'])
+                section_filter = dict(content_key=lesson['content_key']) if lesson['content_key'] else \
+                                 dict(course_id=course_id, lesson_title=lesson_title)
+                if restructured:
+                    _store_lesson_sections(cursor, patched["content_markdown"], **section_filter)
+                else:
+                    condition, params = _lesson_sections_filter(lesson)
+                    cursor.execute(f'''
+                        UPDATE lesson_sections SET content_markdown = {ph} WHERE {condition} AND position = {ph}
+                    ''', (value, *params, position))
+        conn.commit()
+        return {
+            "lesson_title": lesson_title,
+            "content_markdown": patched["content_markdown"],
+            "mermaid_code": patched["mermaid_code"],
+            "explanation": patched["explanation"],
+            "shared": bool(lesson['content_key']) and not private,
+            "restructured": restructured
+        }
+
+@traced
+def get_shared_content_titles(table: str, topic: str, level: str, lesson_titles: list) -> set:
+    """The lesson titles that already have a shared body in lesson_bodies or quiz_bodies."""
+    if table not in ("lesson_bodies", "quiz_bodies"):
+        raise ValueError(f"Not a shared content table: {table}")
+    if not lesson_titles:
+        return set()
+    ph = get_placeholder()
+    keys = {lesson_content_key(topic, level, title): title for title in lesson_titles}
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT content_key FROM {table} WHERE content_key IN ({", ".join([ph] * len(keys))})
+        ''', tuple(keys))
+        return {keys[row['content_key']] for row in cursor.fetchall()}
+
+def release_course_lessons(cursor, course_id: str) -> int:
+    """Delete a course's cached lessons and drop its references to shared bodies."""
+    ph = get_placeholder()
+    
+    cursor.execute(f'''
+        SELECT content_key FROM lessons WHERE course_id = {ph} AND content_key IS NOT NULL
+    ''', (course_id,))
+    content_keys = [row['content_key'] for row in cursor.fetchall()]
+    for content_key in content_keys:
+        _release_lesson_body(cursor, content_key)
+    _remove_search_docs(cursor, f"kind = 'lesson' AND course_id = {ph}", (course_id,))
+    _remove_lesson_sections(cursor, course_id=course_id)
+    cursor.execute(f'DELETE FROM lessons WHERE course_id = {ph}', (course_id,))
+    return cursor.rowcount
+
+@traced
+@writes
+def purge_unreferenced_lesson_bodies(older_than_days: int = 30) -> int:
+    """Delete shared lesson bodies whose last course released them more than `older_than_days` ago.
+
+    Bodies no course has used yet (e.g. pre-warmed ones) are kept.
+    """
+    ph = get_placeholder()
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        _remove_search_docs(cursor, f'''
+            content_key IN (SELECT content_key FROM lesson_bodies WHERE ref_count <= 0 AND released_at < {ph})
+        ''', (cutoff,))
+        cursor.execute(f'''
+            DELETE FROM lesson_sections WHERE
+            content_key IN (SELECT content_key FROM lesson_bodies WHERE ref_count <= 0 AND released_at < {ph})
+        ''', (cutoff,))
+        cursor.execute(f'''
+            DELETE FROM lesson_bodies WHERE ref_count <= 0 AND released_at < {ph}
+        ''', (cutoff,))
+        conn.commit()
+        return cursor.rowcount
+
+def _lesson_sections_filter(lesson: dict) -> Tuple[str, tuple]:
+    """WHERE condition on lesson_sections for a lessons row (shared or course-specific)."""
+    ph = get_placeholder()
+    if lesson['content_key']:
+        return f'content_key = {ph}', (lesson['content_key'],)
+    return f'content_key IS NULL AND course_id = {ph} AND lesson_title = {ph}', (lesson['course_id'], lesson['lesson_title'])
+
+@traced
+def get_lesson_outline(course_id: str, lesson_title: str, topic: Optional[str] = None,
+                       level: Optional[str] = None) -> Optional[dict]:
+    """A cached lesson's table of contents and first section, without reading the rest of its body.
+
+    Like get_cached_lesson, a shared body from another course is adopted when
+    topic and level are given, and only that adoption goes through the writer.
+    """
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        select_lesson = f'''
+            SELECT l.course_id, l.lesson_title, l.content_key,
+                   COALESCE(b.mermaid_code, l.mermaid_code) AS mermaid_code,
+                   COALESCE(b.explanation, l.explanation) AS explanation
+            FROM lessons l
+            LEFT JOIN lesson_bodies b ON b.content_key = l.content_key
+            WHERE l.course_id = {ph} AND l.lesson_title = {ph}
+        '''
+        cursor.execute(select_lesson, (course_id, lesson_title))
+        lesson = cursor.fetchone()
+        
+        if not lesson and topic is not None and level is not None:
+            content_key = lesson_content_key(topic, level, lesson_title)
+            cursor.execute(f'''
+                SELECT mermaid_code, explanation FROM lesson_bodies WHERE content_key = {ph}
+            ''', (content_key,))
+            body = cursor.fetchone()
+            if body:
+                adopt_shared_lesson(course_id, lesson_title, topic, level, content_key)
+                lesson = {"course_id": course_id, "lesson_title": lesson_title, "content_key": content_key,
+                          "mermaid_code": body['mermaid_code'], "explanation": body['explanation']}
+        if not lesson:
+            return None
+        
+        condition, params = _lesson_sections_filter(lesson)
+        cursor.execute(f'''
+            SELECT position, heading, level, anchor, LENGTH(content_markdown) AS length,
+                   CASE WHEN position = 0 THEN content_markdown END AS content_markdown
+            FROM lesson_sections WHERE {condition} ORDER BY position
+        ''', params)
+        sections = [dict(row) for row in cursor.fetchall()]
+        return {
+            "lesson_title": lesson['lesson_title'],
+            "mermaid_code": lesson['mermaid_code'],
+            "explanation": lesson['explanation'],
+            "shared": lesson['content_key'] is not None,
+            "sections": [{key: value for key, value in section.items() if key != 'content_markdown'} for section in sections],
+            "first_section": sections[0] if sections else None
+        }
+
+@traced
+def get_lesson_section(course_id: str, lesson_title: str, position: int) -> Optional[dict]:
+    """One section of a cached lesson, or None if the lesson or section doesn't exist."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT course_id, lesson_title, content_key FROM lessons WHERE course_id = {ph} AND lesson_title = {ph}
+        ''', (course_id, lesson_title))
+        lesson = cursor.fetchone()
+        if not lesson:
+            return None
+        
+        condition, params = _lesson_sections_filter(lesson)
+        cursor.execute(f'''
+            SELECT position, heading, level, anchor, LENGTH(content_markdown) AS length, content_markdown
+            FROM lesson_sections WHERE {condition} AND position = {ph}
+        ''', (*params, position))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+@traced
+@writes
+def rebuild_lesson_sections() -> int:
+    """Re-split every cached lesson into sections. Returns the number of lessons."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        count = _rebuild_lesson_sections(cursor)
+        conn.commit()
+        return count
+
+@traced
+@writes
+def delete_user_course(email: str, course_id: str) -> bool:
+    """Remove a course from a user's list, releasing its cached lessons once no user holds it."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'DELETE FROM user_courses WHERE user_email = {ph} AND course_id = {ph}', (email, course_id))
+        if cursor.rowcount == 0:
+            return False
+        
+        cursor.execute(f'SELECT 1 FROM user_courses WHERE course_id = {ph} LIMIT 1', (course_id,))
+        if not cursor.fetchone():
+            release_course_lessons(cursor, course_id)
+        conn.commit()
+        return True
+
+def _save_quiz_bodies(cursor, topic: str, level: str, quizzes: list, created_at: str) -> None:
+    """Insert or replace the shared copies of quizzes (dicts with lesson_title and questions)."""
+    import json
+    ph = get_placeholder()
+    cursor.executemany(f'''
+        INSERT INTO quiz_bodies (content_key, lesson_title, topic, level, questions_json, created_at)
+        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+        ON CONFLICT (content_key) DO UPDATE SET
+            questions_json = EXCLUDED.questions_json,
+            created_at = EXCLUDED.created_at
+    ''', [(lesson_content_key(topic, level, quiz['lesson_title']), quiz['lesson_title'], topic, level,
+           json.dumps(quiz['questions']), created_at) for quiz in quizzes])
+
+def _save_course_quizzes(cursor, course_id: str, topic: str, level: str, quizzes: list, created_at: str) -> None:
+    import json
+    rows = [
+        (course_id, quiz['lesson_title'], topic, level, json.dumps(quiz['questions']), created_at)
+        for quiz in quizzes
+    ]
+    if USE_POSTGRES:
+        cursor.executemany('''
+            INSERT INTO quizzes (course_id, lesson_title, topic, level, questions_json, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (course_id, lesson_title) DO UPDATE SET
+                questions_json = EXCLUDED.questions_json,
+                created_at = EXCLUDED.created_at
+        ''', rows)
+    else:
+        cursor.executemany('''
+            INSERT OR REPLACE INTO quizzes (course_id, lesson_title, topic, level, questions_json, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+@traced
+@writes
+def adopt_shared_quizzes(course_id: str, topic: str, level: str, quizzes: list) -> None:
+    """Give a course its own rows for shared quizzes it has adopted."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        _save_course_quizzes(cursor, course_id, topic, level, quizzes, datetime.now().isoformat())
+        conn.commit()
+
+@traced
+def get_cached_quizzes(course_id: str, lesson_titles: list, topic: Optional[str] = None,
+                       level: Optional[str] = None) -> Dict[str, list]:
+    """Get cached quiz questions for several lessons at once, keyed by lesson title.
+
+    When topic and level are given, lessons the course has no quiz for yet adopt
+    the shared quiz generated for another course (or by the cache warmer). Only
+    that adoption is a write; the lookups run on a reader connection.
+    """
+    import json
+    ph = get_placeholder()
+    
+    if not lesson_titles:
+        return {}
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        placeholders = ", ".join([ph] * len(lesson_titles))
+        cursor.execute(f'''
+            SELECT lesson_title, questions_json FROM quizzes
+            WHERE course_id = {ph} AND lesson_title IN ({placeholders})
+        ''', (course_id, *lesson_titles))
+        
+        cached = {row['lesson_title']: json.loads(row['questions_json']) for row in cursor.fetchall()}
+        missing = [title for title in lesson_titles if title not in cached]
+        if not missing or topic is None or level is None:
+            return cached
+        
+        keys = {lesson_content_key(topic, level, title): title for title in missing}
+        cursor.execute(f'''
+            SELECT content_key, questions_json FROM quiz_bodies WHERE content_key IN ({", ".join([ph] * len(keys))})
+        ''', tuple(keys))
+        adopted = [{"lesson_title": keys[row['content_key']], "questions": json.loads(row['questions_json'])}
+                   for row in cursor.fetchall()]
+    
+    if adopted:
+        adopt_shared_quizzes(course_id, topic, level, adopted)
+        cached.update({quiz["lesson_title"]: quiz["questions"] for quiz in adopted})
+    return cached
+
+@traced
+@writes
+def save_cached_quizzes(course_id: str, topic: str, level: str, quizzes: list) -> bool:
+    """Save generated quizzes (dicts with lesson_title and questions) in one transaction.
+
+    Each quiz is also kept as a shared copy that other courses can adopt.
+    """
+    if not quizzes:
+        return True
+    
+    created_at = datetime.now().isoformat()
+    with get_db() as conn:
+        cursor = conn.cursor()
+        _save_course_quizzes(cursor, course_id, topic, level, quizzes, created_at)
+        _save_quiz_bodies(cursor, topic, level, quizzes, created_at)
+        conn.commit()
+        return True
+
+@traced
+@writes
+def save_shared_quizzes(topic: str, level: str, quizzes: list) -> bool:
+    """Store shared quizzes that no course has yet (used to pre-warm the cache)."""
+    if not quizzes:
+        return True
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        _save_quiz_bodies(cursor, topic, level, quizzes, datetime.now().isoformat())
+        conn.commit()
+        return True
+
+@traced
+def get_cached_diagram(topic: str, level: str, lesson_title: str) -> Optional[dict]:
+    """The cached standalone diagram for a lesson, if one was generated before."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT lesson_title, mermaid_code, explanation FROM diagram_bodies WHERE content_key = {ph}
+        ''', (lesson_content_key(topic, level, lesson_title),))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+@traced
+@writes
+def save_cached_diagram(topic: str, level: str, lesson_title: str, mermaid_code: str, explanation: str = "") -> bool:
+    """Cache a generated diagram, shared by every course with the same lesson."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            INSERT INTO diagram_bodies (content_key, lesson_title, topic, level, mermaid_code, explanation, created_at)
+            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+            ON CONFLICT (content_key) DO UPDATE SET
+                mermaid_code = EXCLUDED.mermaid_code,
+                explanation = EXCLUDED.explanation,
+                created_at = EXCLUDED.created_at
+        ''', (lesson_content_key(topic, level, lesson_title), lesson_title, topic, level, mermaid_code, explanation,
+              datetime.now().isoformat()))
+        conn.commit()
+        return True
+
+# ============ EMAIL OUTBOX FUNCTIONS ============
+
+# A claimed row that is still 'sending' after this long belongs to a dead worker
+EMAIL_CLAIM_TIMEOUT_MINUTES = 5
+
+def queue_email(cursor, recipient: str, subject: str, html_content: str, text_content: str = "") -> None:
+    """Add an email to the outbox using the caller's cursor, so it commits with the caller's transaction."""
+    ph = get_placeholder()
+    now = datetime.now().isoformat()
+    cursor.execute(f'''
+        INSERT INTO email_outbox (recipient, subject, html_content, text_content, status, attempts, next_attempt_at, created_at)
+        VALUES ({ph}, {ph}, {ph}, {ph}, 'pending', 0, {ph}, {ph})
+    ''', (recipient, subject, html_content, text_content, now, now))
+
+@traced
+@writes
+def claim_pending_emails(limit: int) -> list:
+    """Claim up to `limit` due emails for delivery and mark them as 'sending'."""
+    ph = get_placeholder()
+    now = datetime.now()
+    stale_before = (now - timedelta(minutes=EMAIL_CLAIM_TIMEOUT_MINUTES)).isoformat()
+    
     with get_db() as conn:
         cursor = conn.cursor()
         
         if USE_POSTGRES:
+            # SKIP LOCKED lets several workers drain the outbox without double-sending
             cursor.execute('''
-                INSERT INTO lessons 
-                (course_id, lesson_title, topic, level, content_markdown, mermaid_code, explanation, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (course_id, lesson_title) DO UPDATE SET
-                    content_markdown = EXCLUDED.content_markdown,
-                    mermaid_code = EXCLUDED.mermaid_code,
-                    explanation = EXCLUDED.explanation
-            ''', (course_id, lesson_title, topic, level, content_markdown, mermaid_code, explanation, 
-                  datetime.now().isoformat()))
+                UPDATE email_outbox SET status = 'sending', next_attempt_at = %s
+                WHERE id IN (
+                    SELECT id FROM email_outbox
+                    WHERE (status = 'pending' AND next_attempt_at <= %s)
+                       OR (status = 'sending' AND next_attempt_at <= %s)
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, recipient, subject, html_content, text_content, attempts
+            ''', (now.isoformat(), now.isoformat(), stale_before, limit))
+            rows = [dict(row) for row in cursor.fetchall()]
         else:
             cursor.execute('''
-                INSERT OR REPLACE INTO lessons 
-                (course_id, lesson_title, topic, level, content_markdown, mermaid_code, explanation, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (course_id, lesson_title, topic, level, content_markdown, mermaid_code, explanation, 
-                  datetime.now().isoformat()))
+                SELECT id, recipient, subject, html_content, text_content, attempts, status, next_attempt_at
+                FROM email_outbox
+                WHERE (status = 'pending' AND next_attempt_at <= ?)
+                   OR (status = 'sending' AND next_attempt_at <= ?)
+                ORDER BY next_attempt_at
+                LIMIT ?
+            ''', (now.isoformat(), stale_before, limit))
+            candidates = [dict(row) for row in cursor.fetchall()]
+            # Another process may claim the same rows between the SELECT and the
+            # UPDATE; only keep those still in the state we read them in
+            rows = []
+            for row in candidates:
+                cursor.execute('''
+                    UPDATE email_outbox SET status = 'sending', next_attempt_at = ?
+                    WHERE id = ? AND status = ? AND next_attempt_at = ?
+                ''', (now.isoformat(), row['id'], row.pop('status'), row.pop('next_attempt_at')))
+                if cursor.rowcount == 1:
+                    rows.append(row)
+        conn.commit()
+        return rows
+
+@traced
+@writes
+def mark_email_sent(email_id: int) -> None:
+    """Mark an outbox email as delivered."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            UPDATE email_outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL, sent_at = {ph}
+            WHERE id = {ph}
+        ''', (datetime.now().isoformat(), email_id))
+        conn.commit()
+
+@traced
+@writes
+def mark_email_failed(email_id: int, error: str, retry_at: Optional[datetime]) -> None:
+    """Record a failed delivery; reschedule it, or give up when retry_at is None."""
+    ph = get_placeholder()
+    status = 'pending' if retry_at else 'failed'
+    next_attempt_at = (retry_at or datetime.now()).isoformat()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            UPDATE email_outbox SET status = {ph}, attempts = attempts + 1, last_error = {ph}, next_attempt_at = {ph}
+            WHERE id = {ph}
+        ''', (status, error[:500], next_attempt_at, email_id))
         conn.commit()
-        return True
+
+@traced
+def count_pending_emails() -> int:
+    """Return how many emails are waiting to be delivered."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) AS pending FROM email_outbox WHERE status IN ('pending', 'sending')")
+        row = cursor.fetchone()
+        return row['pending'] if row else 0
 
 # ============ NOTES FUNCTIONS ============
 
-def get_user_note(user_email: str, course_id: str, lesson_id: str) -> Optional[str]:
-    """Get user's note for a specific lesson."""
+class NoteVersionConflict(Exception):
+    """A note save was based on a version that is no longer the latest."""
+
+    def __init__(self, version: int):
+        super().__init__(f"Version conflict: the note is at version {version}")
+        self.version = version
+
+@traced
+def get_user_note(user_email: str, course_id: str, lesson_id: str) -> Optional[dict]:
+    """Get user's note for a specific lesson, with its version."""
     ph = get_placeholder()
     
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute(f'''
-            SELECT content FROM user_notes 
+            SELECT content, version FROM user_notes 
             WHERE user_email = {ph} AND course_id = {ph} AND lesson_id = {ph}
         ''', (user_email, course_id, lesson_id))
         
         row = cursor.fetchone()
         if row:
-            return row['content'] if isinstance(row, dict) else row[0]
+            return {"content": row['content'] or "", "version": row['version']}
         return None
 
-def save_user_note(user_email: str, course_id: str, lesson_id: str, content: str) -> bool:
-    """Save or update user's note for a specific lesson."""
+@traced
+@writes
+def save_user_note(user_email: str, course_id: str, lesson_id: str, content: str,
+                   base_version: Optional[int] = None) -> dict:
+    """Save or update user's note for a specific lesson.
+
+    With base_version, the save is rejected (NoteVersionConflict) unless the
+    note is still at that version. Returns the note's version and whether it changed.
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        result = _save_user_note(cursor, user_email, course_id, lesson_id, content, base_version)
+        conn.commit()
+        return result
+
+@traced
+@writes
+def patch_user_note(user_email: str, course_id: str, lesson_id: str, base_version: int,
+                    ops: list, sha256: Optional[str] = None) -> dict:
+    """Apply edits made against base_version of a note (see services/note_patch.py)."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        result = _patch_user_note(cursor, user_email, course_id, lesson_id, base_version, ops, sha256)
+        conn.commit()
+        return result
+
+def _patch_user_note(cursor, user_email: str, course_id: str, lesson_id: str, base_version: int,
+                     ops: list, sha256: Optional[str] = None) -> dict:
+    from services.note_patch import apply_note_patch
+    current = _current_note(cursor, user_email, course_id, lesson_id)
+    if current['version'] != base_version:
+        raise NoteVersionConflict(current['version'])
+    content = apply_note_patch(current['content'], ops, sha256)
+    return _write_user_note(cursor, user_email, course_id, lesson_id, content, current, base_version)
+
+def _current_note(cursor, user_email: str, course_id: str, lesson_id: str) -> dict:
+    ph = get_placeholder()
+    cursor.execute(f'''
+        SELECT content, version FROM user_notes WHERE user_email = {ph} AND course_id = {ph} AND lesson_id = {ph}
+    ''', (user_email, course_id, lesson_id))
+    row = cursor.fetchone()
+    return {"exists": True, "content": row['content'] or "", "version": row['version']} if row else \
+           {"exists": False, "content": "", "version": 0}
+
+def _save_user_note(cursor, user_email: str, course_id: str, lesson_id: str, content: str,
+                    base_version: Optional[int] = None) -> dict:
+    current = _current_note(cursor, user_email, course_id, lesson_id)
+    if base_version is not None and current['version'] != base_version:
+        raise NoteVersionConflict(current['version'])
+    return _write_user_note(cursor, user_email, course_id, lesson_id, content, current, base_version)
+
+def _write_user_note(cursor, user_email: str, course_id: str, lesson_id: str, content: str,
+                     current: dict, base_version: Optional[int]) -> dict:
+    """Store a note's new content as the next version, unless it is unchanged."""
+    if content == current['content']:
+        # Autosave with nothing new: no write and no reindex
+        return {"version": current['version'], "changed": False}
+    
+    ph = get_placeholder()
+    now = datetime.now().isoformat()
+    if current['exists']:
+        # Conditional on the version read above, so a concurrent save can't be silently overwritten
+        cursor.execute(f'''
+            UPDATE user_notes SET content = {ph}, version = version + 1, updated_at = {ph}
+            WHERE user_email = {ph} AND course_id = {ph} AND lesson_id = {ph} AND version = {ph}
+        ''', (content, now, user_email, course_id, lesson_id, current['version']))
+    else:
+        cursor.execute(f'''
+            INSERT INTO user_notes (user_email, course_id, lesson_id, content, updated_at, version)
+            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, 1)
+            ON CONFLICT (user_email, course_id, lesson_id) DO NOTHING
+        ''', (user_email, course_id, lesson_id, content, now))
+    if cursor.rowcount == 0:
+        latest = _current_note(cursor, user_email, course_id, lesson_id)
+        if base_version is not None:
+            raise NoteVersionConflict(latest['version'])
+        # Unversioned saves keep last-writer-wins semantics
+        return _write_user_note(cursor, user_email, course_id, lesson_id, content, latest, None)
+    
+    doc_key = _note_doc_key(user_email, course_id, lesson_id)
+    if content and content.strip():
+        _index_search_doc(cursor, doc_key, 'note', lesson_id, content, owner=user_email, course_id=course_id)
+    else:
+        _remove_search_docs(cursor, f'doc_key = {ph}', (doc_key,))
+    return {"version": current['version'] + 1, "changed": True}
+
+# ============ SEARCH FUNCTIONS ============
+
+def build_fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word must match, the last one also as a prefix."""
+    import re
+    terms = ['"' + word + '"' for word in re.findall(r'\w+', text)]
+    if terms:
+        # Search-as-you-type: the last word may be incomplete
+        terms[-1] = f'({terms[-1]} OR {terms[-1]}*)'
+    return " AND ".join(terms)
+
+@traced
+def search_user_content(user_email: str, query: str, kind: Optional[str] = None, limit: int = 20) -> list:
+    """Full-text search over the lessons of a user's courses and their own notes, best match first."""
+    ph = get_placeholder()
+    kinds = [kind] if kind else ['lesson', 'note']
+    
+    # Lesson bodies are shared, so report them under one of the user's courses that uses them
+    visible = f'''
+        ((d.kind = 'note' AND d.owner = {ph})
+         OR (d.kind = 'lesson' AND d.course_id IN (SELECT course_id FROM user_courses WHERE user_email = {ph}))
+         OR (d.kind = 'lesson' AND d.content_key IN (
+             SELECT l.content_key FROM lessons l JOIN user_courses uc ON uc.course_id = l.course_id
+             WHERE uc.user_email = {ph})))
+    '''
+    course_column = f'''
+        COALESCE(d.course_id, (
+            SELECT l.course_id FROM lessons l JOIN user_courses uc ON uc.course_id = l.course_id
+            WHERE l.content_key = d.content_key AND uc.user_email = {ph} LIMIT 1)) AS course_id
+    '''
+    kind_filter = f"d.kind IN ({', '.join([ph] * len(kinds))})"
+    
     with get_db() as conn:
         cursor = conn.cursor()
-        
         if USE_POSTGRES:
-            cursor.execute('''
-                INSERT INTO user_notes 
-                (user_email, course_id, lesson_id, content, updated_at)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (user_email, course_id, lesson_id) DO UPDATE SET
-                    content = EXCLUDED.content,
-                    updated_at = EXCLUDED.updated_at
-            ''', (user_email, course_id, lesson_id, content, datetime.now().isoformat()))
+            cursor.execute(f'''
+                SELECT d.kind, {course_column}, d.lesson_title,
+                       ts_headline('english', d.body, q, 'StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=12') AS snippet,
+                       ts_rank_cd(d.document, q) AS score
+                FROM search_docs d, websearch_to_tsquery('english', %s) q
+                WHERE d.document @@ q AND {kind_filter} AND {visible}
+                ORDER BY score DESC
+                LIMIT %s
+            ''', (user_email, query, *kinds, user_email, user_email, user_email, limit))
         else:
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_notes 
-                (user_email, course_id, lesson_id, content, updated_at)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_email, course_id, lesson_id, content, datetime.now().isoformat()))
+            fts_query = build_fts_query(query)
+            if not fts_query:
+                return []
+            cursor.execute(f'''
+                SELECT d.kind, {course_column}, d.lesson_title,
+                       snippet(search_fts, 1, '<mark>', '</mark>', '…', 24) AS snippet,
+                       -bm25(search_fts, 4.0, 1.0) AS score
+                FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid
+                WHERE search_fts MATCH ? AND {kind_filter} AND {visible}
+                ORDER BY bm25(search_fts, 4.0, 1.0)
+                LIMIT ?
+            ''', (user_email, fts_query, *kinds, user_email, user_email, user_email, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+@traced
+@writes
+def rebuild_search_index() -> int:
+    """Re-index all lessons and notes from scratch. Returns the number of documents."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        count = _rebuild_search_index(cursor)
         conn.commit()
-        return True
+        return count
 
 # ============ ACTIVITY TRACKING FUNCTIONS ============
 
+@traced
+@writes
 def log_user_activity(user_email: str, minutes: int = 0, lessons: int = 0) -> bool:
     """Log user activity for today. Adds to existing values."""
-    today = datetime.now().strftime('%Y-%m-%d')
-    
     with get_db() as conn:
         cursor = conn.cursor()
+        _log_user_activity(cursor, user_email, minutes, lessons)
+        conn.commit()
+        return True
+
+def _log_user_activity(cursor, user_email: str, minutes: int = 0, lessons: int = 0) -> None:
+    today = datetime.now().date()
+    
+    if USE_POSTGRES:
+        cursor.execute('''
+            INSERT INTO user_activity 
+            (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
+            VALUES (%s, %s, %s, %s, 30)
+            ON CONFLICT (user_email, activity_date) DO UPDATE SET
+                minutes_studied = user_activity.minutes_studied + EXCLUDED.minutes_studied,
+                lessons_completed = user_activity.lessons_completed + EXCLUDED.lessons_completed
+            RETURNING minutes_studied
+        ''', (user_email, today.isoformat(), minutes, lessons))
+        previous_minutes = cursor.fetchone()['minutes_studied'] - minutes
+    else:
+        # Check if exists
+        cursor.execute('''
+            SELECT minutes_studied, lessons_completed FROM user_activity 
+            WHERE user_email = ? AND activity_date = ?
+        ''', (user_email, today.isoformat()))
+        row = cursor.fetchone()
         
-        if USE_POSTGRES:
+        if row:
             cursor.execute('''
-                INSERT INTO user_activity 
-                (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
-                VALUES (%s, %s, %s, %s, 30)
-                ON CONFLICT (user_email, activity_date) DO UPDATE SET
-                    minutes_studied = user_activity.minutes_studied + EXCLUDED.minutes_studied,
-                    lessons_completed = user_activity.lessons_completed + EXCLUDED.lessons_completed
-            ''', (user_email, today, minutes, lessons))
+                UPDATE user_activity SET minutes_studied = ?, lessons_completed = ?
+                WHERE user_email = ? AND activity_date = ?
+            ''', (row[0] + minutes, row[1] + lessons, user_email, today.isoformat()))
+            previous_minutes = row[0]
         else:
-            # Check if exists
             cursor.execute('''
-                SELECT minutes_studied, lessons_completed FROM user_activity 
-                WHERE user_email = ? AND activity_date = ?
-            ''', (user_email, today))
-            row = cursor.fetchone()
-            
-            if row:
-                cursor.execute('''
-                    UPDATE user_activity SET minutes_studied = ?, lessons_completed = ?
-                    WHERE user_email = ? AND activity_date = ?
-                ''', (row[0] + minutes, row[1] + lessons, user_email, today))
-            else:
-                cursor.execute('''
-                    INSERT INTO user_activity 
-                    (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
-                    VALUES (?, ?, ?, ?, 30)
-                ''', (user_email, today, minutes, lessons))
-        conn.commit()
-        return True
+                INSERT INTO user_activity 
+                (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
+                VALUES (?, ?, ?, ?, 30)
+            ''', (user_email, today.isoformat(), minutes, lessons))
+            previous_minutes = 0
+    
+    # A day counts as active once it has any minutes
+    active_days = int(previous_minutes + minutes > 0) - int(previous_minutes > 0)
+    _add_to_rollups(cursor, user_email, today, minutes, lessons, active_days)
+    _update_leaderboard_scores(cursor, user_email, today, minutes, active_days)
 
+@traced
 def get_user_stats(user_email: str) -> Dict[str, Any]:
     """Get user's streak, today's progress, and stats."""
     today = datetime.now().strftime('%Y-%m-%d')
@@ -722,6 +2355,7 @@ def get_user_stats(user_email: str) -> Dict[str, Any]:
             "goal_progress_percent": min(100, int((today_minutes / daily_goal) * 100)) if daily_goal > 0 else 0
         }
 
+@traced
 def calculate_streak(user_email: str) -> int:
     """Calculate the current study streak (consecutive days)."""
     ph = get_placeholder()
@@ -759,29 +2393,191 @@ def calculate_streak(user_email: str) -> int:
         
         return streak
 
+@traced
+def get_activity_history(user_email: str, start, end, granularity: str = "week") -> list:
+    """Activity per day, week or month from start to end (dates), oldest first, with empty periods filled in.
+
+    Weeks and months are read from activity_rollups, so a year of weekly data is 53 rows.
+    """
+    ph = get_placeholder()
+    first = period_start(start, granularity)
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if granularity == "day":
+            cursor.execute(f'''
+                SELECT activity_date AS period_start, minutes_studied, lessons_completed,
+                       CASE WHEN minutes_studied > 0 THEN 1 ELSE 0 END AS active_days
+                FROM user_activity
+                WHERE user_email = {ph} AND activity_date >= {ph} AND activity_date <= {ph}
+            ''', (user_email, first.isoformat(), end.isoformat()))
+        else:
+            cursor.execute(f'''
+                SELECT period_start, minutes_studied, lessons_completed, active_days FROM activity_rollups
+                WHERE user_email = {ph} AND period = {ph} AND period_start >= {ph} AND period_start <= {ph}
+            ''', (user_email, granularity, first.isoformat(), end.isoformat()))
+        stored = {row['period_start']: row for row in cursor.fetchall()}
+    
+    history = []
+    current = first
+    while current <= end:
+        row = stored.get(current.isoformat())
+        history.append({
+            "period_start": current.isoformat(),
+            "minutes": row['minutes_studied'] if row else 0,
+            "lessons": row['lessons_completed'] if row else 0,
+            "active_days": row['active_days'] if row else 0
+        })
+        if granularity == "day":
+            current += timedelta(days=1)
+        elif granularity == "week":
+            current += timedelta(weeks=1)
+        else:
+            current = (current.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return history
+
+@traced
+@writes
+def rebuild_activity_rollups() -> int:
+    """Recompute the weekly and monthly activity totals from user_activity. Returns the number of users."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        count = _rebuild_activity_rollups(cursor)
+        conn.commit()
+        return count
+
+@traced
+def get_leaderboard_rows(since: Optional[str] = None) -> list:
+    """Leaderboard scores updated after `since` (all of them when None), oldest update first."""
+    ph = get_placeholder()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        query = 'SELECT user_email, streak, last_active_date, week_start, week_minutes, updated_at FROM leaderboard_scores'
+        if since:
+            cursor.execute(f'{query} WHERE updated_at > {ph} ORDER BY updated_at', (since,))
+        else:
+            cursor.execute(f'{query} ORDER BY updated_at')
+        return [dict(row) for row in cursor.fetchall()]
+
+@traced
+@writes
+def rebuild_leaderboard() -> int:
+    """Recompute every user's leaderboard scores from user_activity. Returns the number of users."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        count = _rebuild_leaderboard(cursor)
+        conn.commit()
+        return count
+
+@traced
+@writes
 def update_daily_goal(user_email: str, goal_minutes: int) -> bool:
     """Update user's daily study goal."""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        _update_daily_goal(cursor, user_email, goal_minutes)
+        conn.commit()
+        return True
+
+def _update_daily_goal(cursor, user_email: str, goal_minutes: int) -> None:
     today = datetime.now().strftime('%Y-%m-%d')
     
+    if USE_POSTGRES:
+        cursor.execute('''
+            INSERT INTO user_activity 
+            (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
+            VALUES (%s, %s, 0, 0, %s)
+            ON CONFLICT (user_email, activity_date) DO UPDATE SET
+                daily_goal_minutes = EXCLUDED.daily_goal_minutes
+        ''', (user_email, today, goal_minutes))
+    else:
+        cursor.execute('''
+            INSERT OR REPLACE INTO user_activity 
+            (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
+            VALUES (?, ?, 
+                COALESCE((SELECT minutes_studied FROM user_activity WHERE user_email = ? AND activity_date = ?), 0),
+                COALESCE((SELECT lessons_completed FROM user_activity WHERE user_email = ? AND activity_date = ?), 0),
+                ?)
+        ''', (user_email, today, user_email, today, user_email, today, goal_minutes))
+
+# ============ GENERATION QUOTAS ============
+
+@traced
+@writes
+def sync_generation_quotas(usage: list, now: float, since: Optional[float], expire_before: float) -> list:
+    """Apply one worker's quota usage to the shared balances and return the balances changed since `since`.
+
+    usage holds (bucket_key, tokens used, burst, tokens per second) per bucket;
+    stored balances are refilled up to `now` before the usage is taken off.
+    Rows untouched since expire_before (full again by then) are deleted.
+    """
+    ph = get_placeholder()
+    lock = " FOR UPDATE" if USE_POSTGRES else ""
+    
     with get_db() as conn:
         cursor = conn.cursor()
+        for bucket_key, used, burst, per_second in usage:
+            cursor.execute(f'''
+                INSERT INTO generation_quotas (bucket_key, tokens, updated_at) VALUES ({ph}, {ph}, {ph})
+                ON CONFLICT (bucket_key) DO NOTHING
+            ''', (bucket_key, burst, now))
+            cursor.execute(f'SELECT tokens, updated_at FROM generation_quotas WHERE bucket_key = {ph}{lock}', (bucket_key,))
+            row = cursor.fetchone()
+            tokens = min(burst, row['tokens'] + max(0.0, now - row['updated_at']) * per_second)
+            cursor.execute(f'''
+                UPDATE generation_quotas SET tokens = {ph}, updated_at = {ph} WHERE bucket_key = {ph}
+            ''', (tokens - used, max(now, row['updated_at']), bucket_key))
         
-        if USE_POSTGRES:
-            cursor.execute('''
-                INSERT INTO user_activity 
-                (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
-                VALUES (%s, %s, 0, 0, %s)
-                ON CONFLICT (user_email, activity_date) DO UPDATE SET
-                    daily_goal_minutes = EXCLUDED.daily_goal_minutes
-            ''', (user_email, today, goal_minutes))
-        else:
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_activity 
-                (user_email, activity_date, minutes_studied, lessons_completed, daily_goal_minutes)
-                VALUES (?, ?, 
-                    COALESCE((SELECT minutes_studied FROM user_activity WHERE user_email = ? AND activity_date = ?), 0),
-                    COALESCE((SELECT lessons_completed FROM user_activity WHERE user_email = ? AND activity_date = ?), 0),
-                    ?)
-            ''', (user_email, today, user_email, today, user_email, today, goal_minutes))
+        cursor.execute(f'DELETE FROM generation_quotas WHERE updated_at < {ph}', (expire_before,))
+        cursor.execute(f'''
+            SELECT bucket_key, tokens, updated_at FROM generation_quotas WHERE updated_at >= {ph}
+        ''', (since if since is not None else 0,))
+        rows = [dict(row) for row in cursor.fetchall()]
         conn.commit()
-        return True
+        return rows
+
+# ============ SYNC FUNCTIONS ============
+
+def _sync_update_progress(cursor, email: str, data: dict) -> None:
+    if not _update_course_progress(cursor, email, data["course_id"], data["progress_percent"]):
+        raise LookupError("Course not found")
+
+# Mutation type -> function applying it with the caller's cursor
+SYNC_HANDLERS = {
+    "save_course": _save_user_course,
+    "update_progress": _sync_update_progress,
+    "save_note": lambda cursor, email, data: _save_user_note(cursor, email, data["course_id"], data["lesson_id"],
+                                                             data["content"], data.get("base_version")),
+    "patch_note": lambda cursor, email, data: _patch_user_note(cursor, email, data["course_id"], data["lesson_id"],
+                                                               data["base_version"], data["ops"], data.get("sha256")),
+    "log_activity": lambda cursor, email, data: _log_user_activity(cursor, email, data.get("minutes", 0), data.get("lessons", 0)),
+    "set_goal": lambda cursor, email, data: _update_daily_goal(cursor, email, data["goal_minutes"]),
+}
+
+@traced
+@writes
+def apply_user_sync(email: str, operations: list) -> list:
+    """Apply a batch of (type, data) mutations for a user in one transaction.
+
+    Each operation runs inside a savepoint, so one that fails is rolled back on
+    its own and the rest still commit. Returns an error message or None per operation.
+    """
+    results = []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        if not USE_POSTGRES and not conn.in_transaction:
+            # Savepoints only nest inside an explicit transaction in SQLite
+            cursor.execute('BEGIN')
+        for op_type, data in operations:
+            cursor.execute('SAVEPOINT sync_op')
+            try:
+                SYNC_HANDLERS[op_type](cursor, email, data)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT sync_op')
+                results.append(str(e) or type(e).__name__)
+            else:
+                results.append(None)
+            cursor.execute('RELEASE SAVEPOINT sync_op')
+        conn.commit()
+    return results
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional, Tuple
+
+# Offline cache warmer: pre-generates the syllabus, lessons (with their
+# diagrams) and quizzes for popular (topic, level) pairs, so the first users on
+# those topics are served from the shared caches instead of waiting on Gemini.
+#
+#   python -m services.cache_warmer topics.txt [--processes 2] [--threads 4] [--rate 60]
+#
+# topics.txt has one "topic, level[, daily_minutes]" per line ("#" starts a
+# comment). Topics are spread over a pool of processes, and each process
+# generates a topic's lessons and chapter quizzes on a pool of threads; every
+# Gemini call in every process shares one --rate limit (calls per minute).
+# Anything already cached is skipped, and finished topics are recorded in a
+# checkpoint file, so an interrupted run picks up where it left off.
+
+DEFAULT_DAILY_MINUTES = 30
+
+# Shared counters, by index into the counters array
+COUNTERS = ["calls", "syllabi", "lessons", "quizzes", "cached", "errors"]
+CALLS, SYLLABI, LESSONS, QUIZZES, CACHED, ERRORS = range(len(COUNTERS))
+
+class RateLimiter:
+    """Spaces calls evenly, at most `per_minute` a minute across every process sharing its state."""
+
+    def __init__(self, per_minute: float, next_slot, lock):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.next_slot = next_slot
+        self.lock = lock
+
+    def __call__(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+# ============ WORKER PROCESSES ============
+
+_counters = None
+_threads = 1
+
+def _bump(counter: int, amount: int = 1):
+    with _counters.get_lock():
+        _counters[counter] += amount
+
+def _init_worker(per_minute: float, next_slot, lock, counters, threads: int):
+    global _counters, _threads
+    from services.gemini_service import set_call_limiter
+    _counters = counters
+    _threads = threads
+    limiter = RateLimiter(per_minute, next_slot, lock)
+
+    def limited_call():
+        limiter()
+        _bump(CALLS)
+    set_call_limiter(limited_call)
+
+def _warm_lesson(topic: str, level: str, lesson_title: str):
+    from schemas.lesson import LessonContentRequest
+    from services.gemini_service import generate_lesson_content
+    from services.auth_service import save_shared_lesson
+
+    data = generate_lesson_content(LessonContentRequest(lesson_title=lesson_title, topic=topic, level=level))
+    # Same rule as /generate-lesson: a diagram that failed validation isn't cached
+    save_shared_lesson(lesson_title, topic, level, data.get("content_markdown", ""),
+                       data.get("mermaid_code", "") if data.get("mermaid_valid", True) else "",
+                       data.get("summary", ""))
+    _bump(LESSONS)
+
+def _warm_chapter_quizzes(topic: str, level: str, chapter, lesson_titles: List[str]):
+    from schemas.quiz import ChapterQuizRequest
+    from services.gemini_service import generate_chapter_quiz_content
+    from services.auth_service import save_shared_quizzes
+
+    quizzes = generate_chapter_quiz_content(ChapterQuizRequest(topic=topic, level=level, chapter=chapter), lesson_titles)
+    save_shared_quizzes(topic, level, quizzes)
+    _bump(QUIZZES, len(quizzes))
+
+def warm_topic(topic: str, level: str, daily_minutes: int) -> dict:
+    """Generate whatever a new course on this topic would still have to wait for."""
+    from schemas.syllabus import SyllabusRequest, Chapter
+    from services import auth_service as db
+    from services.gemini_service import generate_syllabus_content
+    from services.syllabus_index import find_matching_syllabus, index_syllabus, normalize_topic
+
+    # The syllabus /generate-syllabus would reuse for this intake, or a new one
+    syllabus_id = find_matching_syllabus(topic, level, daily_minutes)
+    stored = db.get_syllabus(syllabus_id) if syllabus_id else None
+    if stored:
+        title, chapters = stored["title"], stored["chapters"]
+        _bump(CACHED)
+    else:
+        data = generate_syllabus_content(SyllabusRequest(topic=topic, level=level, daily_minutes=daily_minutes))
+        title, chapters = data["title"], data["chapters"]
+        syllabus_id = str(uuid.uuid4())
+        db.save_syllabus(syllabus_id, topic, normalize_topic(topic), level, daily_minutes, title, chapters)
+        index_syllabus(syllabus_id, topic, level, daily_minutes)
+        _bump(SYLLABI)
+
+    chapters = [Chapter(id=str(chapter.get("id") or f"chap-{index + 1}"), title=chapter.get("title", ""),
+                        lessons=chapter.get("lessons", [])) for index, chapter in enumerate(chapters)]
+    lesson_titles = [lesson for chapter in chapters for lesson in chapter.lessons]
+    cached_lessons = db.get_shared_content_titles("lesson_bodies", topic, level, lesson_titles)
+    cached_quizzes = db.get_shared_content_titles("quiz_bodies", topic, level, lesson_titles)
+    _bump(CACHED, len(cached_lessons) + len(cached_quizzes))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=_threads, thread_name_prefix="warm") as pool:
+        jobs = {pool.submit(_warm_lesson, topic, level, lesson): f"lesson '{lesson}'"
+                for lesson in lesson_titles if lesson not in cached_lessons}
+        for chapter in chapters:
+            missing = [lesson for lesson in chapter.lessons if lesson not in cached_quizzes]
+            if missing:
+                jobs[pool.submit(_warm_chapter_quizzes, topic, level, chapter, missing)] = f"quizzes for '{chapter.title}'"
+        for future, label in jobs.items():
+            try:
+                future.result()
+            except Exception as e:
+                _bump(ERRORS)
+                errors.append(f"{label}: {e}")
+
+    return {"title": title, "lessons": len(lesson_titles), "errors": errors}
+
+# ============ DRIVER ============
+
+def read_topics(path: str, default_minutes: int) -> List[Tuple[str, str, int]]:
+    pairs = []
+    with open(path, encoding="utf-8") as source:
+        for number, line in enumerate(source, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            parts = [part.strip() for part in line.split(",")]
+            if len(parts) not in (2, 3) or not parts[0] or not parts[1]:
+                raise SystemExit(f"{path}:{number}: expected 'topic, level[, daily_minutes]'")
+            pairs.append((parts[0], parts[1], int(parts[2]) if len(parts) == 3 else default_minutes))
+    return pairs
+
+def _topic_key(topic: str, level: str, daily_minutes: int) -> str:
+    return f"{' '.join(topic.casefold().split())}|{level.casefold()}|{daily_minutes}"
+
+def _save_checkpoint(path: str, state: dict):
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as checkpoint:
+        json.dump(state, checkpoint, indent=2)
+    os.replace(temporary, path)
+
+def _report(counters, started: float, done: int, total: int):
+    values = dict(zip(COUNTERS, counters[:]))
+    elapsed = time.perf_counter() - started
+    print(f"📈 {done}/{total} topics | generated {values['syllabi']} syllabi, {values['lessons']} lessons, "
+          f"{values['quizzes']} quizzes | {values['cached']} already cached | {values['calls']} Gemini calls "
+          f"({values['calls'] / max(elapsed, 1e-9) * 60:.1f}/min) | {values['errors']} errors | {elapsed:.0f}s", flush=True)
+
+def run(pairs: List[Tuple[str, str, int]], processes: int, threads: int, per_minute: float,
+        checkpoint_path: str, restart: bool = False, report_every: float = 30.0) -> dict:
+    state = {"done": {}}
+    if not restart and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as checkpoint:
+            state = json.load(checkpoint)
+    pending = [pair for pair in pairs if _topic_key(*pair) not in state["done"]]
+    if len(pending) < len(pairs):
+        print(f"⏭️  Skipping {len(pairs) - len(pending)} topics finished in an earlier run")
+
+    # Spawned workers start clean (no inherited gRPC or database state)
+    context = multiprocessing.get_context("spawn")
+    counters = context.Array("q", len(COUNTERS))
+    next_slot = context.Value("d", 0.0, lock=False)
+    started = time.perf_counter()
+    last_report = started
+    done = 0
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker,
+                             initargs=(per_minute, next_slot, context.Lock(), counters, threads)) as pool:
+        futures = {pool.submit(warm_topic, *pair): pair for pair in pending}
+        while futures:
+            finished, _ = wait(futures, timeout=report_every, return_when=FIRST_COMPLETED)
+            for future in finished:
+                topic, level, daily_minutes = futures.pop(future)
+                done += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    with counters.get_lock():
+                        counters[ERRORS] += 1
+                    print(f"❌ {topic} ({level}): {e}")
+                    continue
+                if result["errors"]:
+                    # Left out of the checkpoint so the next run retries what failed
+                    print(f"⚠️ {topic} ({level}): {len(result['errors'])} failed, e.g. {result['errors'][0]}")
+                    continue
+                state["done"][_topic_key(topic, level, daily_minutes)] = {
+                    "title": result["title"], "lessons": result["lessons"], "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+                }
+                _save_checkpoint(checkpoint_path, state)
+                print(f"✅ {topic} ({level}): '{result['title']}', {result['lessons']} lessons warm")
+            if time.perf_counter() - last_report >= report_every:
+                _report(counters, started, done, len(pending))
+                last_report = time.perf_counter()
+
+    _report(counters, started, done, len(pending))
+    return dict(zip(COUNTERS, counters[:]))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m services.cache_warmer",
+                                     description="Pre-generate syllabi, lessons and quizzes for popular topics.")
+    parser.add_argument("topics", help="File with one 'topic, level[, daily_minutes]' per line")
+    parser.add_argument("--minutes", type=int, default=DEFAULT_DAILY_MINUTES, help="daily_minutes when a line omits it (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=2, help="Worker processes, each warming one topic at a time (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent generations per process (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=60, help="Gemini calls per minute across all workers, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--checkpoint", default="warm_cache_state.json", help="Records finished topics (default: %(default)s)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint; cached content is still skipped")
+    parser.add_argument("--report-every", type=float, default=30, help="Seconds between progress reports (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if not os.getenv("GEMINI_API_KEY"):
+        # Without a key the generators return demo content, which must not be cached
+        raise SystemExit("GEMINI_API_KEY is not set")
+    pairs = read_topics(args.topics, args.minutes)
+    totals = run(pairs, args.processes, args.threads, args.rate, args.checkpoint, args.restart, args.report_every)
+    sys.exit(1 if totals["errors"] else 0)
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    main()
@@ -0,0 +1,99 @@
+import os
+import time
+import threading
+from services.metrics_service import incr, set_gauge
+
+# Circuit breaker for the Gemini provider. After CIRCUIT_FAILURE_THRESHOLD
+# consecutive failures (errors, timeouts or calls slower than
+# CIRCUIT_SLOW_CALL_SECONDS) the circuit opens and calls fail fast for
+# CIRCUIT_OPEN_SECONDS. Then a single half-open probe is let through: if it
+# succeeds the circuit closes, otherwise it opens again.
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "45"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider that is currently failing."""
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is temporarily unavailable, please retry shortly")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float, slow_call_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._set_state(CLOSED)
+
+    def _set_state(self, state: str):
+        self.state = state
+        set_gauge(f"circuit.{self.name}.state", _STATE_GAUGE[state])
+
+    def _retry_after(self) -> int:
+        return max(1, int(self.opened_at + self.open_seconds - time.monotonic()) + 1)
+
+    def is_rejecting(self) -> bool:
+        """True while calls would be refused (open and not yet due for a probe)."""
+        with self.lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at < self.open_seconds
+            return self.state == HALF_OPEN and self.probe_in_flight
+
+    def check(self):
+        """Reject with CircuitOpenError without reserving a probe."""
+        if self.is_rejecting():
+            incr(f"circuit.{self.name}.rejected")
+            raise CircuitOpenError(self.name, self._retry_after())
+
+    def before_call(self):
+        """Call before each request; raises CircuitOpenError if the call must not go out."""
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if not self.probe_in_flight:
+                    self.probe_in_flight = True
+                    incr(f"circuit.{self.name}.probes")
+                    return
+            elif self.state == CLOSED:
+                return
+        incr(f"circuit.{self.name}.rejected")
+        raise CircuitOpenError(self.name, self._retry_after())
+
+    def record_success(self, duration: float):
+        if duration >= self.slow_call_seconds:
+            incr(f"circuit.{self.name}.slow_calls")
+            self.record_failure()
+            return
+        with self.lock:
+            self.failures = 0
+            self.probe_in_flight = False
+            if self.state != CLOSED:
+                print(f"✅ Circuit '{self.name}' closed")
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    print(f"⚠️ Circuit '{self.name}' opened after {self.failures} failures")
+                    incr(f"circuit.{self.name}.opened")
+                self.probe_in_flight = False
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+gemini_breaker = CircuitBreaker("gemini", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_SLOW_CALL_SECONDS)
@@ -0,0 +1,346 @@
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import sqlite3
+import subprocess
+from typing import Iterator, List, Optional, Tuple
+
+# Streaming copy of the application tables between backends:
+#
+#   python -m services.db_copy SOURCE TARGET [--tables users,lessons] [--chunk-size 5000]
+#
+# SOURCE and TARGET are each "sqlite:PATH", a "postgresql://..." URL, or
+# "ndjson:DIRECTORY" (one <table>.ndjson file per table). Tables are read in
+# primary-key order, one chunk at a time, and written with batched inserts
+# (COPY through a staging table on Postgres), so memory use does not grow with
+# table size. Progress is checkpointed to a state file after every chunk; an
+# interrupted copy resumes from the last checkpoint when run again. Rows that
+# already exist in a database target are skipped, never overwritten.
+
+# (table, primary key) in copy order
+TABLES = [
+    ("users", "id"),
+    ("verification_codes", "email"),
+    ("sessions", "token"),
+    ("user_courses", "id"),
+    ("syllabi", "id"),
+    ("lesson_bodies", "content_key"),
+    ("lessons", "id"),
+    ("quizzes", "id"),
+    ("quiz_bodies", "content_key"),
+    ("diagram_bodies", "content_key"),
+    ("user_notes", "id"),
+    ("user_activity", "id"),
+    ("email_outbox", "id"),
+]
+# Tables derived from the copied ones are rebuilt on a database target instead:
+# (auth_service function, report, rebuilt even with --skip-search-rebuild)
+DERIVED = [
+    ("rebuild_lesson_sections", "📑 Rebuilt lesson sections: {} lessons", True),
+    ("rebuild_activity_rollups", "📊 Rebuilt activity rollups: {} users", True),
+    ("rebuild_leaderboard", "🏆 Rebuilt leaderboard scores: {} users", True),
+    ("rebuild_search_index", "🔎 Rebuilt search index: {} documents", False),
+]
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+# ============ ENDPOINTS ============
+
+class SQLiteEndpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def env(self) -> dict:
+        return {"SQLITE_PATH": self.path}
+
+    def open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+
+    def columns(self, table: str) -> List[str]:
+        return [row['name'] for row in self.conn.execute(f'PRAGMA table_info({table})')]
+
+    def read_chunks(self, table: str, key: str, columns: List[str], after, chunk_size: int) -> Iterator[Tuple[list, object]]:
+        while True:
+            query = f'SELECT {", ".join(columns)} FROM {table}'
+            params: tuple = ()
+            if after is not None:
+                query += f' WHERE {key} > ?'
+                params = (after,)
+            rows = [dict(row) for row in self.conn.execute(f'{query} ORDER BY {key} LIMIT ?', (*params, chunk_size))]
+            if not rows:
+                return
+            after = rows[-1][key]
+            yield rows, after
+
+    def write_chunk(self, table: str, columns: List[str], rows: list):
+        placeholders = ", ".join("?" * len(columns))
+        with self.conn:
+            self.conn.executemany(
+                f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) VALUES ({placeholders})',
+                [tuple(row.get(column) for column in columns) for row in rows]
+            )
+
+    def finish_table(self, table: str):
+        pass
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+class PostgresEndpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.conn = None
+
+    def env(self) -> dict:
+        return {"DATABASE_URL": self.url}
+
+    def open(self):
+        import psycopg2
+        from psycopg2.extras import RealDictCursor
+        self.conn = psycopg2.connect(self.url, cursor_factory=RealDictCursor)
+
+    def columns(self, table: str) -> List[str]:
+        with self.conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = %s
+                ORDER BY ordinal_position
+            ''', (table,))
+            return [row['column_name'] for row in cursor.fetchall()]
+
+    def read_chunks(self, table: str, key: str, columns: List[str], after, chunk_size: int) -> Iterator[Tuple[list, object]]:
+        while True:
+            with self.conn.cursor() as cursor:
+                query = f'SELECT {", ".join(columns)} FROM {table}'
+                params: tuple = ()
+                if after is not None:
+                    query += f' WHERE {key} > %s'
+                    params = (after,)
+                cursor.execute(f'{query} ORDER BY {key} LIMIT %s', (*params, chunk_size))
+                rows = [dict(row) for row in cursor.fetchall()]
+            self.conn.rollback()
+            if not rows:
+                return
+            after = rows[-1][key]
+            yield rows, after
+
+    def write_chunk(self, table: str, columns: List[str], rows: list):
+        # COPY into a staging table, then insert what isn't there yet
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(_copy_text(row.get(column)) for column in columns) + "\n")
+        buffer.seek(0)
+        column_list = ", ".join(columns)
+        with self.conn.cursor() as cursor:
+            cursor.execute(f'CREATE TEMP TABLE IF NOT EXISTS _copy_{table} (LIKE {table}) ON COMMIT DELETE ROWS')
+            cursor.copy_expert(f'COPY _copy_{table} ({column_list}) FROM STDIN', buffer)
+            cursor.execute(f'''
+                INSERT INTO {table} ({column_list}) SELECT {column_list} FROM _copy_{table}
+                ON CONFLICT DO NOTHING
+            ''')
+        self.conn.commit()
+
+    def finish_table(self, table: str):
+        # Explicit ids were copied into SERIAL columns; move the sequences past them
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id') AS sequence", (table,))
+            row = cursor.fetchone()
+            if row and row['sequence']:
+                cursor.execute(f"SELECT setval(%s, COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)", (row['sequence'],))
+        self.conn.commit()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+class NDJSONEndpoint:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = {}
+
+    def env(self) -> Optional[dict]:
+        return None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, table: str) -> str:
+        return os.path.join(self.directory, f"{table}.ndjson")
+
+    def columns(self, table: str) -> List[str]:
+        if not os.path.exists(self.path(table)):
+            return []
+        with open(self.path(table), "rb") as source:
+            first = source.readline()
+        return list(json.loads(first)) if first.strip() else []
+
+    def read_chunks(self, table: str, key: str, columns: List[str], after, chunk_size: int) -> Iterator[Tuple[list, object]]:
+        # For NDJSON the resume position is a byte offset rather than a key
+        with open(self.path(table), "rb") as source:
+            source.seek(after or 0)
+            while True:
+                rows = []
+                for line in source:
+                    if line.strip():
+                        rows.append(json.loads(line))
+                    if len(rows) >= chunk_size:
+                        break
+                if not rows:
+                    return
+                yield rows, source.tell()
+
+    def resume_at(self, table: str, offset: Optional[int]):
+        """Drop anything written after the last checkpoint."""
+        mode = "r+b" if offset and os.path.exists(self.path(table)) else "wb"
+        target = open(self.path(table), mode)
+        if offset:
+            target.truncate(offset)
+            target.seek(offset)
+        self.files[table] = target
+
+    def write_chunk(self, table: str, columns: List[str], rows: list) -> int:
+        target = self.files[table]
+        for row in rows:
+            target.write(json.dumps({column: row.get(column) for column in columns}, ensure_ascii=False).encode("utf-8") + b"\n")
+        target.flush()
+        os.fsync(target.fileno())
+        return target.tell()
+
+    def finish_table(self, table: str):
+        self.files.pop(table).close()
+
+    def close(self):
+        for target in self.files.values():
+            target.close()
+
+def _copy_text(value) -> str:
+    """A value in Postgres COPY text format."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def open_endpoint(spec: str):
+    if spec.startswith("postgresql://") or spec.startswith("postgres://"):
+        return PostgresEndpoint(spec)
+    if spec.startswith("sqlite:"):
+        return SQLiteEndpoint(spec[len("sqlite:"):])
+    if spec.startswith("ndjson:"):
+        return NDJSONEndpoint(spec[len("ndjson:"):])
+    raise ValueError(f"Unknown endpoint {spec!r}; use sqlite:PATH, postgresql://... or ndjson:DIRECTORY")
+
+def _run_with_backend(endpoint, code: str) -> str:
+    """Run Python in a child process whose auth_service points at the endpoint's database."""
+    env = dict(os.environ, SQLITE_CONCURRENT="false", TRACING_ENABLED="false")
+    env.pop("DATABASE_URL", None)
+    env.update(endpoint.env())
+    return subprocess.run([sys.executable, "-c", code], env=env, cwd=BACKEND_DIR,
+                          capture_output=True, text=True, check=True).stdout
+
+# ============ COPY ============
+
+def _load_state(path: str, source: str, target: str, restart: bool) -> dict:
+    if restart or not os.path.exists(path):
+        return {"source": source, "target": target, "tables": {}}
+    with open(path, encoding="utf-8") as state_file:
+        state = json.load(state_file)
+    if state.get("source") != source or state.get("target") != target:
+        raise SystemExit(f"{path} belongs to a copy from {state.get('source')} to {state.get('target')}; pass --restart or --state")
+    return state
+
+def _save_state(path: str, state: dict):
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary, path)
+
+def copy_tables(source_spec: str, target_spec: str, tables: List[Tuple[str, str]], chunk_size: int,
+                state_path: str, restart: bool = False, rebuild_search: bool = True):
+    source, target = open_endpoint(source_spec), open_endpoint(target_spec)
+    state = _load_state(state_path, source_spec, target_spec, restart)
+
+    if target.env() is not None:
+        # Let the application create (or migrate) the target schema
+        _run_with_backend(target, "import services.auth_service")
+
+    source.open()
+    target.open()
+    try:
+        for table, key in tables:
+            progress = state["tables"].setdefault(table, {"after": None, "rows": 0, "done": False})
+            if progress["done"]:
+                print(f"⏭️  {table}: already copied ({progress['rows']} rows)")
+                continue
+
+            columns = source.columns(table)
+            if not columns:
+                print(f"⏭️  {table}: nothing to copy in source")
+                progress["done"] = True
+                _save_state(state_path, state)
+                continue
+            target_columns = target.columns(table) if target.env() is not None else columns
+            skipped = [column for column in columns if column not in target_columns]
+            if skipped:
+                print(f"⚠️ {table}: target has no column(s) {', '.join(skipped)}; they are not copied")
+            columns = [column for column in columns if column in target_columns]
+
+            if isinstance(target, NDJSONEndpoint):
+                target.resume_at(table, progress.get("target_offset"))
+
+            started = time.perf_counter()
+            copied = 0
+            for rows, after in source.read_chunks(table, key, columns, progress["after"], chunk_size):
+                position = target.write_chunk(table, columns, rows)
+                copied += len(rows)
+                progress.update(after=after, rows=progress["rows"] + len(rows))
+                if position is not None:
+                    progress["target_offset"] = position
+                _save_state(state_path, state)
+                rate = copied / max(time.perf_counter() - started, 1e-9)
+                print(f"\r📦 {table}: {progress['rows']} rows ({rate:.0f} rows/s)", end="", flush=True)
+            target.finish_table(table)
+            progress["done"] = True
+            _save_state(state_path, state)
+            print(f"\r✅ {table}: {progress['rows']} rows in {time.perf_counter() - started:.1f}s" + " " * 20)
+    finally:
+        source.close()
+        target.close()
+
+    if target.env() is None:
+        return
+    for function, label, always in DERIVED:
+        if always or rebuild_search:
+            output = _run_with_backend(target, f"from services.auth_service import {function}; print({function}())")
+            print(label.format(output.strip().splitlines()[-1]))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m services.db_copy", description="Stream tables between SQLite, Postgres and NDJSON.")
+    parser.add_argument("source", help="sqlite:PATH, postgresql://... or ndjson:DIRECTORY")
+    parser.add_argument("target", help="sqlite:PATH, postgresql://... or ndjson:DIRECTORY")
+    parser.add_argument("--tables", help="Comma-separated subset of: " + ", ".join(table for table, _ in TABLES))
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--state", default="db_copy_state.json", help="Checkpoint file used to resume (default: %(default)s)")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint and start over")
+    parser.add_argument("--skip-search-rebuild", action="store_true", help="Don't rebuild the search index on a database target")
+    args = parser.parse_args(argv)
+
+    tables = TABLES
+    if args.tables:
+        wanted = [name.strip() for name in args.tables.split(",")]
+        unknown = [name for name in wanted if name not in dict(TABLES)]
+        if unknown:
+            parser.error(f"unknown tables: {', '.join(unknown)}")
+        tables = [(table, key) for table, key in TABLES if table in wanted]
+
+    copy_tables(args.source, args.target, tables, args.chunk_size, args.state, args.restart, not args.skip_search_rebuild)
+    if os.path.exists(args.state):
+        os.remove(args.state)
+
+if __name__ == "__main__":
+    main()
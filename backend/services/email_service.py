@@ -0,0 +1,209 @@
+import os
+import json
+import smtplib
+import threading
+import urllib.request
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import List, Optional
+from services.auth_service import (
+    claim_pending_emails,
+    mark_email_sent,
+    mark_email_failed,
+    count_pending_emails
+)
+from services.metrics_service import incr, set_gauge
+
+# Background delivery for the email outbox. Requests only insert a row into
+# email_outbox (see auth_service.queue_email); this worker drains it in
+# batches with a single long-lived transport and retries with backoff.
+
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "20"))
+EMAIL_POLL_INTERVAL = float(os.getenv("EMAIL_POLL_INTERVAL", "2"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_BACKOFF_BASE_SECONDS = float(os.getenv("EMAIL_BACKOFF_BASE_SECONDS", "5"))
+EMAIL_BACKOFF_MAX_SECONDS = float(os.getenv("EMAIL_BACKOFF_MAX_SECONDS", "900"))
+
+SENDER = {"name": "InfiniteTutor", "email": os.getenv("EMAIL_FROM", "noreply@infinitetutor.app")}
+
+class ConsoleTransport:
+    """Prints emails to stdout. Used in development when nothing else is configured."""
+
+    def send_batch(self, emails: List[dict]) -> List[Optional[str]]:
+        for email in emails:
+            print(f"\n{'='*50}")
+            print(f"📧 EMAIL TO {email['recipient']}: {email['subject']}")
+            print(f"   {email['text_content']}")
+            print(f"{'='*50}\n")
+        return [None] * len(emails)
+
+class BrevoTransport:
+    """Sends through the Brevo (Sendinblue) API, reusing one client and its connection pool."""
+
+    def __init__(self, api_key: str):
+        import sib_api_v3_sdk
+        self.sdk = sib_api_v3_sdk
+        configuration = sib_api_v3_sdk.Configuration()
+        configuration.api_key['api-key'] = api_key
+        self.api = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
+
+    def send_batch(self, emails: List[dict]) -> List[Optional[str]]:
+        errors = []
+        for email in emails:
+            try:
+                self.api.send_transac_email(self.sdk.SendSmtpEmail(
+                    to=[{"email": email['recipient']}],
+                    sender=SENDER,
+                    subject=email['subject'],
+                    html_content=email['html_content'],
+                    text_content=email['text_content'] or None
+                ))
+                errors.append(None)
+            except Exception as e:
+                errors.append(str(e))
+        return errors
+
+class SmtpTransport:
+    """Sends over SMTP, one connection per batch. Point it at a local server for testing."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.username = os.getenv("SMTP_USERNAME")
+        self.password = os.getenv("SMTP_PASSWORD")
+        self.starttls = os.getenv("SMTP_STARTTLS", "false").lower() == "true"
+
+    def send_batch(self, emails: List[dict]) -> List[Optional[str]]:
+        try:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+        except Exception as e:
+            return [str(e)] * len(emails)
+
+        errors = []
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password or "")
+            for email in emails:
+                message = EmailMessage()
+                message["From"] = f"{SENDER['name']} <{SENDER['email']}>"
+                message["To"] = email['recipient']
+                message["Subject"] = email['subject']
+                message.set_content(email['text_content'] or "")
+                message.add_alternative(email['html_content'], subtype="html")
+                try:
+                    server.send_message(message)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(str(e))
+        except Exception as e:
+            errors.extend([str(e)] * (len(emails) - len(errors)))
+        finally:
+            try:
+                server.quit()
+            except Exception:
+                pass
+        return errors
+
+class HttpTransport:
+    """POSTs the whole batch as JSON to EMAIL_HTTP_URL (e.g. a local stub or relay)."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def send_batch(self, emails: List[dict]) -> List[Optional[str]]:
+        body = json.dumps({
+            "sender": SENDER,
+            "emails": [
+                {
+                    "to": email['recipient'],
+                    "subject": email['subject'],
+                    "html_content": email['html_content'],
+                    "text_content": email['text_content']
+                } for email in emails
+            ]
+        }).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            return [None] * len(emails)
+        except Exception as e:
+            return [str(e)] * len(emails)
+
+def get_transport():
+    """Pick a transport from EMAIL_TRANSPORT, or infer it from what is configured."""
+    transport = os.getenv("EMAIL_TRANSPORT", "").lower()
+    brevo_api_key = os.getenv("BREVO_API_KEY")
+    smtp_host = os.getenv("SMTP_HOST")
+    http_url = os.getenv("EMAIL_HTTP_URL")
+
+    if transport == "brevo" or (not transport and brevo_api_key):
+        return BrevoTransport(brevo_api_key or "")
+    if transport == "smtp" or (not transport and smtp_host):
+        return SmtpTransport(smtp_host or "localhost", int(os.getenv("SMTP_PORT", "1025")))
+    if transport == "http" or (not transport and http_url):
+        return HttpTransport(http_url or "http://localhost:8025/send")
+    return ConsoleTransport()
+
+def backoff_delay(attempts: int) -> timedelta:
+    """Exponential backoff for the given number of previous attempts."""
+    return timedelta(seconds=min(EMAIL_BACKOFF_MAX_SECONDS, EMAIL_BACKOFF_BASE_SECONDS * (2 ** attempts)))
+
+def deliver_pending(transport, batch_size: int = EMAIL_BATCH_SIZE) -> int:
+    """Send one batch of due emails. Returns how many were claimed."""
+    emails = claim_pending_emails(batch_size)
+    if not emails:
+        return 0
+
+    errors = transport.send_batch(emails)
+    for email, error in zip(emails, errors):
+        if error is None:
+            mark_email_sent(email['id'])
+            incr("email.sent")
+            continue
+
+        attempts = email['attempts'] + 1
+        if attempts >= EMAIL_MAX_ATTEMPTS:
+            print(f"❌ Giving up on email to {email['recipient']}: {error}")
+            mark_email_failed(email['id'], error, None)
+            incr("email.failed")
+        else:
+            mark_email_failed(email['id'], error, datetime.now() + backoff_delay(attempts))
+            incr("email.retried")
+
+    incr("email.batches")
+    return len(emails)
+
+_stop_event = threading.Event()
+_worker: Optional[threading.Thread] = None
+
+def _worker_loop():
+    transport = get_transport()
+    print(f"📮 Email outbox worker started ({type(transport).__name__})")
+    while not _stop_event.is_set():
+        try:
+            claimed = deliver_pending(transport)
+            set_gauge("email.pending", count_pending_emails())
+        except Exception as e:
+            print(f"❌ Email outbox worker error: {e}")
+            claimed = 0
+        # Keep draining while there is a backlog, otherwise wait for the next poll
+        if claimed < EMAIL_BATCH_SIZE:
+            _stop_event.wait(EMAIL_POLL_INTERVAL)
+
+def start_email_worker() -> None:
+    """Start the background outbox worker (idempotent)."""
+    global _worker
+    if _worker and _worker.is_alive():
+        return
+    _stop_event.clear()
+    _worker = threading.Thread(target=_worker_loop, name="email-outbox", daemon=True)
+    _worker.start()
+
+def stop_email_worker(timeout: float = 5) -> None:
+    """Ask the worker to stop and wait briefly for it."""
+    _stop_event.set()
+    if _worker:
+        _worker.join(timeout)
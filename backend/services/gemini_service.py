@@ -1,12 +1,144 @@
 import os
-import json
+import time
 import google.generativeai as genai
-from typing import Dict, Any
+from typing import Dict, Any, List
 from schemas.syllabus import SyllabusRequest
-from schemas.quiz import QuizRequest
-from schemas.lesson import LessonContentRequest
+from schemas.quiz import QuizRequest, ChapterQuizRequest
+from schemas.lesson import LessonContentRequest, LessonRegenerateRequest
 from schemas.diagram import DiagramRequest
+from services.json_repair import parse_model_json, ModelJSONError
+from services.metrics_service import incr, observe
+from services.tracing_service import span, traced
+from services.circuit_breaker import gemini_breaker
+from services.mermaid_validator import check_mermaid
+from services.lesson_sections import LessonSection
 
+JSON_CONFIG = genai.GenerationConfig(response_mime_type="application/json")
+
+# Per-call deadlines in seconds, by kind of generation
+GEMINI_TIMEOUTS = {
+    "syllabus": float(os.getenv("GEMINI_TIMEOUT_SYLLABUS", "45")),
+    "quiz": float(os.getenv("GEMINI_TIMEOUT_QUIZ", "45")),
+    "chapter_quiz": float(os.getenv("GEMINI_TIMEOUT_CHAPTER_QUIZ", "90")),
+    "diagram": float(os.getenv("GEMINI_TIMEOUT_DIAGRAM", "30")),
+    "lesson": float(os.getenv("GEMINI_TIMEOUT_LESSON", "60")),
+    "lesson_part": float(os.getenv("GEMINI_TIMEOUT_LESSON_PART", "30")),
+    "suggestions": float(os.getenv("GEMINI_TIMEOUT_SUGGESTIONS", "15")),
+}
+
+# Called before every Gemini request when set, e.g. the cache warmer's global rate limit
+_call_limiter = None
+
+def set_call_limiter(limiter) -> None:
+    """Install a callable that blocks until the next Gemini call may be made (None removes it)."""
+    global _call_limiter
+    _call_limiter = limiter
+
+def call_model(model, prompt: str, kind: str) -> str:
+    """Make one Gemini call with the kind's timeout, guarded by the circuit breaker."""
+    if _call_limiter:
+        _call_limiter()
+    gemini_breaker.before_call()
+    started = time.perf_counter()
+    with span("llm.generate_content", kind=kind, prompt_chars=len(prompt)) as current:
+        try:
+            response = model.generate_content(
+                prompt,
+                generation_config=JSON_CONFIG,
+                request_options={"timeout": GEMINI_TIMEOUTS[kind]}
+            )
+            text = response.text
+        except Exception:
+            gemini_breaker.record_failure()
+            incr(f"llm.errors.{kind}")
+            raise
+        if current:
+            current.set_attribute("response_chars", len(text))
+    duration = time.perf_counter() - started
+    observe(f"llm.call_ms.{kind}", duration * 1000)
+    gemini_breaker.record_success(duration)
+    return text
+
+def generate_json(model, prompt: str, required_fields: List[str], kind: str) -> Dict[str, Any]:
+    """Call the model and parse its JSON, repairing defects instead of failing outright.
+
+    Fields that could not be recovered, or were cut short (a truncated questions
+    array), are regenerated in one follow-up call that asks only for them, rather
+    than repeating the whole generation.
+    """
+    text = call_model(model, prompt, kind)
+    with span("llm.parse_json") as current:
+        data, status, incomplete = parse_model_json(text)
+        if current:
+            current.set_attribute("status", status)
+    incr(f"llm_json.{status}")
+    if not isinstance(data, dict):
+        raise ModelJSONError("Model response is not a JSON object")
+    
+    missing = [field for field in required_fields if field not in data or field in incomplete]
+    if not missing:
+        return data
+    
+    print(f"🩹 Regenerating missing fields: {', '.join(missing)}")
+    incr("llm_json.field_retries")
+    for field in missing:
+        # A truncated value must not be cached as if it were whole
+        data.pop(field, None)
+    data.update(regenerate_fields(model, prompt, missing, kind))
+    
+    still_missing = [field for field in required_fields if field not in data]
+    if still_missing:
+        incr("llm_json.failed")
+        raise ModelJSONError(f"Model response is missing fields: {', '.join(still_missing)}")
+    incr("llm_json.field_recovered")
+    return data
+
+def regenerate_fields(model, prompt: str, fields: List[str], kind: str, hint: str = "") -> Dict[str, Any]:
+    """Ask the model again for just the given fields; returns whichever it produced."""
+    retry_prompt = f"""{prompt}
+    {hint}
+    IMPORTANT: Return ONLY a valid JSON object containing exactly these fields: {", ".join(fields)}.
+    """
+    text = call_model(model, retry_prompt, kind)
+    with span("llm.parse_json"):
+        try:
+            retry_data, _, incomplete = parse_model_json(text)
+        except ModelJSONError:
+            retry_data, incomplete = {}, set()
+    if not isinstance(retry_data, dict):
+        return {}
+    return {field: retry_data[field] for field in fields if field in retry_data and field not in incomplete}
+
+def ensure_valid_mermaid(model, prompt: str, data: Dict[str, Any], kind: str) -> Dict[str, Any]:
+    """Validate and repair data["mermaid_code"], regenerating it once if it is beyond repair.
+
+    Sets data["mermaid_valid"] so callers can avoid caching a diagram that won't render.
+    """
+    check = check_mermaid(data.get("mermaid_code", ""))
+    if not check.valid:
+        print(f"🩹 Regenerating invalid Mermaid diagram: {'; '.join(check.errors)}")
+        incr("mermaid.regenerated")
+        hint = f"The previous mermaid_code did not parse ({'; '.join(check.errors)}). Use only plain labels without brackets or quotes inside them."
+        try:
+            retry = regenerate_fields(model, prompt, ["mermaid_code"], kind, hint)
+        except Exception as e:
+            # The rest of the content is fine; don't lose it over the diagram
+            print(f"⚠️ Mermaid regeneration failed: {e}")
+            retry = {}
+        if "mermaid_code" in retry:
+            retry_check = check_mermaid(retry["mermaid_code"])
+            if retry_check.valid:
+                check = retry_check
+    
+    if check.valid:
+        incr("mermaid.repaired" if check.repaired else "mermaid.valid")
+    else:
+        incr("mermaid.invalid")
+    data["mermaid_code"] = check.code
+    data["mermaid_valid"] = check.valid
+    return data
+
+@traced
 def generate_syllabus_content(request: SyllabusRequest) -> Dict[str, Any]:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
@@ -47,15 +179,9 @@ def generate_syllabus_content(request: SyllabusRequest) -> Dict[str, Any]:
     }}
     """
 
-    response = model.generate_content(
-        prompt,
-        generation_config=genai.GenerationConfig(
-            response_mime_type="application/json"
-        )
-    )
-    
-    return json.loads(response.text)
+    return generate_json(model, prompt, ["title", "chapters"], "syllabus")
 
+@traced
 def generate_quiz_content(request: QuizRequest) -> Dict[str, Any]:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
@@ -93,15 +219,75 @@ def generate_quiz_content(request: QuizRequest) -> Dict[str, Any]:
     }}
     """
 
-    response = model.generate_content(
-        prompt,
-        generation_config=genai.GenerationConfig(
-            response_mime_type="application/json"
-        )
-    )
+    return generate_json(model, prompt, ["questions"], "quiz")
+
+# Lessons per Gemini call when generating a whole chapter's quizzes
+QUIZ_BATCH_SIZE = int(os.getenv("QUIZ_BATCH_SIZE", "5"))
+
+@traced
+def generate_chapter_quiz_content(request: ChapterQuizRequest, lesson_titles: List[str]) -> List[Dict[str, Any]]:
+    """Generate quizzes for several lessons of a chapter, QUIZ_BATCH_SIZE lessons per call."""
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return [
+            generate_quiz_content(QuizRequest(lesson_title=title, topic=request.topic, level=request.level))
+            for title in lesson_titles
+        ]
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    
+    quizzes = []
+    for start in range(0, len(lesson_titles), QUIZ_BATCH_SIZE):
+        chunk = lesson_titles[start:start + QUIZ_BATCH_SIZE]
+        lessons_str = "\n".join(f"- {title}" for title in chunk)
+        
+        prompt = f"""
+    Generate quizzes for the following lessons from the chapter '{request.chapter.title}'
+    of a course on '{request.topic}' at the '{request.level}' level:
+    {lessons_str}
     
-    return json.loads(response.text)
+    For EACH lesson, generate exactly 6 multiple choice questions about that lesson.
+    Each question must have exactly 4 options labeled A, B, C, and D.
+    Return one quiz per lesson, in the same order, using the exact lesson titles given above.
+    
+    Return the response ONLY in a valid JSON format matching this structure:
+    {{
+        "quizzes": [
+            {{
+                "lesson_title": "Exact lesson title",
+                "questions": [
+                    {{
+                        "question": "The question text?",
+                        "options": ["A. First option", "B. Second option", "C. Third option", "D. Fourth option"],
+                        "correct_answer": "A. First option",
+                        "explanation": "Brief explanation of why this is correct."
+                    }}
+                ]
+            }}
+        ]
+    }}
+    """
+
+        generated = generate_json(model, prompt, ["quizzes"], "chapter_quiz")["quizzes"]
+        # Anything that isn't a quiz object is dropped; its lessons get the single-lesson call below
+        generated = [quiz for quiz in generated if isinstance(quiz, dict)] if isinstance(generated, list) else []
+        by_title = {quiz.get("lesson_title"): quiz for quiz in generated}
+        # Positions only line up when the model returned one quiz per lesson
+        positional = len(generated) == len(chunk)
+        for index, title in enumerate(chunk):
+            quiz = by_title.get(title)
+            if quiz is None and positional and generated[index].get("lesson_title") not in chunk:
+                # The model renamed this lesson; the quiz in its slot isn't another lesson's
+                quiz = generated[index]
+            if not quiz or not isinstance(quiz.get("questions"), list) or not quiz["questions"]:
+                # Missing from the batch: fall back to a single-lesson call
+                quiz = generate_quiz_content(QuizRequest(lesson_title=title, topic=request.topic, level=request.level))
+            quizzes.append({"lesson_title": title, "questions": quiz["questions"]})
+    
+    return quizzes
 
+@traced
 def generate_diagram_content(request: DiagramRequest) -> Dict[str, Any]:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
@@ -128,15 +314,10 @@ def generate_diagram_content(request: DiagramRequest) -> Dict[str, Any]:
     }}
     """
 
-    response = model.generate_content(
-        prompt,
-        generation_config=genai.GenerationConfig(
-            response_mime_type="application/json"
-        )
-    )
-    
-    return json.loads(response.text)
+    data = generate_json(model, prompt, ["mermaid_code", "explanation"], "diagram")
+    return ensure_valid_mermaid(model, prompt, data, "diagram")
 
+@traced
 def generate_lesson_content(request: LessonContentRequest) -> Dict[str, Any]:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
@@ -180,15 +361,113 @@ def generate_lesson_content(request: LessonContentRequest) -> Dict[str, Any]:
     }}
     """
 
-    response = model.generate_content(
-        prompt,
-        generation_config=genai.GenerationConfig(
-            response_mime_type="application/json"
+    data = generate_json(model, prompt, ["content_markdown", "mermaid_code", "image_prompt", "summary"], "lesson")
+    return ensure_valid_mermaid(model, prompt, data, "lesson")
+
+def _replace_section_text(section: LessonSection, text: str) -> str:
+    """New markdown for a section: its original heading line, the new text, and its original trailing whitespace."""
+    original = section.content_markdown
+    trailing = original[len(original.rstrip()):]
+    text = text.strip()
+    if not section.level:
+        return text + trailing
+    heading_line = original.splitlines()[0]
+    if text.startswith("#"):
+        # The model repeated (or renamed) the heading; the stored one is kept
+        text = text.split("\n", 1)[1].strip() if "\n" in text else ""
+    return f"{heading_line}\n\n{text}{trailing}"
+
+@traced
+def regenerate_lesson_part_content(request: LessonRegenerateRequest, lesson: Dict[str, Any],
+                                   sections: List[LessonSection]) -> Dict[str, Any]:
+    """Regenerate one section, the mindmap or the summary of a stored lesson.
+
+    The rest of the lesson is sent as context and only the replaced part is
+    generated, so this costs a fraction of the output tokens (and latency) of
+    generate_lesson_content. Returns {"content_markdown"} for a section (the
+    full section, heading included), {"mermaid_code", "mermaid_valid"} for the
+    mindmap or {"summary"}.
+    """
+    feedback = f"The learner's feedback on the current version: {request.feedback}" if request.feedback else ""
+    section = sections[request.section_index] if request.part == "section" else None
+    
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        if section is not None:
+            return {"content_markdown": _replace_section_text(section, f"This is a demo rewrite of this part of {request.lesson_title}.")}
+        if request.part == "mindmap":
+            return {"mermaid_code": f"mindmap\n  root(({request.lesson_title}))\n    Key Ideas\n    Practice", "mermaid_valid": True}
+        return {"summary": f"You've learned the essentials of {request.lesson_title}."}
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('gemini-2.0-flash')
+    
+    if section is not None:
+        marked = "".join(
+            f"<<<SECTION TO REWRITE>>>\n{part.content_markdown}<<<END SECTION>>>\n" if index == request.section_index
+            else part.content_markdown
+            for index, part in enumerate(sections)
         )
-    )
+        prompt = f"""
+    Below is a lesson on '{request.lesson_title}' from a course on '{request.topic}' at the '{request.level}' level.
+    Rewrite ONLY the section between <<<SECTION TO REWRITE>>> and <<<END SECTION>>>, covering the same ground
+    in a fresh way that fits with the sections around it. {feedback}
+    Do not change the section's heading and do not add headings of the same or a higher level.
     
-    return json.loads(response.text)
+    {marked}
+    
+    Return the response ONLY in a valid JSON format matching this structure:
+    {{
+        "content_markdown": "The rewritten section in Markdown"
+    }}
+    """
+        data = generate_json(model, prompt, ["content_markdown"], "lesson_part")
+        return {"content_markdown": _replace_section_text(section, str(data["content_markdown"]))}
+    
+    if request.part == "mindmap":
+        prompt = f"""
+    Below is a lesson on '{request.lesson_title}' from a course on '{request.topic}' at the '{request.level}' level.
+    Create a new Mermaid.js MINDMAP diagram (NOT flowchart) of its main concepts to replace the current one. {feedback}
+       - Use the mindmap syntax: mindmap
+         root((Main Topic))
+           Branch1
+             Leaf1
+       - Keep labels SHORT (max 3-4 words)
+       - Use emojis to make it visual (📚 🎯 💡 🔑 ⚡ 🌟 etc.)
+       - Maximum 4 main branches, 2-3 leaves per branch
+    
+    Current mindmap:
+    {lesson.get("mermaid_code") or "(none)"}
+    
+    Lesson:
+    {lesson["content_markdown"]}
+    
+    Return the response ONLY in a valid JSON format matching this structure:
+    {{
+        "mermaid_code": "mindmap\\n  root((Topic))\\n    Branch1\\n      Leaf1"
+    }}
+    """
+        data = generate_json(model, prompt, ["mermaid_code"], "lesson_part")
+        return ensure_valid_mermaid(model, prompt, {"mermaid_code": data["mermaid_code"]}, "lesson_part")
+    
+    prompt = f"""
+    Below is a lesson on '{request.lesson_title}' from a course on '{request.topic}' at the '{request.level}' level.
+    Write a new 1-sentence summary of it. {feedback}
+    
+    Current summary: {lesson.get("explanation") or "(none)"}
+    
+    Lesson:
+    {lesson["content_markdown"]}
+    
+    Return the response ONLY in a valid JSON format matching this structure:
+    {{
+        "summary": "Summary here."
+    }}
+    """
+    data = generate_json(model, prompt, ["summary"], "lesson_part")
+    return {"summary": str(data["summary"])}
 
+@traced
 def generate_course_suggestions(user_topics: list) -> list:
     """Generate 3 course suggestions based on user's learning history."""
     api_key = os.getenv("GEMINI_API_KEY")
@@ -221,12 +500,5 @@ def generate_course_suggestions(user_topics: list) -> list:
     }}
     """
     
-    response = model.generate_content(
-        prompt,
-        generation_config=genai.GenerationConfig(
-            response_mime_type="application/json"
-        )
-    )
-    
-    data = json.loads(response.text)
+    data = generate_json(model, prompt, ["suggestions"], "suggestions")
     return data.get("suggestions", [])[:3]
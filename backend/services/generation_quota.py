@@ -0,0 +1,254 @@
+import os
+import math
+import time
+import threading
+from contextvars import ContextVar
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Per-caller quotas on the generation endpoints, as token buckets: verified
+# users are limited by account, everyone else by IP address, and all requests
+# from one address also share a "network" bucket, so minting new accounts
+# doesn't buy more than that. Each bucket holds up to BURST tokens and refills
+# at PER_HOUR tokens an hour. A generation request takes one token from each
+# of its buckets up front, and every further Gemini call it makes (the
+# missing parts of a lesson bundle) takes another; a caller with none left
+# gets 429.
+#
+# Checks are an in-memory dict lookup. Every GENERATION_QUOTA_SYNC_SECONDS a
+# background thread pushes the tokens this worker handed out to the shared
+# generation_quotas table and pulls back buckets other workers changed, so
+# all workers converge on the same balances (a caller can overdraw by what the
+# other workers allow between two syncs) and balances survive restarts.
+
+GENERATION_QUOTA_ENABLED = os.getenv("GENERATION_QUOTA_ENABLED", "true").lower() == "true"
+GENERATION_QUOTA_USER_BURST = float(os.getenv("GENERATION_QUOTA_USER_BURST", "30"))
+GENERATION_QUOTA_USER_PER_HOUR = float(os.getenv("GENERATION_QUOTA_USER_PER_HOUR", "120"))
+GENERATION_QUOTA_IP_BURST = float(os.getenv("GENERATION_QUOTA_IP_BURST", "20"))
+GENERATION_QUOTA_IP_PER_HOUR = float(os.getenv("GENERATION_QUOTA_IP_PER_HOUR", "60"))
+GENERATION_QUOTA_NETWORK_BURST = float(os.getenv("GENERATION_QUOTA_NETWORK_BURST", "100"))
+GENERATION_QUOTA_NETWORK_PER_HOUR = float(os.getenv("GENERATION_QUOTA_NETWORK_PER_HOUR", "400"))
+GENERATION_QUOTA_SYNC_SECONDS = float(os.getenv("GENERATION_QUOTA_SYNC_SECONDS", "5"))
+# Re-read buckets changed this far before the last sync, so rows committed
+# out of timestamp order aren't missed (reading a balance twice is harmless)
+SYNC_OVERLAP_SECONDS = 5
+
+# Kind of caller (the quota key's prefix) -> (burst, tokens per second)
+POLICIES = {
+    "user": (GENERATION_QUOTA_USER_BURST, GENERATION_QUOTA_USER_PER_HOUR / 3600),
+    "ip": (GENERATION_QUOTA_IP_BURST, GENERATION_QUOTA_IP_PER_HOUR / 3600),
+    "network": (GENERATION_QUOTA_NETWORK_BURST, GENERATION_QUOTA_NETWORK_PER_HOUR / 3600),
+}
+# A bucket left alone this long is full again, so its stored row can go
+FULL_AFTER_SECONDS = max(burst / rate for burst, rate in POLICIES.values())
+
+# How long a resolved Authorization header is trusted, and how many are kept
+IDENTITY_TTL_SECONDS = 60
+IDENTITY_CACHE_SIZE = 10000
+
+def quota_key(kind: str, identity: str) -> str:
+    return f"{kind}:{identity.lower()}"
+
+class QuotaDecision(NamedTuple):
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: int  # Seconds until the next token, when refused
+    reset: int  # Seconds until the bucket is full again
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "consumed")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.consumed = 0.0  # Taken here since the last sync
+
+class GenerationQuotas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, _Bucket] = {}
+        self.last_sync: Optional[float] = None
+
+    def take(self, keys: List[str], cost: float = 1.0) -> QuotaDecision:
+        """Take `cost` tokens from each of a caller's buckets, or from none unless all have them.
+
+        The decision describes the tightest bucket; a cost of 0 just reports it.
+        """
+        now = time.time()
+        with self.lock:
+            buckets = []
+            for key in keys:
+                burst, rate = POLICIES[key.split(":", 1)[0]]
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = _Bucket(burst, now)
+                else:
+                    bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+                    bucket.updated = now
+                buckets.append((bucket, burst, rate))
+            allowed = all(bucket.tokens >= cost for bucket, _, _ in buckets)
+            if allowed:
+                for bucket, _, _ in buckets:
+                    bucket.tokens -= cost
+                    bucket.consumed += cost
+            balances = [(bucket.tokens, burst, rate) for bucket, burst, rate in buckets]
+        tokens, burst, rate = min(balances)
+        return QuotaDecision(
+            allowed=allowed,
+            limit=int(burst),
+            remaining=max(0, int(tokens)),
+            retry_after=0 if allowed else max(math.ceil((cost - tokens) / rate)
+                                              for tokens, _, rate in balances if tokens < cost),
+            reset=max(math.ceil((burst - tokens) / rate) for tokens, burst, rate in balances),
+        )
+
+    def sync(self):
+        """Push this worker's usage to the shared table and pull balances changed elsewhere."""
+        from services.auth_service import sync_generation_quotas
+        now = time.time()
+        with self.lock:
+            usage = []
+            for key, bucket in self.buckets.items():
+                if bucket.consumed:
+                    usage.append((key, bucket.consumed, *POLICIES[key.split(":", 1)[0]]))
+                    bucket.consumed = 0.0
+            since = self.last_sync - SYNC_OVERLAP_SECONDS if self.last_sync else None
+        try:
+            rows = sync_generation_quotas(usage, now, since, now - FULL_AFTER_SECONDS)
+        except Exception:
+            with self.lock:
+                # Keep the usage for the next attempt
+                for key, consumed, _, _ in usage:
+                    bucket = self.buckets.get(key)
+                    if bucket:
+                        bucket.consumed += consumed
+            raise
+
+        with self.lock:
+            current = time.time()
+            for row in rows:
+                key = row['bucket_key']
+                kind = key.split(":", 1)[0]
+                if kind not in POLICIES:
+                    continue
+                burst, rate = POLICIES[kind]
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = _Bucket(burst, current)
+                # The stored balance already includes the usage pushed above;
+                # tokens taken here while the sync ran are still owed on top of it
+                stored = min(burst, row['tokens'] + max(0.0, current - row['updated_at']) * rate)
+                bucket.tokens = stored - bucket.consumed
+                bucket.updated = current
+            # Buckets that have refilled carry no information; forget them
+            for key in [key for key, bucket in self.buckets.items() if not bucket.consumed and
+                        bucket.tokens + (current - bucket.updated) * POLICIES[key.split(":", 1)[0]][1]
+                        >= POLICIES[key.split(":", 1)[0]][0]]:
+                del self.buckets[key]
+            self.last_sync = now
+
+_quotas = GenerationQuotas()
+
+class GenerationQuotaExceeded(Exception):
+    def __init__(self, decision: QuotaDecision):
+        super().__init__(f"Generation quota exceeded; try again in {decision.retry_after} seconds")
+        self.decision = decision
+        self.retry_after = decision.retry_after
+
+# The current request's buckets and the tokens it has paid for but not used yet
+_request_quota: ContextVar[Optional[dict]] = ContextVar("request_quota", default=None)
+
+def begin_request_quota(keys: List[str]) -> QuotaDecision:
+    """Charge a generation request its first token; later Gemini calls it makes go through charge_generation."""
+    decision = _quotas.take(keys)
+    if decision.allowed:
+        _request_quota.set({"keys": keys, "prepaid": 1})
+    return decision
+
+def charge_generation() -> None:
+    """Pay for one Gemini call made by the current request; raises GenerationQuotaExceeded when out of tokens.
+
+    Does nothing outside a request begun with begin_request_quota.
+    """
+    state = _request_quota.get()
+    if state is None:
+        return
+    if state["prepaid"]:
+        state["prepaid"] -= 1
+        return
+    decision = _quotas.take(state["keys"])
+    if not decision.allowed:
+        raise GenerationQuotaExceeded(decision)
+
+def request_quota_status() -> Optional[QuotaDecision]:
+    """The current request's tightest bucket, after everything it has been charged."""
+    state = _request_quota.get()
+    if state is None:
+        return None
+    # A balance overdrawn by other workers still isn't a refusal of this request
+    return _quotas.take(state["keys"], cost=0)._replace(allowed=True)
+
+class IdentityCache:
+    """Authorization header -> quota key, so repeat callers skip the token lookup."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Tuple[Optional[str], float]] = {}
+
+    def get(self, authorization: str) -> Tuple[bool, Optional[str]]:
+        """(found, key); key is None for a header that didn't resolve to a user."""
+        entry = self.entries.get(authorization)
+        if entry is None or time.monotonic() - entry[1] > IDENTITY_TTL_SECONDS:
+            return False, None
+        return True, entry[0]
+
+    def put(self, authorization: str, key: Optional[str]):
+        with self.lock:
+            if len(self.entries) >= IDENTITY_CACHE_SIZE:
+                self.entries.clear()
+            self.entries[authorization] = (key, time.monotonic())
+
+identity_cache = IdentityCache()
+
+# ============ BACKGROUND SYNC ============
+
+_stop_event = threading.Event()
+_worker: Optional[threading.Thread] = None
+
+def _sync_loop():
+    while True:
+        try:
+            _quotas.sync()
+        except Exception as e:
+            print(f"❌ Generation quota sync failed: {e}")
+        if _stop_event.wait(GENERATION_QUOTA_SYNC_SECONDS):
+            break
+    try:
+        _quotas.sync()  # Don't lose the last few seconds of usage on shutdown
+    except Exception as e:
+        print(f"❌ Generation quota sync failed: {e}")
+
+def start_quota_sync() -> None:
+    """Start the background sync thread (idempotent; does nothing when quotas are disabled)."""
+    global _worker
+    if not GENERATION_QUOTA_ENABLED or (_worker and _worker.is_alive()):
+        return
+    _stop_event.clear()
+    _worker = threading.Thread(target=_sync_loop, name="quota-sync", daemon=True)
+    _worker.start()
+
+def stop_quota_sync(timeout: float = 5) -> None:
+    """Stop the sync thread after a final push of this worker's usage."""
+    _stop_event.set()
+    if _worker:
+        _worker.join(timeout)
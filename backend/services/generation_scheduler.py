@@ -0,0 +1,107 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from services.metrics_service import incr, set_gauge, observe
+
+# Admission control for Gemini calls. At most GENERATION_MAX_CONCURRENCY
+# generations run at once; the rest wait in bounded per-priority queues and
+# are admitted strictly by priority. A full queue, or a wait longer than
+# GENERATION_MAX_WAIT_SECONDS, is rejected so the endpoint can answer 503.
+# All state is touched only from the event loop, so no locking is needed.
+
+class Priority(IntEnum):
+    LESSON = 0  # A learner is waiting on lesson content
+    STANDARD = 1  # Quizzes, diagrams, syllabus intake
+    BACKGROUND = 2  # Suggestions and other work nobody is blocked on
+
+GENERATION_MAX_CONCURRENCY = int(os.getenv("GENERATION_MAX_CONCURRENCY", "8"))
+GENERATION_MAX_WAIT_SECONDS = float(os.getenv("GENERATION_MAX_WAIT_SECONDS", "30"))
+GENERATION_RETRY_AFTER = int(os.getenv("GENERATION_RETRY_AFTER", "5"))
+GENERATION_QUEUE_LIMITS = {
+    Priority.LESSON: int(os.getenv("GENERATION_QUEUE_LESSON", "64")),
+    Priority.STANDARD: int(os.getenv("GENERATION_QUEUE_STANDARD", "32")),
+    Priority.BACKGROUND: int(os.getenv("GENERATION_QUEUE_BACKGROUND", "8")),
+}
+
+class GenerationQueueFull(Exception):
+    """Raised when a generation cannot be admitted and should be retried later."""
+
+    def __init__(self, reason: str, retry_after: int = GENERATION_RETRY_AFTER):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+class GenerationScheduler:
+    def __init__(self, max_concurrency: int, queue_limits: dict, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.queue_limits = queue_limits
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiters = {priority: deque() for priority in Priority}
+
+    def _update_gauges(self):
+        set_gauge("generation.in_flight", self.in_flight)
+        for priority, waiters in self.waiters.items():
+            set_gauge(f"generation.queued.{priority.name.lower()}", len(waiters))
+
+    def _has_waiters_at_or_above(self, priority: Priority) -> bool:
+        return any(self.waiters[p] for p in Priority if p <= priority)
+
+    async def acquire(self, priority: Priority):
+        name = priority.name.lower()
+        started = time.perf_counter()
+
+        if self.in_flight < self.max_concurrency and not self._has_waiters_at_or_above(priority):
+            self.in_flight += 1
+            observe(f"generation.queue_wait_ms.{name}", 0)
+            self._update_gauges()
+            return
+
+        if len(self.waiters[priority]) >= self.queue_limits[priority]:
+            incr(f"generation.rejected.{name}")
+            raise GenerationQueueFull(f"{name} generation queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(future)
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            elif future in self.waiters[priority]:
+                self.waiters[priority].remove(future)
+            self._update_gauges()
+            if isinstance(e, asyncio.TimeoutError):
+                incr(f"generation.timed_out.{name}")
+                raise GenerationQueueFull(f"Waited too long for a {name} generation slot")
+            raise
+        finally:
+            observe(f"generation.queue_wait_ms.{name}", (time.perf_counter() - started) * 1000)
+
+    def release(self):
+        """Hand the slot to the highest-priority waiter, or free it."""
+        for priority in Priority:
+            waiters = self.waiters[priority]
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    self._update_gauges()
+                    return
+        self.in_flight -= 1
+        self._update_gauges()
+
+scheduler = GenerationScheduler(GENERATION_MAX_CONCURRENCY, GENERATION_QUEUE_LIMITS, GENERATION_MAX_WAIT_SECONDS)
+
+@asynccontextmanager
+async def generation_slot(priority: Priority):
+    """Hold one of the global generation slots for the duration of the block."""
+    await scheduler.acquire(priority)
+    try:
+        yield
+    finally:
+        scheduler.release()
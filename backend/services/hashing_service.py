@@ -0,0 +1,77 @@
+import os
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from services.auth_service import hash_password, verify_password
+from services.metrics_service import incr, set_gauge, observe
+
+# bcrypt releases the GIL while hashing, so a small thread pool is enough
+# to keep the event loop free without the cost of a process pool.
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Maximum number of hashing jobs (running + waiting) before we shed load
+HASH_POOL_MAX_PENDING = int(os.getenv("HASH_POOL_MAX_PENDING", "32"))
+HASH_POOL_RETRY_AFTER = int(os.getenv("HASH_POOL_RETRY_AFTER", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=HASH_POOL_WORKERS, thread_name_prefix="bcrypt")
+_lock = threading.Lock()
+_pending = 0
+_running = 0
+
+set_gauge("hash_pool.workers", HASH_POOL_WORKERS)
+set_gauge("hash_pool.max_pending", HASH_POOL_MAX_PENDING)
+
+class HashingPoolBusy(Exception):
+    """Raised when the hashing pool is full and the request should be retried later."""
+
+    def __init__(self, retry_after: int = HASH_POOL_RETRY_AFTER):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+def _update_gauges():
+    set_gauge("hash_pool.pending", _pending)
+    set_gauge("hash_pool.running", _running)
+    set_gauge("hash_pool.utilization", _running / HASH_POOL_WORKERS)
+
+def _run_job(fn, args, submitted_at: float):
+    """Execute a job on a pool thread and keep the gauges in sync."""
+    global _running
+    observe("hash_pool.wait_ms", (time.perf_counter() - submitted_at) * 1000)
+    with _lock:
+        _running += 1
+        _update_gauges()
+    started_at = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        observe("hash_pool.run_ms", (time.perf_counter() - started_at) * 1000)
+        with _lock:
+            _running -= 1
+            _update_gauges()
+
+async def run_in_hash_pool(fn, *args):
+    """Run a CPU-heavy hashing call on the bounded pool, failing fast when it is full."""
+    global _pending
+    with _lock:
+        if _pending >= HASH_POOL_MAX_PENDING:
+            incr("hash_pool.rejected")
+            raise HashingPoolBusy()
+        _pending += 1
+        _update_gauges()
+
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_executor, _run_job, fn, args, time.perf_counter())
+    finally:
+        with _lock:
+            _pending -= 1
+            _update_gauges()
+        incr("hash_pool.completed")
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password without blocking the event loop."""
+    return await run_in_hash_pool(hash_password, password)
+
+async def verify_password_async(password: str, password_hash: str) -> bool:
+    """Verify a password without blocking the event loop."""
+    return await run_in_hash_pool(verify_password, password, password_hash)
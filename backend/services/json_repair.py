@@ -0,0 +1,284 @@
+import re
+import json
+from typing import Any, Set, Tuple
+
+# Tolerant parsing for JSON produced by the model. json.loads is tried first;
+# if it fails, a lenient parser repairs common defects (code fences, trailing
+# commas, invalid escapes, raw newlines, bare keys, Python literals) and
+# salvages what it can from truncated or partly broken output: a member whose
+# value cannot be parsed is dropped and parsing resumes at the next key, so the
+# caller can regenerate just that field. Top-level members that were kept but
+# lost part of their value (a truncated array) are reported as incomplete.
+
+_VALID_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+_LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+_NEXT_KEY = re.compile(r',\s*"[^"\\\n]{1,80}"\s*:')
+_KEY_AHEAD = re.compile(r'"[^"\\\n]{1,80}"\s*:')
+_NUMBER = re.compile(r'-?\d+(\.\d+)?([eE][+-]?\d+)?')
+_BARE_KEY = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+class ModelJSONError(ValueError):
+    """Raised when nothing usable can be recovered from a model response."""
+
+class _Truncated(Exception):
+    pass
+
+class _Broken(Exception):
+    pass
+
+class _LenientParser:
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.repaired = False
+        self.dropped = False
+        self.depth = 0
+        # Set when an array stopped early; its complete elements are still kept
+        self.partial_array = False
+        # Top-level keys whose value was kept even though part of it was dropped
+        self.incomplete = set()
+
+    def skip_ws(self):
+        while self.pos < len(self.text) and self.text[self.pos] in " \t\r\n":
+            self.pos += 1
+
+    def at_end(self) -> bool:
+        self.skip_ws()
+        return self.pos >= len(self.text)
+
+    def parse_value(self) -> Any:
+        if self.at_end():
+            raise _Truncated()
+        char = self.text[self.pos]
+        if char == '{':
+            return self.parse_object()
+        if char == '[':
+            return self.parse_array()
+        if char == '"':
+            return self.parse_string()
+        number = _NUMBER.match(self.text, self.pos)
+        if number:
+            self.pos = number.end()
+            return json.loads(number.group())
+        word = _BARE_KEY.match(self.text, self.pos)
+        if word and word.group() in _LITERALS:
+            if word.group() not in ("true", "false", "null"):
+                self.repaired = True
+            self.pos = word.end()
+            return _LITERALS[word.group()]
+        if word and word.end() == len(self.text):
+            raise _Truncated()
+        raise _Broken()
+
+    def parse_string(self) -> str:
+        self.pos += 1
+        chars = []
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == '"':
+                self.pos += 1
+                return "".join(chars)
+            if char == '\\':
+                if self.pos + 1 >= len(self.text):
+                    raise _Truncated()
+                escape = self.text[self.pos + 1]
+                if escape in _VALID_ESCAPES:
+                    chars.append(_VALID_ESCAPES[escape])
+                    self.pos += 2
+                    continue
+                if escape == 'u':
+                    digits = self.text[self.pos + 2:self.pos + 6]
+                    if len(digits) < 4 and self.pos + 6 > len(self.text):
+                        raise _Truncated()
+                    if re.fullmatch(r'[0-9a-fA-F]{4}', digits):
+                        chars.append(chr(int(digits, 16)))
+                        self.pos += 6
+                        continue
+                # Invalid escape such as \( in Mermaid or LaTeX: keep it literally
+                self.repaired = True
+                chars.append(char)
+                self.pos += 1
+                continue
+            if char in "\n\r\t":
+                self.repaired = True
+            chars.append(char)
+            self.pos += 1
+        raise _Truncated()
+
+    def parse_key(self) -> str:
+        if self.text[self.pos] == '"':
+            return self.parse_string()
+        word = _BARE_KEY.match(self.text, self.pos)
+        if not word:
+            raise _Broken()
+        self.repaired = True
+        self.pos = word.end()
+        return word.group()
+
+    def resync_to_next_key(self) -> bool:
+        """Skip a damaged member; leave pos just after the comma before the next key."""
+        self.dropped = True
+        match = _NEXT_KEY.search(self.text, self.pos)
+        if not match:
+            self.pos = len(self.text)
+            return False
+        self.pos = match.start() + 1
+        return True
+
+    def parse_object(self) -> dict:
+        self.pos += 1
+        self.depth += 1
+        try:
+            return self._parse_members()
+        finally:
+            self.depth -= 1
+
+    def _cut_off(self, result: dict) -> dict:
+        """Handle an object that ends before its closing brace."""
+        self.dropped = True
+        self.pos = len(self.text)
+        if self.depth > 1:
+            # A nested record that is only partly there is not worth keeping
+            raise _Truncated()
+        return result
+
+    def _parse_members(self) -> dict:
+        result = {}
+        while True:
+            if self.at_end():
+                return self._cut_off(result)
+            char = self.text[self.pos]
+            if char == '}':
+                self.pos += 1
+                return result
+            if char == ',':
+                # Trailing or doubled comma
+                self.repaired = True
+                self.pos += 1
+                continue
+
+            member_start = self.pos
+            try:
+                key = self.parse_key()
+                if self.at_end():
+                    raise _Truncated()
+                if self.text[self.pos] != ':':
+                    raise _Broken()
+                self.pos += 1
+                dropped_before, self.dropped = self.dropped, False
+                value = self.parse_value()
+                if self.dropped and self.depth == 1:
+                    self.incomplete.add(key)
+                self.dropped = self.dropped or dropped_before
+            except _Truncated:
+                return self._cut_off(result)
+            except _Broken:
+                self.pos = max(self.pos, member_start + 1)
+                if not self.resync_to_next_key():
+                    return result
+                continue
+
+            if self.partial_array:
+                # Keep the elements that parsed and carry on from the next key
+                self.partial_array = False
+                result[key] = value
+                if not self.resync_to_next_key():
+                    return result
+                continue
+            if self.at_end():
+                result[key] = value
+                return self._cut_off(result)
+            char = self.text[self.pos]
+            if char in ',}':
+                result[key] = value
+                if char == ',':
+                    self.pos += 1
+                continue
+            if _KEY_AHEAD.match(self.text, self.pos):
+                # Missing comma between members
+                self.repaired = True
+                result[key] = value
+                continue
+            # Garbage after the value, e.g. an unescaped quote ended a string early
+            if not self.resync_to_next_key():
+                return result
+
+    def parse_array(self) -> list:
+        self.pos += 1
+        self.depth += 1
+        try:
+            return self._parse_elements()
+        finally:
+            self.depth -= 1
+
+    def _parse_elements(self) -> list:
+        result = []
+        while True:
+            if self.at_end():
+                self.dropped = True
+                return result
+            char = self.text[self.pos]
+            if char == ']':
+                self.pos += 1
+                return result
+            if char == ',':
+                self.repaired = True
+                self.pos += 1
+                continue
+            try:
+                value = self.parse_value()
+            except _Truncated:
+                self.dropped = True
+                self.pos = len(self.text)
+                return result
+            except _Broken:
+                # Keep the complete elements; the enclosing object resyncs on the next key
+                self.dropped = True
+                self.partial_array = True
+                return result
+            result.append(value)
+            if self.at_end():
+                self.dropped = True
+                return result
+            char = self.text[self.pos]
+            if char == ',':
+                self.pos += 1
+            elif char in '{["':
+                # Missing comma between elements
+                self.repaired = True
+            elif char != ']':
+                self.dropped = True
+                self.partial_array = True
+                return result
+
+def _strip_wrapping(text: str) -> str:
+    """Remove markdown code fences and any prose before the first bracket."""
+    text = text.strip()
+    fence = re.match(r'^```[a-zA-Z]*\s*\n?(.*?)(\n?```\s*)?$', text, re.DOTALL)
+    if fence:
+        text = fence.group(1)
+    starts = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    return text[min(starts):] if starts else text
+
+def parse_model_json(text: str) -> Tuple[Any, str, Set[str]]:
+    """Parse model output as JSON, repairing it if needed.
+
+    Returns (data, status, incomplete) where status is "ok" (valid JSON),
+    "repaired" (syntax fixed, nothing lost) or "salvaged" (some members were
+    dropped or truncated), and incomplete names the top-level keys that were kept
+    with part of their value missing.
+    """
+    try:
+        return json.loads(text), "ok", set()
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    cleaned = _strip_wrapping(text or "")
+    if not cleaned or cleaned[0] not in "{[":
+        raise ModelJSONError("Model response contains no JSON object")
+
+    parser = _LenientParser(cleaned)
+    data = parser.parse_value()
+    if not data:
+        raise ModelJSONError("Could not recover any data from model response")
+    return data, "salvaged" if parser.dropped else "repaired", parser.incomplete
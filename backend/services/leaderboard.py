@@ -0,0 +1,199 @@
+import os
+import time
+import heapq
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from services.auth_service import get_leaderboard_rows, rebuild_leaderboard, period_start
+
+# Leaderboards of learners by current streak and by minutes studied this week.
+# Scores live in leaderboard_scores (updated by every logged activity); each
+# worker keeps them ranked in memory in a Fenwick tree of score counts, so
+# updates, "my rank" and each step of a top-K walk cost O(log max score) no
+# matter how many users there are. Like the syllabus index, a worker pulls the
+# scores changed by other workers at most every LEADERBOARD_REFRESH_SECONDS.
+
+LEADERBOARD_REFRESH_SECONDS = float(os.getenv("LEADERBOARD_REFRESH_SECONDS", "2"))
+# Re-read updates this far back on each refresh, so rows committed out of
+# timestamp order aren't missed (applying a score twice is harmless)
+REFRESH_OVERLAP_SECONDS = 5
+
+BOARDS = ("streak", "weekly_minutes")
+
+class _ScoreCounts:
+    """Fenwick tree counting users per score, growing as higher scores appear."""
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, score: int, delta: int):
+        while score > self.size:
+            self._grow()
+        while score <= self.size:
+            self.tree[score] += delta
+            score += score & -score
+
+    def at_most(self, score: int) -> int:
+        """Number of users with a score <= score."""
+        score = min(score, self.size)
+        total = 0
+        while score > 0:
+            total += self.tree[score]
+            score -= score & -score
+        return total
+
+    def kth(self, k: int) -> int:
+        """The k-th smallest score (1-based)."""
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if position + step <= self.size and self.tree[position + step] < k:
+                position += step
+                k -= self.tree[position]
+            step >>= 1
+        return position + 1
+
+    def _grow(self):
+        counts = [self.at_most(score) - self.at_most(score - 1) for score in range(1, self.size + 1)]
+        self.size *= 2
+        self.tree = [0] * (self.size + 1)
+        for score, count in enumerate(counts, 1):
+            if count:
+                self.add(score, count)
+
+class Ranking:
+    """Users ordered by a positive integer score; ties share a rank and are listed by email."""
+
+    def __init__(self):
+        self.scores: Dict[str, int] = {}
+        self.by_score: Dict[int, Set[str]] = {}
+        self.counts = _ScoreCounts()
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def set(self, user_email: str, score: int):
+        """Set a user's score; users with a score of 0 are left off the board."""
+        previous = self.scores.get(user_email, 0)
+        if score == previous:
+            return
+        if previous:
+            self.counts.add(previous, -1)
+            self.by_score[previous].discard(user_email)
+            if not self.by_score[previous]:
+                del self.by_score[previous]
+            del self.scores[user_email]
+        if score > 0:
+            self.counts.add(score, 1)
+            self.by_score.setdefault(score, set()).add(user_email)
+            self.scores[user_email] = score
+
+    def rank(self, user_email: str) -> Optional[Tuple[int, int]]:
+        """(rank, score) of a user, or None when they aren't on the board."""
+        score = self.scores.get(user_email)
+        if not score:
+            return None
+        return len(self.scores) - self.counts.at_most(score) + 1, score
+
+    def top(self, k: int) -> List[Tuple[int, str, int]]:
+        """The first k (rank, user_email, score) entries, best first."""
+        entries = []
+        above = 0
+        while len(entries) < k and above < len(self.scores):
+            score = self.counts.kth(len(self.scores) - above)
+            tied = self.by_score[score]
+            entries.extend((above + 1, user_email, score) for user_email in heapq.nsmallest(k - len(entries), tied))
+            above += len(tied)
+        return entries
+
+class Leaderboards:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rankings = {board: Ranking() for board in BOARDS}
+        self.rows: Dict[str, dict] = {}
+        self.today: Optional[date] = None
+        self.last_updated_at: Optional[str] = None
+        self.last_refresh = 0.0
+        self.loaded = False
+
+    def _score(self, row: dict) -> Dict[str, int]:
+        yesterday = (self.today - timedelta(days=1)).isoformat()
+        this_week = period_start(self.today, "week").isoformat()
+        return {
+            # Same rule as calculate_streak: a streak survives until a whole day is missed
+            "streak": row['streak'] if (row['last_active_date'] or "") >= yesterday else 0,
+            "weekly_minutes": max(0, row['week_minutes']) if row['week_start'] == this_week else 0,
+        }
+
+    def _apply(self, row: dict):
+        self.rows[row['user_email']] = row
+        for board, score in self._score(row).items():
+            self.rankings[board].set(row['user_email'], score)
+
+    def refresh(self, force: bool = False):
+        """Pull scores written since the last refresh (by this or any other worker)."""
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.loaded and now - self.last_refresh < LEADERBOARD_REFRESH_SECONDS:
+                return
+            self.last_refresh = now
+
+            today = datetime.now().date()
+            if today != self.today:
+                # Streaks lapse and weeks roll over at midnight: rescore everyone once
+                self.today = today
+                for row in list(self.rows.values()):
+                    self._apply(row)
+
+            since = None
+            if self.last_updated_at:
+                overlap = datetime.fromisoformat(self.last_updated_at) - timedelta(seconds=REFRESH_OVERLAP_SECONDS)
+                since = overlap.isoformat()
+            for row in get_leaderboard_rows(since):
+                self._apply(row)
+                self.last_updated_at = max(self.last_updated_at or "", row['updated_at'])
+            self.loaded = True
+
+    def top(self, board: str, k: int) -> List[Tuple[int, str, int]]:
+        self.refresh()
+        with self.lock:
+            return self.rankings[board].top(k)
+
+    def rank(self, board: str, user_email: str) -> Optional[Tuple[int, int]]:
+        self.refresh()
+        with self.lock:
+            return self.rankings[board].rank(user_email)
+
+    def size(self, board: str) -> int:
+        with self.lock:
+            return len(self.rankings[board])
+
+    def reload(self):
+        with self.lock:
+            self.rankings = {board: Ranking() for board in BOARDS}
+            self.rows = {}
+            self.last_updated_at = None
+            self.loaded = False
+        self.refresh(force=True)
+
+_leaderboards = Leaderboards()
+
+def get_leaderboard(board: str, limit: int = 10, user_email: Optional[str] = None) -> dict:
+    """Top `limit` entries of a board, plus the given user's own rank."""
+    entries = _leaderboards.top(board, limit)
+    mine = _leaderboards.rank(board, user_email) if user_email else None
+    return {
+        "entries": entries,
+        "me": mine,
+        "total": _leaderboards.size(board),
+    }
+
+def rebuild() -> int:
+    """Recompute every score from the activity history and reload this worker's rankings."""
+    count = rebuild_leaderboard()
+    _leaderboards.reload()
+    return count
+
+if __name__ == "__main__":
+    print(f"🏆 Rebuilt leaderboard scores for {rebuild()} users")
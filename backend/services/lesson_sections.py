@@ -0,0 +1,92 @@
+import re
+from typing import List, NamedTuple
+
+# Splits lesson markdown into sections at its top-level headings, so a client
+# can render the first section and the table of contents straight away and
+# fetch the rest as the reader scrolls. Sections keep their text verbatim:
+# joining every section's markdown gives back the original lesson.
+
+class LessonSection(NamedTuple):
+    heading: str
+    level: int
+    anchor: str
+    content_markdown: str
+
+_HEADING = re.compile(r'^ {0,3}(#{1,6})[ \t]+(.+?)(?:[ \t]+#+)?[ \t]*$')
+_FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+
+def _headings(lines: List[str]) -> List[tuple]:
+    """(line index, level, text) of every ATX heading outside fenced code blocks."""
+    found = []
+    fence = None
+    for index, line in enumerate(lines):
+        match = _FENCE.match(line)
+        if match:
+            marker = match.group(1)
+            if fence is None:
+                fence = marker
+            elif marker[0] == fence[0] and len(marker) >= len(fence):
+                fence = None
+            continue
+        if fence is None:
+            heading = _HEADING.match(line.rstrip("\r\n"))
+            if heading:
+                found.append((index, len(heading.group(1)), heading.group(2).strip()))
+    return found
+
+def _anchor(heading: str, used: set) -> str:
+    """GitHub-style slug, made unique within the lesson."""
+    text = re.sub(r'[*_`~\[\]()]', '', heading).casefold()
+    slug = re.sub(r'[^\w\- ]', '', text).strip().replace(' ', '-') or "section"
+    anchor, n = slug, 1
+    while anchor in used:
+        anchor = f"{slug}-{n}"
+        n += 1
+    used.add(anchor)
+    return anchor
+
+def split_lesson_sections(markdown: str) -> List[LessonSection]:
+    """Split a lesson at the shallowest heading level that divides it into several parts.
+
+    A lesson with "# Title" and "## Part" headings is split at both levels; one
+    that only uses "###" headings is split at those. Text before the first
+    heading becomes an untitled section, and a heading with nothing under it
+    (or blank lines before the first heading) is folded into the start of the
+    section that follows, which keeps its own heading and anchor.
+    """
+    markdown = markdown or ""
+    if not markdown.strip():
+        return []
+    lines = markdown.splitlines(keepends=True)
+    headings = _headings(lines)
+
+    split_level = min((level for _, level, _ in headings), default=0)
+    for level in range(1, 7):
+        if sum(1 for _, heading_level, _ in headings if heading_level <= level) >= 2:
+            split_level = level
+            break
+    boundaries = [(index, level, text) for index, level, text in headings if level <= split_level]
+    if not boundaries or boundaries[0][0] != 0:
+        boundaries.insert(0, (0, 0, ""))
+
+    parts = []
+    for position, (start, level, text) in enumerate(boundaries):
+        end = boundaries[position + 1][0] if position + 1 < len(boundaries) else len(lines)
+        body = lines[start:end]
+        parts.append([text, level, body, bool("".join(body[1 if level else 0:]).strip())])
+
+    merged = []
+    for part in parts:
+        if merged and not merged[-1][3]:
+            # The previous section is only a heading (e.g. the lesson title) or
+            # blank lines: prepend it to this one rather than hide this heading
+            part[2] = merged.pop()[2] + part[2]
+        merged.append(part)
+
+    used = set()
+    return [LessonSection(text, level, _anchor(text, used) if text else "", "".join(body))
+            for text, level, body, _ in merged]
+
+if __name__ == "__main__":
+    from services.auth_service import rebuild_lesson_sections
+    print(f"📑 Re-split {rebuild_lesson_sections()} cached lessons into sections")
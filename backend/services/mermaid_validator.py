@@ -0,0 +1,365 @@
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+# Server-side syntax check for the Mermaid diagrams we ask Gemini for
+# (mindmap, flowchart/graph and sequenceDiagram), with cheap fixes for the
+# mistakes the model makes most often: code fences, escaped newlines, missing
+# headers, uneven indentation, several mindmap roots, labels containing
+# brackets or quotes, node ids with spaces and "->" arrows. It mirrors the
+# client-side clean-up in MermaidRenderer.tsx so that what we cache renders.
+
+class MermaidCheck(NamedTuple):
+    valid: bool
+    code: str
+    repaired: bool
+    diagram_type: str
+    errors: List[str]
+
+FLOWCHART_DIRECTIONS = {"TD", "TB", "BT", "RL", "LR"}
+# Other diagram types only get a header and bracket-balance check
+OTHER_TYPES = {
+    "classdiagram": "classDiagram", "statediagram": "stateDiagram", "statediagram-v2": "stateDiagram-v2",
+    "erdiagram": "erDiagram", "journey": "journey", "gantt": "gantt", "pie": "pie", "timeline": "timeline",
+}
+_SPECIAL_LABEL_CHARS = re.compile(r'[()\[\]{}"<>]')
+
+def _clean(code: str) -> str:
+    code = (code or "").strip()
+    code = re.sub(r'^```(?:mermaid)?\s*', '', code, flags=re.IGNORECASE)
+    code = re.sub(r'\s*```$', '', code)
+    if "\n" not in code and "\\n" in code:
+        code = code.replace("\\n", "\n")
+    code = re.sub(r'[​-‍﻿]', '', code)
+    code = code.replace("\t", "  ")
+    return "\n".join(line.rstrip() for line in code.split("\n"))
+
+def _balanced(text: str) -> bool:
+    pairs = {')': '(', ']': '[', '}': '{'}
+    stack = []
+    in_quotes = False
+    for char in text:
+        if char == '"':
+            in_quotes = not in_quotes
+        elif in_quotes:
+            continue
+        elif char in '([{':
+            stack.append(char)
+        elif char in pairs:
+            if not stack or stack.pop() != pairs[char]:
+                return False
+    return not stack and not in_quotes
+
+def _safe_text(text: str) -> str:
+    """Label text with characters that break Mermaid parsing removed."""
+    text = re.sub(r'[()\[\]{}"<>]', '', text).replace('`', "'")
+    return " ".join(text.split())
+
+# ============ MINDMAP ============
+
+_MINDMAP_SHAPES = [
+    ('((', '))'), ('))', '(('), ('{{', '}}'), ('(', ')'), (')', '('), ('[', ']'),
+]
+
+def _split_mindmap_node(text: str) -> Tuple[str, str, str, str]:
+    """Split 'id((label))' into (id, open, label, close); plain text has empty id and brackets."""
+    for open_bracket, close_bracket in _MINDMAP_SHAPES:
+        start = text.find(open_bracket)
+        if start >= 0 and text.endswith(close_bracket) and len(text) >= start + len(open_bracket) + len(close_bracket):
+            node_id = text[:start]
+            if not re.search(r'[\s()\[\]{}]', node_id):
+                return node_id, open_bracket, text[start + len(open_bracket):len(text) - len(close_bracket)], close_bracket
+    return "", "", text, ""
+
+def _repair_mindmap_node(text: str) -> str:
+    if text.startswith("::icon(") or text.startswith(":::"):
+        return text
+    node_id, open_bracket, label, close_bracket = _split_mindmap_node(text)
+    if open_bracket:
+        if _SPECIAL_LABEL_CHARS.search(label):
+            label = _safe_text(label)
+        return f"{node_id}{open_bracket}{label}{close_bracket}"
+    if _SPECIAL_LABEL_CHARS.search(text):
+        return _safe_text(text)
+    return text
+
+def _mindmap_nodes(lines: List[str]) -> List[Tuple[int, str]]:
+    """(indent, text) of each node line, skipping comments."""
+    return [(len(line) - len(line.lstrip(" ")), line.strip()) for line in lines if line.strip() and not line.strip().startswith("%%")]
+
+def _mindmap_levels(nodes: List[Tuple[int, str]]) -> List[int]:
+    """Map raw indentation to levels: a child is exactly one level below the nearest shallower line."""
+    levels = []
+    stack: List[Tuple[int, int]] = []  # (indent, level)
+    for indent, _ in nodes:
+        while stack and stack[-1][0] >= indent:
+            if stack[-1][0] == indent:
+                break
+            stack.pop()
+        if stack and stack[-1][0] == indent:
+            level = stack[-1][1]
+        else:
+            level = stack[-1][1] + 1 if stack else 0
+            stack.append((indent, level))
+        levels.append(level)
+    return levels
+
+def _check_mindmap(lines: List[str]) -> Tuple[List[str], List[str]]:
+    errors = []
+    nodes = _mindmap_nodes(lines)
+    if not nodes:
+        return ["mindmap"], ["mindmap has no nodes"]
+    levels = _mindmap_levels(nodes)
+
+    # A mindmap has one root; once a second top-level node appears, it and
+    # everything after it move one level down under the first root
+    fixed_levels = []
+    extra_root_seen = False
+    for index, level in enumerate(levels):
+        extra_root_seen = extra_root_seen or (index > 0 and level == 0)
+        fixed_levels.append(level + 1 if extra_root_seen else level)
+
+    output = ["mindmap"]
+    for (indent, text), level in zip(nodes, fixed_levels):
+        node = _repair_mindmap_node(text)
+        node_id, open_bracket, label, _ = _split_mindmap_node(node)
+        if not (label.strip() or open_bracket and node_id):
+            errors.append(f"empty mindmap node: {text!r}")
+        elif not _balanced(node):
+            errors.append(f"unbalanced brackets in mindmap node: {text!r}")
+        output.append("  " * (level + 1) + node)
+    return output, errors
+
+# ============ FLOWCHART ============
+
+_FLOWCHART_KEYWORDS = re.compile(r'^(subgraph\b|end$|direction\s+(TD|TB|BT|RL|LR)$|classDef\s|class\s|style\s|linkStyle\s|click\s|%%)')
+# Ids may contain '-' and '.', but not where they start an edge such as A-->B or A-.->B
+_NODE_ID_PATTERN = r'[A-Za-z0-9_](?:\w|-(?![-.>])|\.(?!-))*'
+_NODE_ID = re.compile(_NODE_ID_PATTERN)
+_EDGE_OPERATOR = (
+    r'(?:'
+    r'<?(?:-{2,}|={2,}|-\.+-)[>ox]?(?:\|[^|]*\|)?'      # -->, ---, ==>, -.->, with optional |text|
+    r'|<?--\s[^->][^>]*?\s-{2,}[>ox]?'                 # -- text -->
+    r'|<?==\s[^=>][^>]*?\s={2,}>'                      # == text ==>
+    r')'
+)
+_EDGE = re.compile(r'\s*' + _EDGE_OPERATOR + r'\s*')
+_FLOWCHART_SHAPES = [
+    ('(((', ')))'), ('((', '))'), ('([', '])'), ('[[', ']]'), ('[(', ')]'), ('{{', '}}'),
+    ('[/', '/]'), ('[\\', '\\]'), ('[/', '\\]'), ('[\\', '/]'),
+    ('[', ']'), ('(', ')'), ('{', '}'), ('>', ']'),
+]
+
+def _match_shape(text: str, pos: int) -> Optional[Tuple[str, str, str, int]]:
+    """Match a node shape starting at pos; returns (open, label, close, end_pos)."""
+    for open_bracket, close_bracket in _FLOWCHART_SHAPES:
+        if not text.startswith(open_bracket, pos):
+            continue
+        start = pos + len(open_bracket)
+        if text.startswith('"', start):
+            end_quote = text.find('"', start + 1)
+            if end_quote >= 0 and text.startswith(close_bracket, end_quote + 1):
+                return open_bracket, text[start:end_quote + 1], close_bracket, end_quote + 1 + len(close_bracket)
+        # Take the closing bracket that is followed by an edge, ':::' or the end of the statement
+        search = start
+        while True:
+            end = text.find(close_bracket, search)
+            if end < 0:
+                break
+            after = end + len(close_bracket)
+            rest = text[after:]
+            if not rest.strip() or rest.startswith(":::") or _EDGE.match(rest) or rest.lstrip().startswith("&"):
+                return open_bracket, text[start:end], close_bracket, after
+            search = end + 1
+    return None
+
+def _parse_flowchart_node(text: str, pos: int) -> Tuple[str, int]:
+    """Parse one node reference and return it (repaired) with the position after it."""
+    id_match = _NODE_ID.match(text, pos)
+    if not id_match:
+        raise ValueError(f"expected a node at {text[pos:pos + 20]!r}")
+    node_id = id_match.group()
+    pos = id_match.end()
+
+    # "Start Node --> B": words separated by spaces form a label, not an id
+    words = re.match(r'((?:\s+' + _NODE_ID_PATTERN + r')+)(?=\s*(?:$|&|:::|' + _EDGE_OPERATOR + '))', text[pos:])
+    if words and not _match_shape(text, pos):
+        label = node_id + words.group(1)
+        node_id = re.sub(r'\W+', '_', label.strip())
+        return f'{node_id}["{label.strip()}"]', pos + len(words.group(1))
+
+    if node_id.lower() == "end":
+        node_id = "end_node"
+
+    shape = _match_shape(text, pos)
+    node = node_id
+    if shape:
+        open_bracket, label, close_bracket, pos = shape
+        quoted = label.startswith('"') and label.endswith('"') and len(label) >= 2
+        if not quoted and _SPECIAL_LABEL_CHARS.search(label):
+            label = '"' + label.replace('"', "'") + '"'
+        node += f"{open_bracket}{label}{close_bracket}"
+    elif pos < len(text) and text[pos] in "([{>":
+        raise ValueError(f"unclosed node shape in {text!r}")
+
+    class_match = re.match(r':::[\w-]+', text[pos:])
+    if class_match:
+        node += class_match.group()
+        pos += class_match.end()
+    return node, pos
+
+def _parse_node_group(text: str, pos: int) -> Tuple[str, int]:
+    nodes = []
+    while True:
+        node, pos = _parse_flowchart_node(text, pos)
+        nodes.append(node)
+        ampersand = re.match(r'\s*&\s*', text[pos:])
+        if not ampersand:
+            return " & ".join(nodes), pos
+        pos += ampersand.end()
+
+def _repair_flowchart_statement(statement: str) -> str:
+    statement = statement.strip()
+    # A single-dash arrow is a common slip: "A -> B"
+    statement = re.sub(r'(?<![-=.<])\s*->\s*(?!>)', ' --> ', statement)
+
+    parts = []
+    group, pos = _parse_node_group(statement, 0)
+    parts.append(group)
+    while pos < len(statement):
+        edge = _EDGE.match(statement, pos)
+        if not edge or edge.end() == pos:
+            raise ValueError(f"unexpected text {statement[pos:pos + 20]!r}")
+        parts.append(edge.group().strip())
+        group, pos = _parse_node_group(statement, edge.end())
+        parts.append(group)
+    return " ".join(parts)
+
+def _check_flowchart(header: str, lines: List[str]) -> Tuple[List[str], List[str]]:
+    output = [header]
+    errors = []
+    depth = 0
+    for raw_line in lines:
+        for statement in raw_line.split(";"):
+            statement = statement.strip()
+            if not statement:
+                continue
+            indent = "    " * (depth + 1)
+            if _FLOWCHART_KEYWORDS.match(statement):
+                if statement.startswith("subgraph"):
+                    depth += 1
+                elif statement == "end":
+                    depth -= 1
+                    indent = "    " * (depth + 1)
+                    if depth < 0:
+                        errors.append("'end' without a matching subgraph")
+                        depth = 0
+                        continue
+                output.append(indent + statement)
+                continue
+            try:
+                output.append(indent + _repair_flowchart_statement(statement))
+            except ValueError as e:
+                errors.append(str(e))
+                output.append(indent + statement)
+    # Close any subgraph the model forgot to end
+    output.extend("    " * level + "end" for level in range(depth, 0, -1))
+    if len(output) == 1:
+        errors.append("flowchart has no statements")
+    return output, errors
+
+# ============ SEQUENCE DIAGRAM ============
+
+_SEQUENCE_LINE = re.compile(
+    r'^(?:'
+    r'(?:participant|actor)\s+\S.*'
+    r'|[^\s:][^:]*?\s*(?:->>|-->>|->|-->|-x|--x|-\)|--\))[+-]?\s*[^:]+:.*'
+    r'|[Nn]ote\s+(?:left of|right of|over)\s+[^:]+:.*'
+    r'|(?:loop|alt|opt|par|critical|break|rect)\b.*'
+    r'|(?:else|and)\b.*'
+    r'|(?:activate|deactivate)\s+\S+'
+    r'|autonumber.*|title\b.*|%%.*'
+    r')$'
+)
+_SEQUENCE_ARROW_NO_TEXT = re.compile(r'^([^\s:][^:]*?\s*(?:->>|-->>|->|-->|-x|--x|-\)|--\))[+-]?\s*[^:]+)$')
+
+def _check_sequence(lines: List[str]) -> Tuple[List[str], List[str]]:
+    output = ["sequenceDiagram"]
+    errors = []
+    depth = 0
+    for line in lines:
+        statement = line.strip()
+        if not statement:
+            continue
+        if statement == "end":
+            depth -= 1
+            if depth < 0:
+                errors.append("'end' without a matching block")
+                depth = 0
+                continue
+        elif _SEQUENCE_ARROW_NO_TEXT.match(statement):
+            # Messages need a text after ':'
+            statement += ": "
+        elif not _SEQUENCE_LINE.match(statement):
+            errors.append(f"unrecognized sequence statement: {statement!r}")
+        elif re.match(r'^(loop|alt|opt|par|critical|break|rect)\b', statement):
+            depth += 1
+        output.append("    " + statement)
+    output.extend("    end" for _ in range(depth))
+    return output, errors
+
+# ============ ENTRY POINT ============
+
+def _statements(code: str) -> List[str]:
+    """Non-empty lines with all whitespace removed, so re-indenting or re-spacing isn't a repair."""
+    return [re.sub(r'\s+', '', line) for line in code.split("\n") if line.strip()]
+
+def _detect_header(first_line: str) -> Tuple[str, str, bool]:
+    """Return (diagram_type, header, header_was_missing) for the first line."""
+    words = first_line.split()
+    keyword = words[0].lower() if words else ""
+    if keyword == "mindmap":
+        return "mindmap", "mindmap", False
+    if keyword in ("graph", "flowchart"):
+        direction = words[1].upper() if len(words) > 1 and words[1].upper() in FLOWCHART_DIRECTIONS else "TD"
+        return "flowchart", f"{keyword} {direction}", False
+    if keyword == "sequencediagram":
+        return "sequenceDiagram", "sequenceDiagram", False
+    if keyword in OTHER_TYPES:
+        return OTHER_TYPES[keyword], first_line.strip(), False
+    # No header: guess from the content, like the client does
+    if re.match(r'^\s*\w*\(\(', first_line):
+        return "mindmap", "mindmap", True
+    return "flowchart", "flowchart TD", True
+
+def check_mermaid(code: str) -> MermaidCheck:
+    """Validate a Mermaid diagram, applying cheap fixes first."""
+    cleaned = _clean(code)
+    lines = [line for line in cleaned.split("\n") if line.strip()]
+    if not lines:
+        return MermaidCheck(False, cleaned, False, "", ["diagram is empty"])
+
+    diagram_type, header, missing_header = _detect_header(lines[0].strip())
+    body = lines if missing_header else lines[1:]
+
+    if diagram_type == "mindmap":
+        output, errors = _check_mindmap(body)
+    elif diagram_type == "flowchart":
+        output, errors = _check_flowchart(header, body)
+    elif diagram_type == "sequenceDiagram":
+        output, errors = _check_sequence(body)
+    else:
+        output = [header] + body
+        errors = [] if _balanced("\n".join(body)) else ["unbalanced brackets"]
+
+    repaired_code = "\n".join(output)
+    repaired = _statements(code or "") != _statements(repaired_code)
+    if diagram_type == "mindmap" and not repaired:
+        # A mindmap's indentation is its tree, so moving a node to another level is a repair
+        repaired = _mindmap_levels(_mindmap_nodes(body)) != _mindmap_levels(_mindmap_nodes(output[1:]))
+    return MermaidCheck(
+        valid=not errors,
+        code=repaired_code,
+        repaired=repaired,
+        diagram_type=diagram_type,
+        errors=errors
+    )
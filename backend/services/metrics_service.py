@@ -0,0 +1,44 @@
+import threading
+from typing import Dict, Any
+
+# Simple in-process metrics registry, exposed through GET /metrics.
+# Counters only go up, gauges hold the latest value and timings keep
+# count/total/max so averages can be derived by whoever scrapes them.
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_timings: Dict[str, Dict[str, float]] = {}
+
+def incr(name: str, value: float = 1) -> None:
+    """Increment a counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def set_gauge(name: str, value: float) -> None:
+    """Set a gauge to its current value."""
+    with _lock:
+        _gauges[name] = value
+
+def observe(name: str, value: float) -> None:
+    """Record one observation (usually a duration in milliseconds)."""
+    with _lock:
+        stats = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["total"] += value
+        stats["max"] = max(stats["max"], value)
+
+def get_metrics() -> Dict[str, Any]:
+    """Return a snapshot of every metric."""
+    with _lock:
+        timings = {}
+        for name, stats in _timings.items():
+            timings[name] = {
+                **stats,
+                "avg": stats["total"] / stats["count"] if stats["count"] else 0.0
+            }
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": timings
+        }
@@ -0,0 +1,37 @@
+import hashlib
+from typing import List, Optional
+
+# Delta saves for notes: instead of re-uploading the whole note on every
+# autosave, the client sends the edits made since the version it last saw.
+# Each edit replaces `delete` characters at `pos` with `insert`; positions are
+# Unicode code points (Array.from(text) in JavaScript, not UTF-16 units) in the
+# base version, and edits are sorted and don't overlap. The optional sha256 of
+# the expected result catches a client whose copy has drifted from the server's.
+
+def apply_note_patch(base: str, ops: List[dict], sha256: Optional[str] = None) -> str:
+    """Apply edits made against `base`; raises ValueError if they don't fit it."""
+    end = 0
+    for op in ops:
+        if op["pos"] < 0 or op.get("delete", 0) < 0:
+            raise ValueError("Edit positions and lengths can't be negative")
+        if op["pos"] < end:
+            raise ValueError("Edits must be sorted by position and must not overlap")
+        end = op["pos"] + op.get("delete", 0)
+        if end > len(base):
+            raise ValueError(f"Edit at {op['pos']} runs past the end of the note ({len(base)} characters)")
+
+    parts = []
+    position = 0
+    for op in ops:
+        parts.append(base[position:op["pos"]])
+        parts.append(op.get("insert", ""))
+        position = op["pos"] + op.get("delete", 0)
+    parts.append(base[position:])
+    result = "".join(parts)
+
+    if sha256 and note_sha256(result) != sha256.lower():
+        raise ValueError("Patched note doesn't match sha256; send the full note instead")
+    return result
+
+def note_sha256(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
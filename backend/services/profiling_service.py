@@ -0,0 +1,236 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import secrets
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any
+
+# Opt-in, dependency-free sampling profiler for slow requests. A fraction
+# (PROFILE_SAMPLE_RATE) of requests is profiled by the middleware in main.py:
+# while at least one of them is in flight, a background thread snapshots the
+# Python stack of every busy thread each PROFILE_INTERVAL_MS. Requests slower
+# than PROFILE_MIN_DURATION_MS are written to PROFILE_DIR as collapsed stacks
+# ("<id>.folded", one "frame;frame;frame count" line per stack) that
+# flamegraph.pl, speedscope or inferno render directly, with a "<id>.json"
+# summary next to it. Only the newest PROFILE_MAX_FILES captures are kept.
+#
+# Samples are wall-clock and process-wide: the event loop and the threadpools
+# (database calls, bcrypt, Gemini) are all included, so a capture taken while
+# other requests were running also shows their work ("concurrent" in the
+# summary). Threads parked in a wait (idle pool workers, the event loop's
+# select) are left out.
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.05"))
+PROFILE_MIN_DURATION_MS = float(os.getenv("PROFILE_MIN_DURATION_MS", "500"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), '..', 'data', 'profiles'))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+MAX_STACK_DEPTH = 128
+TOP_FRAMES = 10
+
+# (file name, function) of the leaf frame of a thread that is only waiting
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+_CAPTURE_ID = re.compile(r'^\d{8}T\d{9}-[0-9a-f]{6}$')
+
+class Capture:
+    __slots__ = ("stacks", "samples", "started", "concurrent")
+
+    def __init__(self):
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.concurrent = 0  # Most other profiled requests in flight at once
+
+class Sampler:
+    """One thread that samples every busy thread's stack while any capture is active."""
+
+    def __init__(self, interval_ms: float):
+        self.interval = interval_ms / 1000
+        self.lock = threading.Lock()
+        self.active: List[Capture] = []
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.labels: Dict[Any, str] = {}
+        self.root = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+    def start(self) -> Capture:
+        capture = Capture()
+        with self.lock:
+            self.active.append(capture)
+            for other in self.active:
+                other.concurrent = max(other.concurrent, len(self.active) - 1)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+            self.wake.set()
+        return capture
+
+    def stop(self, capture: Capture):
+        with self.lock:
+            self.active.remove(capture)
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            with self.lock:
+                captures = list(self.active)
+                if not captures:
+                    self.wake.clear()
+                    continue
+            stacks = self._sample()
+            with self.lock:
+                for capture in captures:
+                    capture.stacks.update(stacks)
+                    capture.samples += 1
+            time.sleep(self.interval)
+
+    def _label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if filename.startswith(self.root):
+                filename = filename[len(self.root):]
+            elif "site-packages" + os.sep in filename:
+                filename = filename.split("site-packages" + os.sep, 1)[1]
+            else:
+                filename = os.path.basename(filename)
+            label = f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+            self.labels[code] = label
+        return label
+
+    def _sample(self) -> List[str]:
+        own = threading.get_ident()
+        names = {thread.ident: re.sub(r'_\d+$', '', thread.name) for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                continue
+            frames = []
+            while frame is not None and len(frames) < MAX_STACK_DEPTH:
+                frames.append(self._label(frame.f_code))
+                frame = frame.f_back
+            frames.append(names.get(ident, "thread"))
+            stacks.append(";".join(reversed(frames)))
+        return stacks
+
+_sampler = Sampler(PROFILE_INTERVAL_MS)
+
+def should_profile() -> bool:
+    """Whether to profile this request: PROFILING_ENABLED and within PROFILE_SAMPLE_RATE."""
+    return PROFILING_ENABLED and random.random() < PROFILE_SAMPLE_RATE
+
+@contextmanager
+def profile_request(method: str, path: str):
+    """Sample stacks for the duration of a request and keep them if it was slow.
+
+    Yields a dict the caller can add details to (e.g. "status") before it is saved.
+    """
+    capture = _sampler.start()
+    details: Dict[str, Any] = {}
+    try:
+        yield details
+    finally:
+        _sampler.stop(capture)
+        duration_ms = (time.perf_counter() - capture.started) * 1000
+        if duration_ms >= PROFILE_MIN_DURATION_MS and capture.samples:
+            try:
+                _write_queue.put_nowait((method, path, duration_ms, capture, details))
+            except queue.Full:
+                pass  # Writer is behind; drop rather than slow the request
+
+# ============ CAPTURE FILES ============
+
+_write_queue: "queue.Queue[tuple]" = queue.Queue(maxsize=100)
+
+def _summary(capture_id: str, method: str, path: str, duration_ms: float, capture: Capture, details: dict) -> dict:
+    own = Counter()
+    for stack, count in capture.stacks.items():
+        own[stack.rsplit(";", 1)[-1]] += count
+    return {
+        "id": capture_id,
+        "captured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "method": method,
+        "path": path,
+        "duration_ms": round(duration_ms, 1),
+        "samples": capture.samples,
+        "interval_ms": PROFILE_INTERVAL_MS,
+        "concurrent": capture.concurrent,
+        # Frames where the most samples were taken, i.e. what the threads were doing
+        "top_frames": [{"frame": frame, "samples": count} for frame, count in own.most_common(TOP_FRAMES)],
+        **details
+    }
+
+def _rotate():
+    summaries = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".json"))
+    for name in summaries[:max(0, len(summaries) - PROFILE_MAX_FILES)]:
+        for path in (name, name[:-len(".json")] + ".folded"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, path))
+            except FileNotFoundError:
+                pass  # Another worker rotated it first
+
+def _write_loop():
+    while True:
+        method, path, duration_ms, capture, details = _write_queue.get()
+        try:
+            now = time.time()
+            capture_id = f"{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}{int(now * 1000) % 1000:03d}-{secrets.token_hex(3)}"
+            base = os.path.join(PROFILE_DIR, capture_id)
+            with open(base + ".folded", "w", encoding="utf-8") as folded:
+                for stack, count in capture.stacks.most_common():
+                    folded.write(f"{stack} {count}\n")
+            # The summary is written last: listings only show complete captures
+            with open(base + ".json", "w", encoding="utf-8") as summary:
+                json.dump(_summary(capture_id, method, path, duration_ms, capture, details), summary)
+            _rotate()
+        except Exception as e:
+            print(f"❌ Profile write failed: {e}")
+
+if PROFILING_ENABLED:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    threading.Thread(target=_write_loop, name="profile-writer", daemon=True).start()
+
+def list_captures(limit: int = 50) -> List[dict]:
+    """Summaries of the most recent captures, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((name for name in os.listdir(PROFILE_DIR) if name.endswith(".json")), reverse=True)
+    captures = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(PROFILE_DIR, name), encoding="utf-8") as summary:
+                captures.append(json.load(summary))
+        except (FileNotFoundError, ValueError):
+            continue  # Rotated away or half-written by another worker
+    return captures
+
+def capture_path(capture_id: str) -> Optional[str]:
+    """Path of a capture's collapsed stacks, or None for an unknown id."""
+    if not _CAPTURE_ID.match(capture_id):
+        return None
+    path = os.path.join(PROFILE_DIR, capture_id + ".folded")
+    return path if os.path.exists(path) else None
+
+if __name__ == "__main__":
+    for summary in list_captures(int(sys.argv[1]) if len(sys.argv) > 1 else 10):
+        print(f"\n{summary['id']}  {summary['method']} {summary['path']}  {summary['duration_ms']} ms  "
+              f"{summary['samples']} samples")
+        for top in summary["top_frames"][:5]:
+            print(f"  {top['samples']:>6}  {top['frame']}")
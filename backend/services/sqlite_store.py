@@ -0,0 +1,154 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+import contextvars
+from concurrent.futures import Future
+from typing import Optional
+from services.metrics_service import incr, set_gauge, observe
+
+# High-concurrency mode for the SQLite fallback (SQLITE_CONCURRENT=true).
+# The database runs in WAL mode with tuned pragmas; every thread keeps one
+# persistent reader connection, and all writes are funnelled through a single
+# writer thread. The writer drains up to SQLITE_WRITE_BATCH queued writes,
+# runs each inside its own savepoint of one transaction and commits once, so
+# concurrent writers never fight over the database lock and share an fsync.
+
+SQLITE_CONCURRENT = os.getenv("SQLITE_CONCURRENT", "false").lower() == "true"
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_WRITE_BATCH = int(os.getenv("SQLITE_WRITE_BATCH", "64"))
+
+def configure_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Apply the WAL and cache pragmas used in concurrent mode."""
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    # NORMAL is durable against application crashes in WAL mode; only an OS
+    # crash can lose the last commits
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+# ============ READERS ============
+
+_readers = threading.local()
+
+def reader_connection(path: str) -> sqlite3.Connection:
+    """This thread's persistent connection, opened on first use."""
+    conn = getattr(_readers, "conn", None)
+    if conn is None:
+        conn = configure_connection(sqlite3.connect(path, check_same_thread=False))
+        _readers.conn = conn
+        incr("sqlite.reader_connections")
+    return conn
+
+# ============ WRITER ============
+
+class _WriterConnection:
+    """The writer's connection as seen by a queued write.
+
+    commit() is deferred to the group commit and rollback() only undoes the
+    current write, so existing write functions run unchanged.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def execute(self, *args):
+        return self._conn.execute(*args)
+
+    @property
+    def in_transaction(self) -> bool:
+        return True
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._conn.execute('ROLLBACK TO SAVEPOINT queued_write')
+
+class SQLiteWriter:
+    def __init__(self, path: str, batch_size: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.jobs: "queue.Queue[tuple]" = queue.Queue()
+        self.local = threading.local()
+        self.thread: Optional[threading.Thread] = None
+        self.start_lock = threading.Lock()
+
+    def current_connection(self) -> Optional[_WriterConnection]:
+        """The writer connection when called from inside a queued write, else None."""
+        return getattr(self.local, "conn", None)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn on the writer thread and wait for its result (or exception)."""
+        if self.current_connection() is not None:
+            # A write calling another write: already on the writer thread
+            return fn(*args, **kwargs)
+        self._ensure_started()
+        future: Future = Future()
+        self.jobs.put((contextvars.copy_context(), fn, args, kwargs, future, time.perf_counter()))
+        set_gauge("sqlite.write_queue", self.jobs.qsize())
+        return future.result()
+
+    def _ensure_started(self):
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        conn = configure_connection(sqlite3.connect(self.path, isolation_level=None, check_same_thread=False))
+        self.local.conn = _WriterConnection(conn)
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            set_gauge("sqlite.write_queue", self.jobs.qsize())
+            self._apply(conn, batch)
+
+    def _apply(self, conn: sqlite3.Connection, batch: list):
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for context, fn, args, kwargs, future, queued in batch:
+                observe("sqlite.write_wait_ms", (started - queued) * 1000)
+                conn.execute('SAVEPOINT queued_write')
+                try:
+                    result = context.run(fn, *args, **kwargs)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO SAVEPOINT queued_write')
+                    outcomes.append((future, None, e))
+                else:
+                    outcomes.append((future, result, None))
+                conn.execute('RELEASE SAVEPOINT queued_write')
+            conn.execute('COMMIT')
+        except Exception as e:
+            # The commit itself failed: nothing in the batch was written
+            print(f"❌ SQLite group commit failed: {e}")
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            outcomes = [(job[4], None, e) for job in batch]
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        incr("sqlite.group_commits")
+        incr("sqlite.writes", len(batch))
+        observe("sqlite.group_commit_size", len(batch))
+        observe("sqlite.group_commit_ms", (time.perf_counter() - started) * 1000)
@@ -0,0 +1,163 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from services.auth_service import get_syllabus_index_rows
+
+# Lookup over previously generated syllabi. Topics are normalized, so "Python
+# basics", "python Basics " and "Intro to Python" at the same level and daily
+# minutes are the same intake and reuse one syllabus instead of paying for a new
+# Gemini call. Near-duplicates are only offered (/syllabus/similar), never reused
+# silently: "Organic Chemistry I" and "... II" are close as strings but are
+# different courses. For those, topics are split into character trigrams and
+# indexed with MinHash + LSH banding; candidates are then confirmed with the
+# exact Jaccard similarity of their trigram sets.
+
+SYLLABUS_SIMILARITY_THRESHOLD = float(os.getenv("SYLLABUS_SIMILARITY_THRESHOLD", "0.8"))
+# Seconds between checks for syllabi written by other workers
+SYLLABUS_INDEX_REFRESH_SECONDS = float(os.getenv("SYLLABUS_INDEX_REFRESH_SECONDS", "30"))
+
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# Words that describe the kind of course rather than its subject. Words that
+# can also be part of a subject ("Machine Learning", "Golf Course") stay out.
+FILLER_WORDS = {
+    "a", "an", "the", "to", "of", "for", "and", "in", "on", "with",
+    "intro", "introduction", "introductory", "basics", "fundamentals",
+    "beginner", "beginners", "101", "guide", "essentials",
+}
+
+def _permutation_params() -> List[Tuple[int, int]]:
+    """Fixed (a, b) pairs for the universal hash family, identical across workers."""
+    params = []
+    for i in range(NUM_PERM):
+        digest = hashlib.blake2b(f"minhash-{i}".encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "big") % _MERSENNE_PRIME or 1
+        b = int.from_bytes(digest[8:], "big") % _MERSENNE_PRIME
+        params.append((a, b))
+    return params
+
+_PERMUTATIONS = _permutation_params()
+
+def normalize_topic(topic: str) -> str:
+    """Fold case, punctuation, whitespace and filler words so equivalent topics compare equal."""
+    words = re.findall(r"[a-z0-9+#]+", topic.casefold())
+    meaningful = [word for word in words if word not in FILLER_WORDS]
+    return " ".join(meaningful or words)
+
+def normalize_level(level: str) -> str:
+    return " ".join(level.casefold().split())
+
+def shingles(normalized_topic: str) -> Set[str]:
+    """Character n-grams of the normalized topic (padded so short topics still produce some)."""
+    padded = f" {normalized_topic} "
+    if len(padded) <= SHINGLE_SIZE:
+        return {padded}
+    return {padded[i:i + SHINGLE_SIZE] for i in range(len(padded) - SHINGLE_SIZE + 1)}
+
+def minhash_signature(grams: Set[str]) -> Tuple[int, ...]:
+    base_hashes = [int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "big") for gram in grams]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in base_hashes)
+        for a, b in _PERMUTATIONS
+    )
+
+def jaccard(first: Set[str], second: Set[str]) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+class TopicIndex:
+    """In-memory MinHash/LSH index, partitioned by (level, daily_minutes)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.exact: Dict[tuple, str] = {}
+        self.buckets: Dict[tuple, Set[str]] = {}
+        self.grams: Dict[str, Set[str]] = {}
+        self.last_created_at: Optional[str] = None
+        self.last_refresh = 0.0
+        self.loaded = False
+
+    def add(self, syllabus_id: str, normalized_topic: str, level: str, daily_minutes: int):
+        partition = (normalize_level(level), daily_minutes)
+        grams = shingles(normalized_topic)
+        signature = minhash_signature(grams)
+        with self.lock:
+            # Keep the oldest syllabus for an exact match so reuse stays stable
+            self.exact.setdefault((partition, normalized_topic), syllabus_id)
+            self.grams[syllabus_id] = grams
+            for band in range(BANDS):
+                band_key = (partition, band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])
+                self.buckets.setdefault(band_key, set()).add(syllabus_id)
+
+    def query(self, normalized_topic: str, level: str, daily_minutes: int,
+              threshold: float, limit: int) -> List[Tuple[str, float]]:
+        partition = (normalize_level(level), daily_minutes)
+        with self.lock:
+            exact_id = self.exact.get((partition, normalized_topic))
+        if exact_id and limit == 1:
+            return [(exact_id, 1.0)]
+
+        grams = shingles(normalized_topic)
+        signature = minhash_signature(grams)
+        candidates: Set[str] = set()
+        with self.lock:
+            for band in range(BANDS):
+                band_key = (partition, band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND])
+                candidates |= self.buckets.get(band_key, set())
+            scored = [(syllabus_id, jaccard(grams, self.grams[syllabus_id])) for syllabus_id in candidates]
+
+        matches = [(syllabus_id, score) for syllabus_id, score in scored if score >= threshold]
+        matches.sort(key=lambda match: (-match[1], match[0] != exact_id))
+        return matches[:limit]
+
+    def exact_match(self, normalized_topic: str, level: str, daily_minutes: int) -> Optional[str]:
+        with self.lock:
+            return self.exact.get(((normalize_level(level), daily_minutes), normalized_topic))
+
+    def refresh(self, force: bool = False):
+        """Pull syllabi written since the last refresh (by this or any other worker)."""
+        now = time.monotonic()
+        if not force and self.loaded and now - self.last_refresh < SYLLABUS_INDEX_REFRESH_SECONDS:
+            return
+        # Lookups run on several threads; one refresh at a time is enough, the
+        # others use the index as it is (or wait for the first load)
+        if not self.refresh_lock.acquire(blocking=not self.loaded):
+            return
+        try:
+            self.last_refresh = now
+            for row in get_syllabus_index_rows(self.last_created_at):
+                # Normalized here rather than read back, so changes to the rules apply to old syllabi
+                self.add(row['id'], normalize_topic(row['topic']), row['level'], row['daily_minutes'])
+                self.last_created_at = row['created_at']
+            self.loaded = True
+        finally:
+            self.refresh_lock.release()
+
+_index = TopicIndex()
+
+def find_similar_syllabi(topic: str, level: str, daily_minutes: int,
+                         threshold: Optional[float] = None, limit: int = 1) -> List[Tuple[str, float]]:
+    """Return up to `limit` (syllabus_id, similarity) pairs above the threshold, best first."""
+    _index.refresh()
+    return _index.query(
+        normalize_topic(topic), level, daily_minutes,
+        SYLLABUS_SIMILARITY_THRESHOLD if threshold is None else threshold, limit
+    )
+
+def find_matching_syllabus(topic: str, level: str, daily_minutes: int) -> Optional[str]:
+    """The stored syllabus for the same normalized topic, level and daily minutes, if any."""
+    _index.refresh()
+    return _index.exact_match(normalize_topic(topic), level, daily_minutes)
+
+def index_syllabus(syllabus_id: str, topic: str, level: str, daily_minutes: int) -> None:
+    """Add a freshly stored syllabus to this worker's index."""
+    _index.add(syllabus_id, normalize_topic(topic), level, daily_minutes)
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import queue
+import secrets
+import functools
+import threading
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, List, Dict, Any
+
+# Opt-in, dependency-free request tracing. A root span is opened per HTTP
+# request (see the middleware in main.py); spans opened while it is active
+# become its children. When the root ends, the whole trace is handed to a
+# background exporter that appends it as an OTLP/JSON line to TRACE_FILE or
+# POSTs it to an OTLP/HTTP collector. Outside a request, spans are no-ops.
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")  # "file" or "otlp"
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.path.dirname(__file__), '..', 'data', 'traces.jsonl'))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# Only export traces whose root took at least this long
+TRACE_MIN_DURATION_MS = float(os.getenv("TRACE_MIN_DURATION_MS", "0"))
+SERVICE_NAME = "infinitetutor-api"
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns", "error", "spans")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], spans: List["Span"], attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        # Shared by every span of the trace; list.append is thread-safe
+        self.spans = spans
+        spans.append(self)
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if self.parent_id is None else 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+def _otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a child span of the active trace. Does nothing when no trace is active."""
+    parent = _current_span.get() if TRACING_ENABLED else None
+    if parent is None:
+        yield None
+        return
+
+    current = Span(name, parent.trace_id, parent.span_id, parent.spans, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+
+@contextmanager
+def trace_request(name: str, **attributes):
+    """Open the root span of a new trace and export the trace when it ends."""
+    if not TRACING_ENABLED:
+        yield None
+        return
+
+    root = Span(name, secrets.token_hex(16), None, [], attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        root.end_ns = time.time_ns()
+        _current_span.reset(token)
+        if root.duration_ms >= TRACE_MIN_DURATION_MS:
+            try:
+                _export_queue.put_nowait(root.spans)
+            except queue.Full:
+                pass  # Exporter is behind; drop rather than slow the request
+
+def traced(fn):
+    """Decorator that records a span named after the function for each call."""
+    name = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not TRACING_ENABLED or _current_span.get() is None:
+            return fn(*args, **kwargs)
+        with span(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+# ============ EXPORT ============
+
+_export_queue: "queue.Queue[List[Span]]" = queue.Queue(maxsize=1000)
+
+def _otlp_payload(spans: List[Span]) -> dict:
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "infinitetutor"}, "spans": [s.to_otlp() for s in spans]}]
+        }]
+    }
+
+def _export_loop():
+    while True:
+        spans = _export_queue.get()
+        try:
+            payload = json.dumps(_otlp_payload(spans))
+            if TRACE_EXPORTER == "otlp":
+                request = urllib.request.Request(
+                    TRACE_OTLP_ENDPOINT, data=payload.encode('utf-8'),
+                    headers={"Content-Type": "application/json"}
+                )
+                with urllib.request.urlopen(request, timeout=5) as response:
+                    response.read()
+            else:
+                with open(TRACE_FILE, "a", encoding="utf-8") as trace_file:
+                    trace_file.write(payload + "\n")
+        except Exception as e:
+            print(f"❌ Trace export failed: {e}")
+
+if TRACING_ENABLED:
+    if TRACE_EXPORTER != "otlp":
+        os.makedirs(os.path.dirname(os.path.abspath(TRACE_FILE)), exist_ok=True)
+    threading.Thread(target=_export_loop, name="trace-exporter", daemon=True).start()
+
+# ============ WATERFALL VIEWER ============
+
+def print_waterfalls(path: str, slowest: int = 5):
+    """Print text waterfalls for the slowest traces in a TRACE_FILE."""
+    traces = []
+    with open(path, encoding="utf-8") as trace_file:
+        for line in trace_file:
+            spans = json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+            root = next(s for s in spans if "parentSpanId" not in s)
+            duration = (int(root["endTimeUnixNano"]) - int(root["startTimeUnixNano"])) / 1e6
+            traces.append((duration, root, spans))
+
+    for duration, root, spans in sorted(traces, key=lambda t: -t[0])[:slowest]:
+        start = int(root["startTimeUnixNano"])
+        children: Dict[str, list] = {}
+        for s in spans:
+            children.setdefault(s.get("parentSpanId"), []).append(s)
+
+        print(f"\n{root['name']}  {duration:.1f} ms  trace={root['traceId']}")
+
+        def walk(s, depth):
+            offset = (int(s["startTimeUnixNano"]) - start) / 1e6
+            length = (int(s["endTimeUnixNano"]) - int(s["startTimeUnixNano"])) / 1e6
+            bar_start = int(40 * offset / duration) if duration else 0
+            bar = " " * bar_start + "█" * max(1, int(40 * length / duration) if duration else 1)
+            failed = " ❌" if s["status"].get("code") == 2 else ""
+            print(f"  {'  ' * depth}{s['name']:<{50 - 2 * depth}} {offset:>8.1f} +{length:>8.1f} ms |{bar:<40}|{failed}")
+            for child in sorted(children.get(s["spanId"], []), key=lambda c: int(c["startTimeUnixNano"])):
+                walk(child, depth + 1)
+
+        walk(root, 0)
+
+if __name__ == "__main__":
+    print_waterfalls(sys.argv[1] if len(sys.argv) > 1 else TRACE_FILE, int(sys.argv[2]) if len(sys.argv) > 2 else 5)